@@ -1,150 +1,375 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 
-# This is a copy of the defirqaffinity.py script provided by the tuned
-# package available on Amazon Linux 2.
+# This is derived from the defirqaffinity.py script provided by the tuned
+# package available on Amazon Linux 2 (a Python 2 helper script for realtime
+# profiles provided by RT), and keeps the same command line interface:
 #
-# It has one change from that file: the final three lines of the script
-# (that write to the smp_affinity file) have been put inside a
-# try/except block.
-# This means a failure to write the affinity (which can happen with MSI or
-# MSI-X drivers like NVMe, which is used on AWS nodes for EBS storage) doesn't
-# result in the script bailing out and failing to set the affinity for
-# the IRQs it hasn't attempted yet.
-# This is the approach taken in more recent versions of tuned which aren't
-# easily available on Amazon Linux 2.
+#   defirqaffinity.py [--dry-run] add|remove|verify CPULIST [IRQPATH]
+#   defirqaffinity.py [--dry-run] [--sysfs SYSFS] place CPULIST [IRQPATH]
 #
-# Helper script for realtime profiles provided by RT
+# It differs from that file in the following ways:
+#
+# - It is Python 3.
+#
+# - A failure to write the affinity for an IRQ (which can happen with MSI or
+#   MSI-X drivers like NVMe, which is used on AWS nodes for EBS storage)
+#   doesn't result in the script bailing out and failing to set the affinity
+#   for the IRQs it hasn't attempted yet.
+#   This is the approach taken in more recent versions of tuned which aren't
+#   easily available on Amazon Linux 2.
+#   Each written mask is also read back, along with the IRQ's effective
+#   affinity where the kernel reports it, and IRQs the kernel didn't move are
+#   reported along with those whose write failed.
+#
+# - The CPU list is parsed into a bitmask once, and each IRQ's hex mask is
+#   converted straight to an int, so add/remove is a single bitwise operation
+#   per IRQ.  The affinity file is only written if the mask actually changes.
+#   Large instances can have hundreds of MSI-X vectors, and this script runs
+#   on every tuned profile apply.
+#
+# - An optional IRQPATH argument can be given in place of /proc/irq/, so the
+#   script can be run (e.g. benchmarked) against a synthetic IRQ tree.
+#
+# - With --dry-run nothing is written; instead a JSON report is printed with
+#   the old and new mask of each IRQ that would change, and the IRQs which
+#   can't be moved off the given CPUs.  Without --dry-run the IRQs which
+#   couldn't be moved are summarized on stderr.
+#
+# - The 'place' action removes the given (isolated) CPUs like 'remove', and
+#   additionally pins each IRQ raised by a PCI device to a single one of the
+#   remaining (housekeeping) CPUs local to the device's NUMA node, spreading
+#   the IRQs across those CPUs.  This stops e.g. ENA and NVMe interrupts being
+#   handled on the remote socket of multi-socket instances.
+#   IRQs which can't be mapped to a device, or whose device has no local
+#   housekeeping CPUs, are treated as for 'remove'.
 
+import argparse
+import json
 import os
 import sys
+from typing import Dict, List, NamedTuple, Optional
+
+
+IRQPATH = "/proc/irq/"
+SYSFS = "/sys/"
 
-irqpath = "/proc/irq/"
-
-def bitmasklist(line):
-	fields = line.strip().split(",")
-	bitmasklist = []
-	entry = 0
-	for i in range(len(fields) - 1, -1, -1):
-		mask = int(fields[i], 16)
-		while mask != 0:
-			if mask & 1:
-				bitmasklist.append(entry)
-			mask >>= 1
-			entry += 1
-	return bitmasklist
-
-def get_cpumask(mask):
-	groups = []
-	comma = 0
-	while mask:
-		cpumaskstr = ''
-		m = mask & 0xffffffff
-		cpumaskstr += ('%x' % m)
-		if comma:
-			cpumaskstr += ','
-		comma = 1
-		mask >>= 32
-		groups.append(cpumaskstr)
-	string = ''
-	for i in reversed(groups):
-		string += i
-	return string
-
-def parse_def_affinity(fname):
-	if os.getuid() != 0:
-		return
-	try:
-		f = file(fname)
-		line = f.readline()
-		f.close()
-		return bitmasklist(line)
-	except IOError:
-		return [ 0 ]
-
-def verify(shouldbemask):
-	inplacemask = 0
-	fname = irqpath + "default_smp_affinity";
-	cpulist = parse_def_affinity(fname)
-	for i in cpulist:
-		inplacemask = inplacemask | 1 << i;
-	if (inplacemask & ~shouldbemask):
-		sys.stderr.write("verify: failed: irqaffinity (%s) inplacemask=%x shouldbemask=%x\n" % (fname, inplacemask, shouldbemask))
-		sys.exit(1)
-
-	# now verify each /proc/irq/$num/smp_affinity
-	interruptdirs = [ f for f in os.listdir(irqpath) if os.path.isdir(os.path.join(irqpath,f)) ]
-	# IRQ 2 - cascaded signals from IRQs 8-15 (any devices configured to use IRQ 2 will actually be using IRQ 9)
-	interruptdirs.remove("2")
-	# IRQ 0 - system timer (cannot be changed)
-	interruptdirs.remove("0")
-
-	for i in interruptdirs:
-		inplacemask = 0
-		fname = irqpath + i + "/smp_affinity"
-		cpulist = parse_def_affinity(fname)
-		for i in cpulist:
-			inplacemask = inplacemask | 1 << i;
-		if (inplacemask & ~shouldbemask):
-			sys.stderr.write("verify: failed: irqaffinity (%s) inplacemask=%x shouldbemask=%x\n" % (fname, inplacemask, shouldbemask))
-			sys.exit(1)
-
-	sys.exit(0)
-
-
-
-# adjust default_smp_affinity
-cpulist = parse_def_affinity(irqpath + "default_smp_affinity")
-mask = 0
-for i in cpulist:
-	mask = mask | 1 << i;
-
-if len(sys.argv) < 3 or len(str(sys.argv[2])) == 0:
-	sys.stderr.write("%s: invalid arguments\n" % os.path.basename(sys.argv[0]))
-	sys.exit(1)
-
-line = sys.argv[2]
-fields = line.strip().split(",")
-
-for i in fields:
-	if sys.argv[1] == "add":
-		mask = mask | 1 << int(i);
-	elif sys.argv[1] == "remove" or sys.argv[1] == "verify":
-		mask = mask & ~(1 << int(i));
-
-if sys.argv[1] == "verify":
-	verify(mask)
-
-string = get_cpumask(mask)
-
-fo = open(irqpath + "default_smp_affinity", "wb")
-fo.write(string)
-fo.close()
-
-# now adjust each /proc/irq/$num/smp_affinity
-
-interruptdirs = [ f for f in os.listdir(irqpath) if os.path.isdir(os.path.join(irqpath,f)) ]
-
-# IRQ 2 - cascaded signals from IRQs 8-15 (any devices configured to use IRQ 2 will actually be using IRQ 9)
-interruptdirs.remove("2")
 # IRQ 0 - system timer (cannot be changed)
-interruptdirs.remove("0")
-
-for i in interruptdirs:
-	irq = i
-	fname = irqpath + i + "/smp_affinity"
-	cpulist = parse_def_affinity(fname)
-	mask = 0
-	for i in cpulist:
-		mask = mask | 1 << i;
-	for i in fields:
-		if sys.argv[1] == "add":
-			mask = mask | 1 << int(i);
-		elif sys.argv[1] == "remove":
-			mask = mask & ~(1 << int(i));
-	string = get_cpumask(mask)
-	try:
-		fo = open(fname, "wb")
-		fo.write(string)
-		fo.close()
-	except Exception:
-		print "Failed to set affinity for irq %u, continuing...", irq
+# IRQ 2 - cascaded signals from IRQs 8-15 (any devices configured to use IRQ 2
+# will actually be using IRQ 9)
+SKIPPED_IRQS = ("0", "2")
+
+
+class Change(NamedTuple):
+    """A change to the affinity of an IRQ ("default" for the default)."""
+
+    irq: str
+    fname: str
+    old: int
+    new: int
+
+
+def parse_cpulist(line: str) -> int:
+    """Convert a CPU list (e.g. "1,2,5-7") into a bitmask."""
+    mask = 0
+    for field in line.strip().split(","):
+        if not field:
+            continue
+        if "-" in field:
+            first, last = (int(x) for x in field.split("-", 1))
+            mask |= ((1 << (last - first + 1)) - 1) << first
+        else:
+            mask |= 1 << int(field)
+    return mask
+
+
+def parse_cpumask(line: str) -> int:
+    """Convert a (comma separated) hex cpumask into a bitmask."""
+    return int(line.strip().replace(",", ""), 16)
+
+
+def format_cpumask(mask: int) -> str:
+    """Convert a bitmask into a hex cpumask (comma separated 32-bit groups)."""
+    string = "%x" % mask
+    head = len(string) % 8 or 8
+    groups = [string[:head]]
+    groups.extend(string[i : i + 8] for i in range(head, len(string), 8))
+    return ",".join(groups)
+
+
+def read_cpumask(fname: str) -> int:
+    """Read a cpumask file, assuming CPU 0 only if it can't be read."""
+    try:
+        with open(fname) as f:
+            return parse_cpumask(f.readline())
+    except (OSError, ValueError):
+        return 1
+
+
+def write_cpumask(fname: str, mask: int) -> None:
+    with open(fname, "w") as f:
+        f.write(format_cpumask(mask))
+
+
+def interrupt_dirs(path: str) -> List[str]:
+    return sorted(
+        (
+            f
+            for f in os.listdir(path)
+            if f not in SKIPPED_IRQS and os.path.isdir(os.path.join(path, f))
+        ),
+        key=int,
+    )
+
+
+def affinity_files(path: str) -> List[Change]:
+    """
+    Return the default and per-IRQ affinity files, as no-op changes with the
+    current mask.
+
+    """
+    files = [("default", os.path.join(path, "default_smp_affinity"))]
+    files.extend(
+        (irq, os.path.join(path, irq, "smp_affinity"))
+        for irq in interrupt_dirs(path)
+    )
+    changes = []
+    for irq, fname in files:
+        mask = read_cpumask(fname)
+        changes.append(Change(irq, fname, mask, mask))
+    return changes
+
+
+def device_irqs(sysfs: str) -> Dict[str, str]:
+    """Map IRQs to the sysfs path of the PCI device which raises them."""
+    devices = os.path.join(sysfs, "bus", "pci", "devices")
+    try:
+        names = sorted(os.listdir(devices))
+    except OSError:
+        return {}
+
+    irqs = {}
+    for name in names:
+        device = os.path.join(devices, name)
+        try:
+            for irq in os.listdir(os.path.join(device, "msi_irqs")):
+                irqs[irq] = device
+        except OSError:
+            pass
+        try:
+            with open(os.path.join(device, "irq")) as f:
+                irq = f.readline().strip()
+        except OSError:
+            continue
+        if irq and irq != "0":
+            irqs.setdefault(irq, device)
+    return irqs
+
+
+def device_cpumask(device: str) -> int:
+    """
+    Return the CPUs local to a PCI device's NUMA node, or 0 if the device has
+    no NUMA affinity.
+
+    """
+    try:
+        with open(os.path.join(device, "numa_node")) as f:
+            if int(f.readline()) < 0:
+                return 0
+        with open(os.path.join(device, "local_cpulist")) as f:
+            return parse_cpulist(f.readline())
+    except (OSError, ValueError):
+        return 0
+
+
+def verify(path: str, cpumask: int) -> int:
+    """Check no IRQ has affinity with any CPU in ``cpumask``."""
+    files = affinity_files(path)
+    shouldbemask = files[0].old & ~cpumask
+    for c in files:
+        if c.old & ~shouldbemask:
+            sys.stderr.write(
+                "verify: failed: irqaffinity (%s) inplacemask=%x "
+                "shouldbemask=%x\n" % (c.fname, c.old, shouldbemask)
+            )
+            return 1
+    return 0
+
+
+def plan(path: str, action: str, cpumask: int) -> List[Change]:
+    """Return the changes needed to add or remove ``cpumask`` for all IRQs."""
+    changes = []
+    for c in affinity_files(path):
+        if action == "add":
+            new = c.old | cpumask
+        else:
+            new = c.old & ~cpumask
+        if new != c.old:
+            changes.append(c._replace(new=new))
+    return changes
+
+
+def plan_placement(path: str, sysfs: str, cpumask: int) -> List[Change]:
+    """
+    Return the changes needed to remove ``cpumask`` for all IRQs, pinning
+    each device IRQ to the least loaded remaining CPU on the device's node.
+
+    """
+    files = affinity_files(path)
+    housekeeping = files[0].old & ~cpumask
+    devices = device_irqs(sysfs)
+    local_cpus = {}
+    load = {}
+
+    changes = []
+    for c in files:
+        new = c.old & ~cpumask
+        device = devices.get(c.irq)
+        if device is not None:
+            if device not in local_cpus:
+                local = device_cpumask(device) & housekeeping
+                local_cpus[device] = [
+                    cpu
+                    for cpu in range(local.bit_length())
+                    if local >> cpu & 1
+                ]
+            if local_cpus[device]:
+                cpu = min(local_cpus[device], key=lambda i: load.get(i, 0))
+                load[cpu] = load.get(cpu, 0) + 1
+                new = 1 << cpu
+        if new != c.old:
+            changes.append(c._replace(new=new))
+    return changes
+
+
+def applied(c: Change) -> bool:
+    """
+    Check the kernel applied a change: the mask must read back as written,
+    and the IRQ's effective affinity (if the kernel reports it), which is
+    typically a single CPU of the mask, must be within the mask.
+
+    """
+    if read_cpumask(c.fname) != c.new:
+        return False
+    if c.irq == "default":
+        return True
+    effective = os.path.join(os.path.dirname(c.fname), "effective_affinity")
+    if not os.path.exists(effective):
+        return True
+    return not read_cpumask(effective) & ~c.new
+
+
+def apply(changes: List[Change]) -> List[Change]:
+    """
+    Apply changes, returning those to IRQs which failed, either because the
+    mask couldn't be written or because the kernel didn't apply it.
+
+    """
+    failed = []
+    for c in changes:
+        # The kernel rejects an empty mask, so don't try to write one.  The
+        # default isn't an IRQ, so can't fail to be moved.
+        if c.new == 0:
+            if c.irq != "default":
+                failed.append(c)
+            continue
+        try:
+            write_cpumask(c.fname, c.new)
+        except OSError:
+            if c.irq == "default":
+                raise
+            failed.append(c)
+            continue
+        if not applied(c):
+            failed.append(c)
+    return failed
+
+
+def report(action: str, cpulist: str, changes: List[Change]) -> dict:
+    """Return a JSON-serializable report of the changes."""
+    return {
+        "action": action,
+        "cpulist": cpulist,
+        "changes": {
+            c.irq: {"old": format_cpumask(c.old), "new": format_cpumask(c.new)}
+            for c in changes
+        },
+        "unmovable": [
+            c.irq for c in changes if c.new == 0 and c.irq != "default"
+        ],
+    }
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Add or remove CPUs from the default and per-IRQ SMP "
+        "affinity, or verify that no IRQ has affinity with the given CPUs.  "
+        "'place' removes the CPUs and pins each device IRQ to a remaining CPU "
+        "on the device's NUMA node.",
+    )
+    parser.add_argument("action", choices=("add", "remove", "place", "verify"))
+    parser.add_argument("cpulist", help="CPU list, e.g. '1,2,5-7'")
+    parser.add_argument(
+        "irqpath",
+        nargs="?",
+        help="Path to use in place of %s" % IRQPATH,
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Print a JSON report of the changes instead of making them",
+    )
+    parser.add_argument(
+        "--sysfs",
+        default=SYSFS,
+        help="Path to use in place of %s, for 'place'" % SYSFS,
+    )
+    args = parser.parse_args(argv)
+    if not args.cpulist.strip():
+        parser.error("cpulist must not be empty")
+    if args.dry_run and args.action == "verify":
+        parser.error("--dry-run is not valid with verify")
+    return args
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    prog = os.path.basename(sys.argv[0])
+
+    path = args.irqpath or IRQPATH
+    if args.irqpath is None and not args.dry_run and os.getuid() != 0:
+        sys.stderr.write("%s: must be run as root\n" % prog)
+        return 1
+
+    cpumask = parse_cpulist(args.cpulist)
+
+    if args.action == "verify":
+        return verify(path, cpumask)
+
+    if args.action == "place":
+        changes = plan_placement(path, args.sysfs, cpumask)
+    else:
+        changes = plan(path, args.action, cpumask)
+
+    if args.dry_run:
+        json.dump(
+            report(args.action, args.cpulist, changes), sys.stdout, indent=2
+        )
+        sys.stdout.write("\n")
+        return 0
+
+    failed = apply(changes)
+    for c in failed:
+        sys.stderr.write(
+            "Failed to set affinity for irq %s, continuing...\n" % c.irq
+        )
+    if failed:
+        sys.stderr.write(
+            "%s: %d IRQ(s) could not be moved: %s\n"
+            % (prog, len(failed), ",".join(c.irq for c in failed))
+        )
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
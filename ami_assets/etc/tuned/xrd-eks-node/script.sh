@@ -0,0 +1,32 @@
+#!/bin/sh
+#
+# Place IRQs raised by PCI devices on the housekeeping (non-isolated) cores
+# local to each device's NUMA node.
+#
+# This runs after the scripts of the included profiles, which have already
+# removed the isolated cores from every IRQ's affinity.
+
+. /usr/lib/tuned/functions
+
+# Read the isolated cores from the tuned settings, which are in tuned's syntax
+# rather than the shell's, so can't be sourced.
+isolated_cores=$(sed -n 's/^isolated_cores=//p' /etc/tuned/xrd-eks-node-variables.conf | tr -d '[:space:]')
+
+start() {
+    if [ -n "${isolated_cores}" ]; then
+        /usr/libexec/tuned/defirqaffinity.py place "${isolated_cores}"
+    fi
+    return 0
+}
+
+stop() {
+    return 0
+}
+
+verify() {
+    if [ -n "${isolated_cores}" ]; then
+        /usr/libexec/tuned/defirqaffinity.py verify "${isolated_cores}"
+    fi
+}
+
+process "$@"
@@ -6,9 +6,12 @@ set -o errexit
 
 HUGEPAGES_GB=${HUGEPAGES_GB:-"3"}
 ISOLATED_CORES=${ISOLATED_CORES:-"1-3"}
+# Strip any whitespace, e.g. from "1, 4-5", which isn't valid in the kernel
+# command line (isolcpus) or the tuned settings.
+ISOLATED_CORES=$(echo "${ISOLATED_CORES}" | tr -d '[:space:]')
 
 # Copy the ISOLATED_CPUS into the tuned settings.
-sudo sed "s/isolated_cores=/isolated_cores=${ISOLATED_CORES}/" -i /etc/tuned/xrd-eks-node-variables.conf
+sudo sed "s/isolated_cores=.*/isolated_cores=${ISOLATED_CORES}/" -i /etc/tuned/xrd-eks-node-variables.conf
 
 # Copy HUGEPAGES_GB into the tuned settings and hugetlb service env.
 # Get the number of NUMA nodes.
@@ -17,11 +20,22 @@ numa_node_count=$(lscpu | grep -F "NUMA node(s)" | awk '{ print $3 }')
 # Multiply the requested hugepages by the number of NUMA nodes at boot
 # so we're guaranteed a contiguous block of pages on each node.
 # Then during early boot the systemd service will unreserve all the
-# hugepages from all nodes except the first.
+# hugepages from all nodes except those local to XRd's PCI devices.
 boot_hugepages=$((HUGEPAGES_GB * numa_node_count))
 
 sudo sed "s/hugepages_gb=.*/hugepages_gb=${boot_hugepages}/" -i /etc/tuned/xrd-eks-node-variables.conf
 echo "HUGEPAGES_GB=${HUGEPAGES_GB}" | sudo tee /etc/xrd/hugetlb-reserve-env.conf
+# If the full number of pages can't be reserved on a node, fall back to
+# HUGEPAGES_MIN_GB pages, if given.
+if [ -n "${HUGEPAGES_MIN_GB:-}" ]; then
+    echo "HUGEPAGES_MIN_GB=${HUGEPAGES_MIN_GB}" | sudo tee -a /etc/xrd/hugetlb-reserve-env.conf
+fi
+# Reserve the pages on the NUMA node(s) local to these PCI devices, if given
+# (otherwise the node(s) local to all network devices).
+if [ -n "${XRD_PCI_DEVICES:-}" ]; then
+    echo "XRD_PCI_DEVICES=\"${XRD_PCI_DEVICES}\"" | sudo tee -a /etc/xrd/hugetlb-reserve-env.conf
+fi
+sudo chmod +x /etc/xrd/hugetlb-reserve-pages.py
 
 # Start tuned.
 sudo systemctl start tuned
@@ -35,8 +49,15 @@ sleep 10
 # specified. This is fixed in later versions of tuned but those are not
 # easily available on Amazon Linux 2 (and have lots of dependencies that also
 # aren't easily available).
+# The replacement script is Python 3; to see what it would change before
+# applying the profile run:
+#   /usr/libexec/tuned/defirqaffinity.py --dry-run remove "${ISOLATED_CORES}"
 sudo cp /etc/tuned/xrd-eks-node/defirqaffinity.py /usr/libexec/tuned/defirqaffinity.py
 
+# The profile's script places device IRQs on the housekeeping cores local to
+# the device's NUMA node; it's downloaded without the executable bit.
+sudo chmod +x /etc/tuned/xrd-eks-node/script.sh
+
 # Set the tuned profile.
 sudo tuned-adm profile xrd-eks-node
 
@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+#
+# Reserve 1GiB hugepages on the NUMA node(s) local to XRd's PCI devices.
+#
+# At boot the kernel reserves HUGEPAGES_GB pages for every NUMA node (spread
+# across the nodes), so that there is guaranteed to be a contiguous block of
+# pages on each node.  This script then keeps HUGEPAGES_GB pages on each node
+# local to the PCI devices handed to XRd vRouter, and releases the pages on
+# all other nodes, so XRd's packet buffers are on the same node as its NICs.
+#
+# The devices are given by the 'XRD_PCI_DEVICES' env var (or --pci-device),
+# as a space or comma separated list of PCI addresses, e.g. '0000:00:06.0'.
+# If no devices are given, all network devices are used.  If none of the
+# devices has NUMA affinity, the pages are reserved on the first online node.
+#
+# This script requires the 'HUGEPAGES_GB' env var (or --hugepages-gb) to be
+# set to the number of 1GiB hugepages required on each node.
+#
+# The kernel may grant fewer pages than requested, so the pages on each node
+# are read back after the reservation.  If a node is short, its memory is
+# compacted and the reservation retried.  If the 'HUGEPAGES_MIN_GB' env var
+# (or --min-hugepages-gb) is set, a node still short of that minimum has just
+# the minimum reserved instead; a node granted at least the minimum keeps the
+# pages it was granted.
+#
+# The pages requested and actually granted on each node are reported on
+# stdout, and written as JSON to a status file (by default
+# /run/xrd/hugepages-status.json) so operators can see the hugepage capacity
+# the node really has.  The script fails if any node ends up with fewer pages
+# than the minimum (or requested) number.
+
+import argparse
+import json
+import os
+import sys
+from typing import Iterable, List, NamedTuple, Optional
+
+
+SYSFS = "/sys/"
+
+STATUS_FILE = "/run/xrd/hugepages-status.json"
+
+# Number of times to compact memory and retry a reservation which falls short.
+RETRIES = 3
+
+HUGEPAGES_DIR = "hugepages/hugepages-1048576kB"
+
+# PCI class code (base class) of network controllers.
+PCI_CLASS_NETWORK = 0x02
+
+
+class NodePages(NamedTuple):
+    """The 1GiB hugepages on a NUMA node."""
+
+    node: int
+    nr: int
+    free: int
+
+
+class NodeStatus(NamedTuple):
+    """The 1GiB hugepages requested and granted on a NUMA node."""
+
+    node: int
+    requested: int
+    granted: int
+    free: int
+
+
+def parse_rangelist(line: str) -> List[int]:
+    """Convert a range list (e.g. "0-1,4") into a sorted list of ints."""
+    values = set()
+    for field in line.strip().split(","):
+        if not field:
+            continue
+        if "-" in field:
+            first, last = (int(x) for x in field.split("-", 1))
+            values.update(range(first, last + 1))
+        else:
+            values.add(int(field))
+    return sorted(values)
+
+
+def nodes_path(sysfs: str) -> str:
+    return os.path.join(sysfs, "devices", "system", "node")
+
+
+def hugepages_path(sysfs: str, node: int) -> str:
+    return os.path.join(nodes_path(sysfs), "node%d" % node, HUGEPAGES_DIR)
+
+
+def read_int(fname: str) -> int:
+    with open(fname) as f:
+        return int(f.readline())
+
+
+def online_nodes(sysfs: str) -> List[int]:
+    with open(os.path.join(nodes_path(sysfs), "online")) as f:
+        return parse_rangelist(f.readline())
+
+
+def node_pages(sysfs: str, node: int) -> NodePages:
+    path = hugepages_path(sysfs, node)
+    return NodePages(
+        node,
+        read_int(os.path.join(path, "nr_hugepages")),
+        read_int(os.path.join(path, "free_hugepages")),
+    )
+
+
+def reserve_pages(sysfs: str, node: int, count: int) -> None:
+    with open(
+        os.path.join(hugepages_path(sysfs, node), "nr_hugepages"), "w"
+    ) as f:
+        f.write("%d\n" % count)
+
+
+def compact(sysfs: str, node: int) -> None:
+    """Compact a node's memory, to make room for gigantic pages."""
+    try:
+        with open(
+            os.path.join(nodes_path(sysfs), "node%d" % node, "compact"), "w"
+        ) as f:
+            f.write("1\n")
+    except OSError:
+        pass
+
+
+def reserve_node(sysfs: str, node: int, count: int, retries: int) -> NodePages:
+    """
+    Reserve ``count`` pages on a node, compacting and retrying up to
+    ``retries`` times if fewer pages are granted.
+
+    :returns:
+        The pages on the node after the reservation.
+
+    """
+    for attempt in range(retries + 1):
+        if attempt:
+            print("node%d: compacting memory and retrying" % node)
+            compact(sysfs, node)
+        reserve_pages(sysfs, node, count)
+        pages = node_pages(sysfs, node)
+        if pages.nr >= count:
+            break
+    return pages
+
+
+def network_devices(sysfs: str) -> List[str]:
+    """Return the PCI addresses of all network devices."""
+    devices = os.path.join(sysfs, "bus", "pci", "devices")
+    try:
+        names = sorted(os.listdir(devices))
+    except OSError:
+        return []
+
+    addresses = []
+    for address in names:
+        try:
+            with open(os.path.join(devices, address, "class")) as f:
+                pci_class = int(f.readline(), 16)
+        except (OSError, ValueError):
+            continue
+        if pci_class >> 16 == PCI_CLASS_NETWORK:
+            addresses.append(address)
+    return addresses
+
+
+def device_node(sysfs: str, address: str) -> Optional[int]:
+    """Return the NUMA node of a PCI device, or None if it has none."""
+    try:
+        node = read_int(
+            os.path.join(sysfs, "bus", "pci", "devices", address, "numa_node")
+        )
+    except (OSError, ValueError):
+        return None
+    return node if node >= 0 else None
+
+
+def local_nodes(
+    sysfs: str, addresses: Iterable[str], online: List[int]
+) -> List[int]:
+    """
+    Return the online nodes local to the given PCI devices, or the first
+    online node if none of the devices has NUMA affinity.
+
+    """
+    nodes = {device_node(sysfs, address) for address in addresses}
+    nodes = sorted(n for n in nodes if n is not None and n in online)
+    return nodes or online[:1]
+
+
+def reserve(
+    sysfs: str,
+    hugepages_gb: int,
+    addresses: Iterable[str],
+    *,
+    min_hugepages_gb: Optional[int] = None,
+    retries: int = RETRIES,
+) -> List[NodeStatus]:
+    """
+    Reserve ``hugepages_gb`` pages on each node local to the given devices,
+    and none on other nodes.
+
+    If fewer than ``min_hugepages_gb`` pages (if given) are granted on a
+    node, fall back to reserving just the minimum there, which may succeed
+    after compaction where the full number didn't.  Otherwise any pages
+    granted above the minimum are kept.
+
+    :returns:
+        The pages requested and granted on each online node.
+
+    """
+    online = online_nodes(sysfs)
+    targets = local_nodes(sysfs, addresses, online)
+
+    # Release pages on the other nodes first.
+    for node in online:
+        if node not in targets:
+            reserve_pages(sysfs, node, 0)
+
+    statuses = []
+    for node in online:
+        if node not in targets:
+            pages = node_pages(sysfs, node)
+            statuses.append(NodeStatus(node, 0, pages.nr, pages.free))
+            continue
+        pages = reserve_node(sysfs, node, hugepages_gb, retries)
+        if min_hugepages_gb is not None and pages.nr < min_hugepages_gb:
+            print(
+                "node%d: only %d of %d 1GiB hugepages granted, falling back "
+                "to %d" % (node, pages.nr, hugepages_gb, min_hugepages_gb)
+            )
+            pages = reserve_node(sysfs, node, min_hugepages_gb, retries)
+        statuses.append(NodeStatus(node, hugepages_gb, pages.nr, pages.free))
+
+    return statuses
+
+
+def overall_status(
+    statuses: Iterable[NodeStatus], min_hugepages_gb: Optional[int] = None
+) -> str:
+    """
+    Return "ok" if all nodes were granted the pages requested, "degraded" if
+    all nodes were granted at least the minimum, and "failed" otherwise.
+
+    """
+    status = "ok"
+    for s in statuses:
+        if s.granted >= s.requested:
+            continue
+        if min_hugepages_gb is not None and s.granted >= min_hugepages_gb:
+            status = "degraded"
+        else:
+            return "failed"
+    return status
+
+
+def write_status(
+    fname: str,
+    statuses: List[NodeStatus],
+    min_hugepages_gb: Optional[int] = None,
+) -> None:
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    with open(fname, "w") as f:
+        json.dump(
+            {
+                "status": overall_status(statuses, min_hugepages_gb),
+                "pageSize": "1Gi",
+                "minimum": min_hugepages_gb,
+                "requested": sum(s.requested for s in statuses),
+                "granted": sum(s.granted for s in statuses),
+                "nodes": {str(s.node): s._asdict() for s in statuses},
+            },
+            f,
+            indent=2,
+        )
+        f.write("\n")
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Reserve 1GiB hugepages on the NUMA node(s) local to "
+        "XRd's PCI devices.",
+    )
+    parser.add_argument(
+        "--hugepages-gb",
+        type=int,
+        default=os.environ.get("HUGEPAGES_GB"),
+        help="Number of 1GiB hugepages to reserve on each node (default: "
+        "$HUGEPAGES_GB)",
+    )
+    parser.add_argument(
+        "--min-hugepages-gb",
+        type=int,
+        default=os.environ.get("HUGEPAGES_MIN_GB"),
+        help="Number of 1GiB hugepages to fall back to on a node if the full "
+        "number can't be reserved (default: $HUGEPAGES_MIN_GB, or no "
+        "fallback)",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=RETRIES,
+        help="Number of times to compact memory and retry a reservation "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--status-file",
+        default=STATUS_FILE,
+        help="File to write the JSON status to (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--pci-device",
+        dest="pci_devices",
+        action="append",
+        help="PCI address of a device used by XRd (default: $XRD_PCI_DEVICES "
+        "or all network devices)",
+    )
+    parser.add_argument(
+        "--sysfs",
+        default=SYSFS,
+        help="Path to use in place of %s" % SYSFS,
+    )
+    args = parser.parse_args(argv)
+    if args.hugepages_gb is None:
+        parser.error("HUGEPAGES_GB or --hugepages-gb must be set")
+    if args.pci_devices is None:
+        args.pci_devices = (
+            os.environ.get("XRD_PCI_DEVICES", "").replace(",", " ").split()
+        )
+    return args
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+
+    if not os.path.isdir(nodes_path(args.sysfs)):
+        print("ERROR: %s does not exist" % nodes_path(args.sysfs))
+        return 1
+
+    addresses = args.pci_devices or network_devices(args.sysfs)
+    print(
+        "Reserving %d 1GiB hugepages on the node(s) local to: %s"
+        % (args.hugepages_gb, " ".join(addresses) or "(no devices)")
+    )
+
+    statuses = reserve(
+        args.sysfs,
+        args.hugepages_gb,
+        addresses,
+        min_hugepages_gb=args.min_hugepages_gb,
+        retries=args.retries,
+    )
+    for s in statuses:
+        print(
+            "node%d: %d of %d 1GiB hugepages granted (%d free)"
+            % (s.node, s.granted, s.requested, s.free)
+        )
+
+    write_status(args.status_file, statuses, args.min_hugepages_gb)
+
+    status = overall_status(statuses, args.min_hugepages_gb)
+    print("Hugepage reservation status: %s" % status)
+    return 1 if status == "failed" else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -11,6 +11,7 @@ AMI_ASSETS_URL=${AMI_ASSETS_URL:-"https://${XRD_S3_BUCKET_NAME}.s3.${XRD_S3_BUCK
 
 # Additional Packages required for XRd vRouter to run
 REQUIRED_PACKAGES="""
+python3
 tuned
 tuned-profiles-realtime
 tuned-profiles-nfv-guest
@@ -24,7 +25,7 @@ kernel-devel-$(uname -r)
 # The ami_assets to retrieve from the S3 bucket
 AMI_ASSETS="""
 /etc/xrd/bootstrap.sh
-/etc/xrd/hugetlb-reserve-pages.sh
+/etc/xrd/hugetlb-reserve-pages.py
 /etc/modprobe.d/vfio.conf
 /etc/modprobe.d/igb_uio.conf
 /etc/modules-load.d/vfio-pci.conf
@@ -33,6 +34,7 @@ AMI_ASSETS="""
 /etc/systemd/coredump.conf
 /etc/tuned/xrd-eks-node-variables.conf
 /etc/tuned/xrd-eks-node/defirqaffinity.py
+/etc/tuned/xrd-eks-node/script.sh
 /etc/tuned/xrd-eks-node/tuned.conf
 /usr/lib/systemd/system/hugetlb-gigantic-pages.service
 """
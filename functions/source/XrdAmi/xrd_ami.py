@@ -0,0 +1,287 @@
+# xrd_ami.py - AMI custom resource
+
+"""
+Custom resource which creates an AMI from a stopped EC2 instance, and
+deregisters it (and deletes its snapshots) on deletion.
+
+Creating an AMI takes longer than a Lambda can run, so the function only
+starts the work, and a Step Functions state machine then invokes it to poll
+the image until it is available, when the response is sent to CloudFormation.
+The state machine's input and output is the poll state, a dict with keys:
+
+- ``Event``: the custom resource request;
+- ``PhysicalResourceId``: the image ID, once the image is created;
+- ``Deadline``: time (in seconds since the epoch) by which the image must be
+  available;
+- ``Wait``: seconds to wait before the next poll;
+- ``Done``: whether the response has been sent.
+
+The state machine adds an ``Error`` key if a poll fails, in which case the
+function sends a failure response.
+
+The poll interval is estimated from the progress of the image's snapshots,
+since the image is available as soon as they are complete, so the image is
+usually found available by the first poll after it is.
+
+"""
+
+__all__ = (
+    "delete_image",
+    "handler",
+    "next_wait",
+    "poll",
+)
+
+import concurrent.futures
+import datetime
+import json
+import logging
+import time
+from typing import Any, Dict, List, Optional
+
+import boto3
+import cfn_response
+from botocore.config import Config
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+CONFIG = Config(retries={"max_attempts": 10, "mode": "standard"})
+
+# Time allowed for the image to be available, in seconds; CloudFormation
+# times out custom resources after an hour.
+TIMEOUT = 55 * 60
+
+# Bounds on the interval between polls, in seconds.
+MIN_WAIT = 5
+MAX_WAIT = 60
+
+# Interval between polls when there is no snapshot progress to estimate from.
+DEFAULT_WAIT = 15
+
+State = Dict[str, Any]
+
+_ec2 = None
+
+
+def _get_ec2() -> Any:
+    """Return an EC2 client, kept across warm invocations."""
+    global _ec2
+    if _ec2 is None:
+        _ec2 = boto3.client("ec2", config=CONFIG)
+    return _ec2
+
+
+def _snapshot_ids(image: Dict[str, Any]) -> List[str]:
+    return [
+        bdm["Ebs"]["SnapshotId"]
+        for bdm in image.get("BlockDeviceMappings", [])
+        if "SnapshotId" in bdm.get("Ebs", {})
+    ]
+
+
+def delete_image(ec2: Any, image_id: str) -> None:
+    """
+    Deregister an image, and delete its snapshots in parallel.
+
+    A snapshot can't be deleted while it is used by a registered image, so the
+    image is deregistered first.
+
+    """
+    images = ec2.describe_images(ImageIds=[image_id])["Images"]
+    for image in images:
+        ec2.deregister_image(ImageId=image["ImageId"])
+        snapshots = _snapshot_ids(image)
+        if not snapshots:
+            continue
+        with concurrent.futures.ThreadPoolExecutor(len(snapshots)) as pool:
+            for future in [
+                pool.submit(ec2.delete_snapshot, SnapshotId=snapshot)
+                for snapshot in snapshots
+            ]:
+                future.result()
+        logger.info("Deleted %s and snapshots %s", image_id, snapshots)
+
+
+def next_wait(snapshots: List[Dict[str, Any]], now: datetime.datetime) -> int:
+    """
+    Estimate the time until the next poll, from the progress of the image's
+    snapshots.
+
+    :param snapshots:
+        Descriptions of the image's snapshots.
+
+    :param now:
+        The current (timezone-aware) time.
+
+    :returns:
+        The estimated time until all the snapshots are complete, in seconds,
+        within `MIN_WAIT` and `MAX_WAIT`.
+
+    """
+    remaining = []
+    for snapshot in snapshots:
+        progress = float(snapshot.get("Progress", "").rstrip("%") or 0)
+        if snapshot["State"] == "completed" or progress >= 100:
+            remaining.append(0.0)
+        elif progress > 0:
+            elapsed = (now - snapshot["StartTime"]).total_seconds()
+            remaining.append(elapsed * (100 - progress) / progress)
+    if not remaining:
+        return DEFAULT_WAIT
+    return int(min(MAX_WAIT, max(MIN_WAIT, max(remaining))))
+
+
+def _create_image(ec2: Any, instance_id: str, name: str) -> Optional[str]:
+    """
+    Create an image from an instance, once it has stopped.
+
+    :returns:
+        The image ID, or None if the instance hasn't stopped yet.
+
+    """
+    instance = ec2.describe_instances(InstanceIds=[instance_id])[
+        "Reservations"
+    ][0]["Instances"][0]
+    if instance["State"]["Name"] != "stopped":
+        logger.info(
+            "Waiting for %s to stop: %s",
+            instance_id,
+            instance["State"]["Name"],
+        )
+        return None
+    # A retried poll may already have created the image.
+    images = ec2.describe_images(
+        Owners=["self"], Filters=[{"Name": "name", "Values": [name]}]
+    )["Images"]
+    if images:
+        return images[0]["ImageId"]
+    return ec2.create_image(InstanceId=instance_id, Name=name)["ImageId"]
+
+
+def poll(state: State, context: Any) -> State:
+    """
+    Poll the image once, creating it if the instance has stopped, and send
+    the response if it is available (or the poll failed).
+
+    :returns:
+        The new poll state.
+
+    """
+    event = state["Event"]
+    physical_id = state.get("PhysicalResourceId")
+
+    if "Error" in state:
+        error = state["Error"]
+        try:
+            reason = json.loads(error["Cause"])["errorMessage"]
+        except (KeyError, TypeError, ValueError):
+            reason = error.get("Cause") or error.get("Error")
+        logger.error("Failed: %s", reason)
+        cfn_response.send(
+            event,
+            context,
+            cfn_response.FAILED,
+            {},
+            physical_id,
+            reason=f"Exception: {reason}",
+        )
+        return {**state, "Done": True}
+
+    if time.time() > state["Deadline"]:
+        raise RuntimeError(f"Timed out waiting for image {physical_id}")
+
+    ec2 = _get_ec2()
+    props = event["ResourceProperties"]
+    if physical_id is None or not physical_id.startswith("ami-"):
+        image_id = _create_image(ec2, props["InstanceId"], props["ImageName"])
+        if image_id is None:
+            return {**state, "Wait": DEFAULT_WAIT}
+        logger.info("Creating image %s", image_id)
+        return {**state, "PhysicalResourceId": image_id, "Wait": MIN_WAIT}
+
+    image = ec2.describe_images(ImageIds=[physical_id])["Images"][0]
+    if image["State"] == "available":
+        logger.info("Image %s available", physical_id)
+        cfn_response.send(
+            event, context, cfn_response.SUCCESS, {"Data": "OK"}, physical_id
+        )
+        return {**state, "Done": True}
+    if image["State"] != "pending":
+        raise RuntimeError(
+            f"Image {physical_id} {image['State']}: "
+            f"{image.get('StateReason', {}).get('Message')}"
+        )
+
+    snapshot_ids = _snapshot_ids(image)
+    snapshots = (
+        ec2.describe_snapshots(SnapshotIds=snapshot_ids)["Snapshots"]
+        if snapshot_ids
+        else []
+    )
+    wait = next_wait(snapshots, datetime.datetime.now(datetime.timezone.utc))
+    logger.info(
+        "Image %s pending, snapshots %s; polling in %ss",
+        physical_id,
+        {s["SnapshotId"]: s.get("Progress") for s in snapshots},
+        wait,
+    )
+    return {**state, "Wait": wait}
+
+
+def handler(event: Dict[str, Any], context: Any) -> Optional[State]:
+    """
+    Handle a custom resource request, or a poll from the state machine.
+
+    Create and update requests start the state machine, which sends the
+    response; delete requests are handled immediately.
+
+    """
+    if "RequestType" not in event:
+        return poll(event, context)
+
+    logger.info(json.dumps(event))
+    physical_id = event.get("PhysicalResourceId")
+    try:
+        if event["RequestType"] == "Delete":
+            # The resource may have failed before creating the image.
+            if physical_id and physical_id.startswith("ami-"):
+                delete_image(_get_ec2(), physical_id)
+            cfn_response.send(
+                event,
+                context,
+                cfn_response.SUCCESS,
+                {"Data": "OK"},
+                physical_id,
+            )
+            return None
+
+        # An update waits for the existing image, as the instance it was
+        # created from is unchanged.
+        state = {
+            "Event": event,
+            "PhysicalResourceId": physical_id or context.log_stream_name,
+            "Deadline": time.time() + TIMEOUT,
+            "Wait": 0,
+            "Done": False,
+        }
+        sfn = boto3.client("stepfunctions", config=CONFIG)
+        # The request ID makes the execution unique, so a request which is
+        # delivered twice doesn't start a second poller.
+        sfn.start_execution(
+            stateMachineArn=event["ResourceProperties"]["StateMachineArn"],
+            name=event["RequestId"],
+            input=json.dumps(state),
+        )
+    except Exception as e:
+        logger.exception("Failed")
+        cfn_response.send(
+            event,
+            context,
+            cfn_response.FAILED,
+            {},
+            physical_id,
+            reason=f"Exception: {e}",
+        )
+    return None
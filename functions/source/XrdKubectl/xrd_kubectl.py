@@ -0,0 +1,338 @@
+# xrd_kubectl.py - Kubectl custom resource
+
+"""
+Custom resource which runs a list of ``kubectl``-style commands against an EKS
+cluster, in order, when it is created or updated.
+
+The commands are run with the Python Kubernetes client rather than the
+``kubectl`` and AWS CLIs, so nothing is forked.  Only these are supported:
+
+- ``apply -f <url>``: server-side apply of the objects in a manifest;
+- ``set env <kind>/<name> [-n <namespace>] <name>=<value>...``: set
+  environment variables in all the containers of a workload.
+
+The cluster's kubeconfig is written to ``/tmp``, keyed by its endpoint, and
+reused by warm invocations until its token is due to expire.
+
+"""
+
+__all__ = (
+    "SetEnv",
+    "apply",
+    "handler",
+    "kubeconfig",
+    "parse_set_env",
+    "run_command",
+    "set_env",
+)
+
+import base64
+import hashlib
+import logging
+import os
+import shlex
+import time
+import urllib.request
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import boto3
+import cfn_response
+import kubernetes
+import yaml
+from botocore.config import Config
+from botocore.signers import RequestSigner
+from kubernetes.dynamic import DynamicClient
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+CONFIG = Config(retries={"max_attempts": 10, "mode": "standard"})
+
+KUBECONFIG_DIR = "/tmp/kubeconfig"
+
+# How long a kubeconfig's token is used for, in seconds; EKS accepts tokens
+# for 15 minutes.
+TOKEN_TTL = 10 * 60
+
+FIELD_MANAGER = "xrd-kubectl"
+
+STRATEGIC_MERGE_PATCH = "application/strategic-merge-patch+json"
+
+# Workload kinds which ``set env`` supports, by their kubectl short names.
+WORKLOAD_KINDS = {
+    "daemonset": "daemon_set",
+    "deployment": "deployment",
+    "statefulset": "stateful_set",
+}
+KIND_ALIASES = {
+    "daemonsets": "daemonset",
+    "ds": "daemonset",
+    "deploy": "deployment",
+    "deployments": "deployment",
+    "statefulsets": "statefulset",
+    "sts": "statefulset",
+}
+
+# Cluster endpoints and CA data, by cluster name, and API clients, by
+# kubeconfig; kept across warm invocations.
+_clusters: Dict[str, Tuple[str, str]] = {}
+_api_clients: Dict[str, Tuple[float, kubernetes.client.ApiClient]] = {}
+
+
+def _token(cluster_name: str) -> str:
+    """Return a token to authenticate to an EKS cluster as the Lambda's role,
+    as ``aws eks get-token`` does."""
+    session = boto3.session.Session()
+    region = session.region_name
+    sts = session.client("sts", region_name=region)
+    signer = RequestSigner(
+        sts.meta.service_model.service_id,
+        region,
+        "sts",
+        "v4",
+        session.get_credentials(),
+        session.events,
+    )
+    url = signer.generate_presigned_url(
+        {
+            "method": "GET",
+            "url": f"https://sts.{region}.amazonaws.com/"
+            "?Action=GetCallerIdentity&Version=2011-06-15",
+            "body": {},
+            "headers": {"x-k8s-aws-id": cluster_name},
+            "context": {},
+        },
+        region_name=region,
+        expires_in=60,
+        operation_name="",
+    )
+    encoded = base64.urlsafe_b64encode(url.encode()).decode().rstrip("=")
+    return f"k8s-aws-v1.{encoded}"
+
+
+def kubeconfig(eks: Any, cluster_name: str) -> str:
+    """
+    Return the path of a kubeconfig for an EKS cluster, reusing the one in
+    ``/tmp`` for the cluster's endpoint if its token is still valid.
+
+    :param eks:
+        A boto3 EKS client.
+
+    """
+    if cluster_name not in _clusters:
+        cluster = eks.describe_cluster(name=cluster_name)["cluster"]
+        _clusters[cluster_name] = (
+            cluster["endpoint"],
+            cluster["certificateAuthority"]["data"],
+        )
+    endpoint, ca_data = _clusters[cluster_name]
+
+    digest = hashlib.sha256(endpoint.encode()).hexdigest()[:16]
+    path = os.path.join(KUBECONFIG_DIR, digest)
+    try:
+        if time.time() - os.path.getmtime(path) < TOKEN_TTL:
+            return path
+    except FileNotFoundError:
+        pass
+
+    config = {
+        "apiVersion": "v1",
+        "kind": "Config",
+        "clusters": [
+            {
+                "name": cluster_name,
+                "cluster": {
+                    "server": endpoint,
+                    "certificate-authority-data": ca_data,
+                },
+            }
+        ],
+        "users": [{"name": "lambda", "user": {"token": _token(cluster_name)}}],
+        "contexts": [
+            {
+                "name": cluster_name,
+                "context": {"cluster": cluster_name, "user": "lambda"},
+            }
+        ],
+        "current-context": cluster_name,
+    }
+    os.makedirs(KUBECONFIG_DIR, exist_ok=True)
+    tmp = f"{path}.{os.getpid()}"
+    with open(tmp, "w") as f:
+        yaml.safe_dump(config, f)
+    os.replace(tmp, path)
+    logger.info("Wrote kubeconfig for %s to %s", endpoint, path)
+    return path
+
+
+def _api_client(path: str) -> kubernetes.client.ApiClient:
+    """Return an API client for a kubeconfig, reused until it is rewritten."""
+    mtime = os.path.getmtime(path)
+    cached = _api_clients.get(path)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, kubernetes.config.new_client_from_config(path))
+        _api_clients[path] = cached
+    return cached[1]
+
+
+def apply(api_client: kubernetes.client.ApiClient, url: str) -> List[str]:
+    """
+    Server-side apply the objects in a manifest.
+
+    :returns:
+        The objects applied, as ``<kind>/<name>``.
+
+    """
+    with urllib.request.urlopen(url) as response:
+        docs = [d for d in yaml.safe_load_all(response.read()) if d]
+    client = DynamicClient(api_client)
+    applied = []
+    for doc in docs:
+        resource = client.resources.get(
+            api_version=doc["apiVersion"], kind=doc["kind"]
+        )
+        namespace = None
+        if resource.namespaced:
+            namespace = doc["metadata"].get("namespace", "default")
+        resource.server_side_apply(
+            body=doc,
+            namespace=namespace,
+            field_manager=FIELD_MANAGER,
+            force_conflicts=True,
+        )
+        applied.append(f"{doc['kind'].lower()}/{doc['metadata']['name']}")
+    return applied
+
+
+class SetEnv(NamedTuple):
+    """A parsed ``set env`` command."""
+
+    kind: str
+    name: str
+    namespace: str
+    env: Dict[str, str]
+
+
+def parse_set_env(args: List[str]) -> SetEnv:
+    """
+    Parse the arguments of a ``set env`` command.
+
+    :raises ValueError:
+        If the command isn't supported.
+
+    """
+    namespace = "default"
+    resource = []
+    env = {}
+    remaining = list(args)
+    while remaining:
+        arg = remaining.pop(0)
+        if arg in ("-n", "--namespace"):
+            namespace = remaining.pop(0)
+        elif arg.startswith("--namespace="):
+            namespace = arg.split("=", 1)[1]
+        elif arg.startswith("-"):
+            raise ValueError(f"Unsupported set env option: {arg}")
+        elif "=" in arg:
+            key, value = arg.split("=", 1)
+            env[key] = value
+        else:
+            resource.extend(arg.split("/", 1))
+    if len(resource) != 2 or not env:
+        raise ValueError(f"Unsupported set env command: {shlex.join(args)}")
+    kind = KIND_ALIASES.get(resource[0].lower(), resource[0].lower())
+    if kind not in WORKLOAD_KINDS:
+        raise ValueError(f"Unsupported set env kind: {resource[0]}")
+    return SetEnv(kind, resource[1], namespace, env)
+
+
+def set_env(api_client: kubernetes.client.ApiClient, cmd: SetEnv) -> str:
+    """
+    Set environment variables in all the containers of a workload.
+
+    :returns:
+        The workload, as ``<kind>/<name>``.
+
+    """
+    apps = kubernetes.client.AppsV1Api(api_client)
+    kind = WORKLOAD_KINDS[cmd.kind]
+    workload = getattr(apps, f"read_namespaced_{kind}")(
+        cmd.name, cmd.namespace
+    )
+    env = [{"name": k, "value": v} for k, v in cmd.env.items()]
+    # A strategic merge patch merges containers and their env by name.
+    patch = {
+        "spec": {
+            "template": {
+                "spec": {
+                    "containers": [
+                        {"name": c.name, "env": env}
+                        for c in workload.spec.template.spec.containers
+                    ]
+                }
+            }
+        }
+    }
+    # The client picks the content type of a patch from the first type the
+    # API accepts (which is JSON Patch in recent clients), not from the body,
+    # so set it explicitly.
+    getattr(apps, f"patch_namespaced_{kind}")(
+        cmd.name,
+        cmd.namespace,
+        patch,
+        field_manager=FIELD_MANAGER,
+        _content_type=STRATEGIC_MERGE_PATCH,
+    )
+    return f"{cmd.kind}/{cmd.name}"
+
+
+def run_command(api_client: kubernetes.client.ApiClient, command: str) -> str:
+    """
+    Run a command.
+
+    :returns:
+        The command's output, as kubectl would print it.
+
+    :raises ValueError:
+        If the command isn't supported.
+
+    """
+    logger.info("Running command: %s", command)
+    args = shlex.split(command)
+    if len(args) == 3 and args[:2] == ["apply", "-f"]:
+        return "\n".join(
+            f"{obj} serverside-applied" for obj in apply(api_client, args[2])
+        )
+    if args[:2] == ["set", "env"]:
+        return f"{set_env(api_client, parse_set_env(args[2:]))} env updated"
+    raise ValueError(f"Unsupported command: {command}")
+
+
+def handler(event: Dict[str, Any], context: Any) -> None:
+    logger.info(event)
+    status = cfn_response.SUCCESS
+    reason: Optional[str] = None
+    data = {}
+    try:
+        if event["RequestType"] in ("Create", "Update"):
+            props = event["ResourceProperties"]
+            commands = props.get("Commands") or [props["Command"]]
+            eks = boto3.client("eks", config=CONFIG)
+            api_client = _api_client(kubeconfig(eks, props["ClusterName"]))
+            outputs = [run_command(api_client, c) for c in commands]
+            logger.info("Output: %s", outputs)
+            data["Output"] = "\n".join(outputs)
+    except Exception as e:
+        logger.exception("Unhandled exception")
+        status = cfn_response.FAILED
+        reason = f"Exception: {e}"
+    finally:
+        cfn_response.send(
+            event,
+            context,
+            status,
+            data,
+            event.get("PhysicalResourceId", context.log_stream_name),
+            reason=reason,
+        )
@@ -0,0 +1,425 @@
+# xrd_qs_ami.py - XrdQsAmi custom resource
+
+"""
+Custom resource which ensures there is an XRd QuickStart AMI stack for a
+Kubernetes version, and returns its AMI ID.
+
+The AMI stack is shared by all the node stacks for the same Kubernetes version
+in a region.  It is named ``<Key>-AMI-<version>`` and tagged with
+``<Key>: AMI-<version>``, so it is found with one ``DescribeStacks`` call by
+name or, failing that (e.g. for a stack created under another name), via the
+Resource Groups tag index, rather than by listing every stack in the account.
+
+Stacks found are cached for a short time across warm invocations.
+
+Concurrent invocations (e.g. from several node stacks) don't race to create
+or update the stack: CloudFormation only lets one of them change it, since
+its name is unique, and the others wait for that operation and use its
+result.  The wait is bounded by the Lambda's remaining time, so a response is
+always sent.
+
+"""
+
+__all__ = (
+    "StackCache",
+    "StackConflict",
+    "find_stack",
+    "get_stack",
+    "handler",
+    "put_stack",
+    "stack_name",
+)
+
+import hashlib
+import json
+import logging
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import boto3
+import cfn_response
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+CONFIG = Config(retries={"max_attempts": 10, "mode": "standard"})
+
+# How long stacks found are cached for, in seconds.
+CACHE_TTL = 30
+
+# Interval between polls of a stack operation, in seconds.
+POLL_INTERVAL = 5
+
+# Time reserved to send the response before the Lambda times out, in seconds.
+RESPONSE_TIME = 15
+
+CAPABILITIES = [
+    "CAPABILITY_IAM",
+    "CAPABILITY_NAMED_IAM",
+    "CAPABILITY_AUTO_EXPAND",
+]
+
+COMPLETE_STATUSES = ("CREATE_COMPLETE", "UPDATE_COMPLETE")
+
+Stack = Dict[str, Any]
+
+
+def stack_name(key: str, name: str) -> str:
+    """Return the name of the AMI stack."""
+    return f"{key}-{name}"
+
+
+def _describe_stack(cfn: Any, stack: str) -> Optional[Stack]:
+    """Describe a stack by name or ID, or return None if it doesn't exist."""
+    try:
+        return cfn.describe_stacks(StackName=stack)["Stacks"][0]
+    except ClientError as e:
+        if "does not exist" in str(e):
+            return None
+        raise
+
+
+def find_stack(cfn: Any, tagging: Any, key: str, name: str) -> Optional[Stack]:
+    """
+    Find the AMI stack, by name or else by its tag.
+
+    :param cfn:
+        A boto3 CloudFormation client.
+
+    :param tagging:
+        A boto3 Resource Groups Tagging API client.
+
+    :returns:
+        The stack's description, or None if there is no (undeleted) stack.
+
+    """
+    stack = _describe_stack(cfn, stack_name(key, name))
+    if stack is not None:
+        return stack
+
+    for page in tagging.get_paginator("get_resources").paginate(
+        TagFilters=[{"Key": key, "Values": [name]}],
+        ResourceTypeFilters=["cloudformation:stack"],
+    ):
+        for resource in page["ResourceTagMappingList"]:
+            # Described by ID, which also returns deleted stacks.
+            stack = _describe_stack(cfn, resource["ResourceARN"])
+            if stack is not None and stack["StackStatus"] != "DELETE_COMPLETE":
+                return stack
+    return None
+
+
+class StackCache:
+    """
+    Stacks in a complete state, cached for a short time.
+
+    Stacks which are being changed, or don't exist, are never cached, since
+    another invocation may be changing or creating them.
+
+    """
+
+    def __init__(
+        self,
+        ttl: float = CACHE_TTL,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self._ttl = ttl
+        self._clock = clock
+        self._entries: Dict[Tuple[str, ...], Tuple[float, Stack]] = {}
+
+    def get(self, key: Tuple[str, ...]) -> Optional[Stack]:
+        entry = self._entries.get(key)
+        if entry is None or self._clock() > entry[0]:
+            self._entries.pop(key, None)
+            return None
+        return entry[1]
+
+    def put(self, key: Tuple[str, ...], stack: Optional[Stack]) -> None:
+        if stack is None or stack["StackStatus"] not in COMPLETE_STATUSES:
+            self._entries.pop(key, None)
+        else:
+            self._entries[key] = (self._clock() + self._ttl, stack)
+
+
+# Cache and clients, kept across warm invocations.
+_cache = StackCache()
+_clients: Dict[Optional[str], Tuple[Any, Any]] = {}
+
+
+def _get_clients(region: Optional[str]) -> Tuple[Any, Any]:
+    """Return CloudFormation and Resource Groups Tagging API clients."""
+    if region not in _clients:
+        _clients[region] = (
+            boto3.client("cloudformation", region_name=region, config=CONFIG),
+            boto3.client(
+                "resourcegroupstaggingapi", region_name=region, config=CONFIG
+            ),
+        )
+    return _clients[region]
+
+
+class StackConflict(Exception):
+    """Another invocation is changing (or has just created) the AMI stack."""
+
+
+def _is_conflict(e: ClientError) -> bool:
+    code = e.response["Error"]["Code"]
+    message = e.response["Error"]["Message"]
+    return code == "AlreadyExistsException" or (
+        code == "ValidationError" and "_IN_PROGRESS state" in message
+    )
+
+
+def waiter(
+    cfn: Any,
+    op: str,
+    stack_id: str,
+    deadline: float,
+    *,
+    check: bool = True,
+) -> Optional[Stack]:
+    """
+    Wait for a stack operation to finish.
+
+    :param deadline:
+        Time (per `time.monotonic`) by which the operation must finish.
+
+    :param check:
+        Whether to raise if the operation fails, e.g. for an operation
+        started by this invocation rather than another.
+
+    :returns:
+        The stack's description, or None if it was deleted.
+
+    :raises RuntimeError:
+        If ``check`` is set and the operation fails, or if the operation
+        doesn't finish by the deadline.
+
+    """
+    logger.info("waiter(%s, %s) started", op, stack_id)
+    while True:
+        stack = _describe_stack(cfn, stack_id)
+        status = stack["StackStatus"] if stack else "DELETE_COMPLETE"
+        if op == "delete" and status == "DELETE_COMPLETE":
+            stack = None
+            break
+        if status in COMPLETE_STATUSES:
+            break
+        if not check and not status.endswith("_IN_PROGRESS"):
+            stack = stack if status != "DELETE_COMPLETE" else None
+            break
+        if status.endswith("FAILED") or status in (
+            "DELETE_COMPLETE",
+            "UPDATE_ROLLBACK_COMPLETE",
+        ):
+            raise RuntimeError(
+                f"Stack operation failed: {op} {status} {stack_id}"
+            )
+        if time.monotonic() + POLL_INTERVAL > deadline:
+            raise RuntimeError(
+                f"Stack operation timed out: {op} {status} {stack_id}"
+            )
+        time.sleep(POLL_INTERVAL)
+    logger.info("waiter(%s, %s) done", op, stack_id)
+    return stack
+
+
+def get_stack(
+    key: str,
+    name: str,
+    region: Optional[str] = None,
+    *,
+    deadline: float,
+    cache: StackCache = _cache,
+) -> Optional[Stack]:
+    """
+    Get the AMI stack, waiting for any operation in progress to finish.
+
+    :returns:
+        The stack's description, or None if there is no stack.
+
+    """
+    cache_key = (region or "", key, name)
+    stack = cache.get(cache_key)
+    if stack is not None:
+        return stack
+
+    cfn, tagging = _get_clients(region)
+    stack = find_stack(cfn, tagging, key, name)
+    if stack is not None and stack["StackStatus"].endswith("_IN_PROGRESS"):
+        op = stack["StackStatus"].split("_")[0].lower()
+        stack = waiter(cfn, op, stack["StackId"], deadline, check=False)
+    cache.put(cache_key, stack)
+    return stack
+
+
+def _ami_id(stack: Optional[Stack]) -> Optional[str]:
+    for output in (stack or {}).get("Outputs", []):
+        if output["OutputKey"] == "AmiId":
+            return output["OutputValue"]
+    return None
+
+
+def _client_token(*args: Any) -> str:
+    """
+    Return a CloudFormation client request token for a stack operation.
+
+    Concurrent invocations making the same request use the same token, so
+    CloudFormation treats their requests as one.  The token also depends on
+    the hour, so a later request isn't taken for an earlier one.
+
+    """
+    digest = hashlib.sha256(
+        json.dumps([*args, int(time.time() // 3600)]).encode()
+    ).hexdigest()
+    return f"xrd-qs-ami-{digest[:32]}"
+
+
+def _put_stack_once(
+    cfn: Any,
+    stack: Optional[Stack],
+    name: str,
+    template_url: str,
+    parameters: Dict[str, str],
+    key: str,
+) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Request to create or update the AMI stack.
+
+    :raises StackConflict:
+        If another invocation is changing (or has just created) the stack.
+
+    :returns:
+        The operation ("create" or "update") and stack ID, or (None, None) if
+        the stack is up to date.
+
+    """
+    args = {
+        "StackName": stack["StackId"] if stack else stack_name(key, name),
+        "TemplateURL": template_url,
+        "Parameters": [
+            {"ParameterKey": k, "ParameterValue": v}
+            for k, v in parameters.items()
+        ],
+        "Capabilities": CAPABILITIES,
+        "Tags": [{"Key": key, "Value": name}],
+    }
+    try:
+        if stack:
+            return "update", cfn.update_stack(**args)["StackId"]
+        # The stack's name is unique, so only one creation can succeed; any
+        # other gets the same stack (if its request was the same) or fails
+        # with AlreadyExistsException.
+        return (
+            "create",
+            cfn.create_stack(
+                OnFailure="DELETE",
+                ClientRequestToken=_client_token(
+                    args["StackName"], template_url, parameters
+                ),
+                **args,
+            )["StackId"],
+        )
+    except ClientError as e:
+        if "No updates are to be performed" in str(e):
+            return None, None
+        if _is_conflict(e):
+            raise StackConflict(str(e)) from e
+        raise
+
+
+def put_stack(
+    name: str,
+    region: Optional[str],
+    template_url: str,
+    parameters: Dict[str, str],
+    key: str,
+    *,
+    deadline: float,
+    cache: StackCache = _cache,
+) -> Optional[str]:
+    """
+    Create or update the AMI stack.
+
+    If another invocation is already changing the stack, this waits for that
+    operation to finish and then tries again, so concurrent invocations
+    share one stack operation rather than racing.
+
+    :param deadline:
+        Time (per `time.monotonic`) by which the stack must be up to date.
+
+    :returns:
+        The AMI ID output by the stack.
+
+    """
+    logger.info(
+        "put_stack(%s, %s, %s, %s, %s)",
+        name,
+        region,
+        template_url,
+        parameters,
+        key,
+    )
+    cache_key = (region or "", key, name)
+    cfn, _ = _get_clients(region)
+    while True:
+        stack = get_stack(key, name, region, deadline=deadline, cache=cache)
+        try:
+            op, stack_id = _put_stack_once(
+                cfn, stack, name, template_url, parameters, key
+            )
+        except StackConflict as e:
+            logger.info("Waiting for another stack operation: %s", e)
+            cache.put(cache_key, None)
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Timed out waiting for stack: {e}") from e
+            continue
+        if op is None:
+            return _ami_id(stack)
+
+        # The stack is being changed, so must be looked up again by any other
+        # invocation.
+        cache.put(cache_key, None)
+        stack = waiter(cfn, op, stack_id, deadline)
+        cache.put(cache_key, stack)
+        return _ami_id(stack)
+
+
+def handler(event: Dict[str, Any], context: Any) -> None:
+    logger.info(json.dumps(event))
+    # Leave time to send the response before the Lambda times out.
+    deadline = (
+        time.monotonic()
+        + context.get_remaining_time_in_millis() / 1000
+        - RESPONSE_TIME
+    )
+    status = cfn_response.SUCCESS
+    reason = " "
+    physical_id = event.get("PhysicalResourceId", context.log_stream_name)
+    props = event["ResourceProperties"]
+    key = props["Key"]
+    template_uri = props["TemplateUri"]
+    name = "AMI-{}".format(props["KubernetesVersion"].replace(".", "-"))
+    parameters = {
+        k: v
+        for k, v in props.items()
+        if k not in ("TemplateUri", "Key", "ServiceToken")
+    }
+    response = {}
+
+    try:
+        if event["RequestType"] != "Delete":
+            response["AmiId"] = put_stack(
+                name, None, template_uri, parameters, key, deadline=deadline
+            )
+    except Exception as e:
+        status = cfn_response.FAILED
+        reason = f"Exception: {e}"
+        logger.exception("Failed")
+    finally:
+        cfn_response.send(
+            event, context, status, response, physical_id, reason=reason
+        )
@@ -0,0 +1,70 @@
+# cfn_response.py - CloudFormation custom resource responses
+
+"""
+Sending of responses to CloudFormation custom resource requests.
+
+This provides the same interface as the ``cfnresponse`` module which Lambda
+provides for functions defined inline in a template, for functions packaged
+from this repository.
+
+"""
+
+__all__ = (
+    "FAILED",
+    "SUCCESS",
+    "send",
+)
+
+import json
+import logging
+import urllib.request
+from typing import Any, Dict, Optional
+
+
+logger = logging.getLogger(__name__)
+
+SUCCESS = "SUCCESS"
+FAILED = "FAILED"
+
+
+def send(
+    event: Dict[str, Any],
+    context: Any,
+    status: str,
+    data: Dict[str, Any],
+    physical_resource_id: Optional[str] = None,
+    *,
+    reason: Optional[str] = None,
+) -> None:
+    """
+    Send a response to a custom resource request.
+
+    :param physical_resource_id:
+        ID of the resource (default: the Lambda's log stream).
+
+    """
+    body = json.dumps(
+        {
+            "Status": status,
+            "Reason": reason
+            or f"See the details in CloudWatch Log Stream: "
+            f"{context.log_stream_name}",
+            "PhysicalResourceId": physical_resource_id
+            or context.log_stream_name,
+            "StackId": event["StackId"],
+            "RequestId": event["RequestId"],
+            "LogicalResourceId": event["LogicalResourceId"],
+            "Data": data,
+        }
+    ).encode()
+    request = urllib.request.Request(
+        event["ResponseURL"],
+        data=body,
+        method="PUT",
+        headers={"Content-Type": "", "Content-Length": str(len(body))},
+    )
+    try:
+        with urllib.request.urlopen(request) as response:
+            logger.info("Response sent: %s", response.status)
+    except Exception:
+        logger.exception("Failed to send response")
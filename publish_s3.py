@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+# publish_s3.py - Incremental publishing of the XRd S3 bucket
+
+"""
+Publish the resources from this repository to the XRd S3 bucket, uploading
+only what has changed since it was last published.
+
+The content of the bucket is described by a manifest, mapping each key to a
+hash of its content: the SHA-256 of a local file, or the source (including
+the pinned version) of a Lambda package copied from the QuickStart bucket.
+The manifest of the last publish is stored in the bucket, so publishing
+compares it with the manifest of this checkout and only uploads, copies or
+deletes the keys which differ, in parallel.
+
+If there is no manifest in the bucket (or ``--full`` is given), the keys under
+the published directories are listed instead, and everything is uploaded,
+so the bucket ends up as after ``aws s3 sync --delete``.
+
+This is run by ``publish-s3-bucket``, after it has created the bucket and
+packaged the Lambda functions.
+
+"""
+
+__all__ = (
+    "LAMBDAS",
+    "Changes",
+    "build_manifest",
+    "diff",
+    "publish",
+    "read_manifest",
+)
+
+import argparse
+import concurrent.futures
+import dataclasses
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import sys
+from pathlib import Path
+from typing import Any, Iterable, Mapping, Optional
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+
+logger = logging.getLogger(__name__)
+
+# Directories of this repository which are published to the bucket.
+DIRS = (
+    "cf-templates",
+    "ami_assets",
+    "functions/packages",
+    "submodules",
+)
+
+MANIFEST_KEY = ".publish-manifest.json"
+
+# The upstream QuickStart bucket, in us-east-1.  Lambdas _must_ be copied from
+# this bucket, regardless of the user's region, because the pinned versions
+# below are valid only for this bucket and not for QuickStart buckets in other
+# regions.
+QUICKSTART_BUCKET = "aws-quickstart-us-east-1"
+QUICKSTART_PREFIX = "quickstart-amazon-eks/functions/packages/"
+
+# Lambdas in the upstream QuickStart bucket that the XRd stack depends on,
+# with their pinned versions.
+LAMBDAS = {
+    "CleanupLambdas/lambda.zip": "xa.Oy15ZoH7.mIp_BuRwsL53sGNbT7WL",
+    "CleanupLoadBalancers/lambda.zip": "5CvkA46x0j2uGCcYVFeQwRhQlDnOonex",
+    "CleanupSecurityGroupDependencies/lambda.zip": (
+        "gBBk2SBA0PMtXpLCX3NfVcyx4iLYQffa"
+    ),
+    "DeleteBucketContents/lambda.zip": "TXgf9J8CzPlR9pIq2q8PAGichTjSVVQs",
+    "EksClusterResource/awsqs-eks-cluster.zip": (
+        "BH57pAffePQxbR3HVmok1FIeuQAEwPQB"
+    ),
+    "FargateProfile/lambda.zip": "6TSPoPHqDS5RBuhHXK7c5nY1cWSQQWAN",
+    "GetCallerArn/lambda.zip": "aHK8rwSAtRi_VvXb93WSZeAPfkJRP1i1",
+    "HelmReleaseResource/awsqs-kubernetes-helm.zip": (
+        "mICndQson0cH88MTYmSHI8nD34BtUv6L"
+    ),
+    "KubeGet/lambda.zip": "D4Ie05qzJFw9phLxGl0c4jokEDe_3vOr",
+    "KubeManifest/lambda.zip": "FjNMguZ.ewamJlVG5FA7njCIPOY_wfBv",
+    "ResourceReader/lambda.zip": "CPRyESVYBRyOn88XbJBRff9BH6FdUPNV",
+    "awscliLayer/lambda.zip": "5bq9jw0Uy6nWpvAdzB3jHnTOsXqVAdNe",
+    "boto3Layer/lambda.zip": "_tm_qNEfTaXbxhdEoMIsevtndWWgVYW8",
+    "crhelperLayer/lambda.zip": "JiHzMw61.BY6cixU9XKvkYdjpf2Pw2o5",
+    "kubectlLayer/lambda.zip": "js0Jh5I5tHcHm3uDQPmzDHefiWrVzLdv",
+    "kubernetesResources/awsqs_kubernetes_apply.zip": (
+        "zur88zGrO3y28JtyZkFHdgrIOWgZiQVA"
+    ),
+    "kubernetesResources/awsqs_kubernetes_apply_vpc.zip": (
+        "h5p9y6olTWxdrOkk81ZZZbcV3w15K_10"
+    ),
+    "kubernetesResources/awsqs_kubernetes_get.zip": (
+        "TOU3OQH4ZjItln8yMy1cX2N1o4ET6tAQ"
+    ),
+    "kubernetesResources/awsqs_kubernetes_get_vpc.zip": (
+        "mi26IfkUgVG4kCZ2EB2Zn915cYgJPFLL"
+    ),
+    "registerCustomResource/lambda.zip": "VYQpmfwS.PKRdHIAXTtWe_.K1dBuc3XX",
+    "registerType/lambda.zip": "s3kDkK67t2.qn1caBkqBLlHL2Bblf.b9",
+}
+
+# Number of uploads and copies made at once.
+WORKERS = 16
+
+# Prefix of the hash of a key copied from another bucket, rather than
+# uploaded.
+COPY_PREFIX = "copy:"
+
+
+def _file_hash(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return f"sha256:{digest.hexdigest()}"
+
+
+def build_manifest(
+    root: Path,
+    prefix: str,
+    *,
+    dirs: Iterable[str] = DIRS,
+    lambdas: Mapping[str, str] = LAMBDAS,
+) -> dict[str, str]:
+    """
+    Build the manifest of this checkout.
+
+    :param root:
+        Root of the repository.
+
+    :param prefix:
+        Key prefix of the published resources, e.g. "xrd-eks/".
+
+    :returns:
+        The hash of each key to publish.
+
+    """
+    manifest = {}
+    for d in dirs:
+        for dirpath, _, filenames in os.walk(root / d):
+            for filename in filenames:
+                path = Path(dirpath, filename)
+                key = prefix + path.relative_to(root).as_posix()
+                manifest[key] = _file_hash(path)
+    for name, version in lambdas.items():
+        source = f"{QUICKSTART_BUCKET}/{QUICKSTART_PREFIX}{name}"
+        key = f"{prefix}submodules/{QUICKSTART_PREFIX}{name}"
+        manifest[key] = f"{COPY_PREFIX}{source}?versionId={version}"
+    return manifest
+
+
+def read_manifest(
+    s3: Any,
+    bucket: str,
+    prefix: str,
+    *,
+    dirs: Iterable[str] = DIRS,
+    full: bool = False,
+) -> dict[str, Optional[str]]:
+    """
+    Read the manifest of the last publish from the bucket, or if there is
+    none, list the keys under the published directories.
+
+    :param full:
+        Whether to list the keys even if there is a manifest.
+
+    :returns:
+        The hash of each published key, or None if it isn't known.
+
+    """
+    if not full:
+        key = prefix + MANIFEST_KEY
+        try:
+            return json.load(s3.get_object(Bucket=bucket, Key=key)["Body"])
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "NoSuchKey":
+                raise
+        logger.info("No manifest in the bucket, listing keys")
+    manifest: dict[str, Optional[str]] = {}
+    paginator = s3.get_paginator("list_objects_v2")
+    for d in dirs:
+        for page in paginator.paginate(Bucket=bucket, Prefix=f"{prefix}{d}/"):
+            for obj in page.get("Contents", []):
+                manifest[obj["Key"]] = None
+    return manifest
+
+
+@dataclasses.dataclass
+class Changes:
+    """Keys which differ between the bucket and this checkout."""
+
+    upload: list[str]
+    copy: list[str]
+    delete: list[str]
+
+    def __len__(self) -> int:
+        return len(self.upload) + len(self.copy) + len(self.delete)
+
+
+def diff(old: Mapping[str, Optional[str]], new: Mapping[str, str]) -> Changes:
+    """Return the changes needed for a bucket with the ``old`` manifest to
+    have the ``new`` one."""
+    changed = sorted(k for k, v in new.items() if old.get(k) != v)
+    return Changes(
+        upload=[k for k in changed if not new[k].startswith(COPY_PREFIX)],
+        copy=[k for k in changed if new[k].startswith(COPY_PREFIX)],
+        delete=sorted(k for k in old if k not in new),
+    )
+
+
+def publish(
+    s3: Any,
+    bucket: str,
+    prefix: str,
+    root: Path,
+    *,
+    full: bool = False,
+    dirs: Iterable[str] = DIRS,
+    lambdas: Mapping[str, str] = LAMBDAS,
+    workers: int = WORKERS,
+) -> Changes:
+    """
+    Publish the changes since the last publish to the bucket.
+
+    The manifest is only written once all the changes are made, so a
+    failed publish is completed by the next one.
+
+    :param s3:
+        A boto3 S3 client, with a connection pool of at least ``workers``.
+
+    :param full:
+        Whether to ignore the manifest in the bucket, and publish everything.
+
+    :returns:
+        The changes made.
+
+    """
+    dirs = tuple(dirs)
+    new = build_manifest(root, prefix, dirs=dirs, lambdas=lambdas)
+    old = read_manifest(s3, bucket, prefix, dirs=dirs, full=full)
+    changes = diff(old, new)
+    logger.info(
+        "%d to upload, %d to copy, %d to delete, %d unchanged",
+        len(changes.upload),
+        len(changes.copy),
+        len(changes.delete),
+        len(new) - len(changes.upload) - len(changes.copy),
+    )
+
+    def upload(key: str) -> None:
+        path = root / key[len(prefix) :]
+        content_type, _ = mimetypes.guess_type(path.name)
+        s3.upload_file(
+            str(path),
+            bucket,
+            key,
+            ExtraArgs={"ContentType": content_type} if content_type else None,
+        )
+        logger.info("upload: %s to s3://%s/%s", path, bucket, key)
+
+    def copy(key: str) -> None:
+        source, version = new[key][len(COPY_PREFIX) :].split("?versionId=")
+        source_bucket, source_key = source.split("/", 1)
+        s3.copy_object(
+            Bucket=bucket,
+            Key=key,
+            CopySource={
+                "Bucket": source_bucket,
+                "Key": source_key,
+                "VersionId": version,
+            },
+            MetadataDirective="REPLACE",
+        )
+        logger.info("copy: s3://%s to s3://%s/%s", source, bucket, key)
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        futures = [pool.submit(upload, k) for k in changes.upload]
+        futures += [pool.submit(copy, k) for k in changes.copy]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+
+    # Deleted in batches of up to 1000, the most DeleteObjects allows.
+    for i in range(0, len(changes.delete), 1000):
+        batch = changes.delete[i : i + 1000]
+        s3.delete_objects(
+            Bucket=bucket,
+            Delete={"Objects": [{"Key": k} for k in batch], "Quiet": True},
+        )
+        for key in batch:
+            logger.info("delete: s3://%s/%s", bucket, key)
+
+    s3.put_object(
+        Bucket=bucket,
+        Key=prefix + MANIFEST_KEY,
+        Body=json.dumps(new, indent=1, sort_keys=True).encode(),
+        ContentType="application/json",
+    )
+    return changes
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--bucket", required=True, help="Bucket name")
+    parser.add_argument(
+        "--prefix",
+        default="xrd-eks/",
+        help="Key prefix (default: %(default)s)",
+    )
+    parser.add_argument("--region", help="Region of the bucket")
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Ignore the manifest in the bucket, and publish everything",
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    s3 = boto3.client(
+        "s3",
+        region_name=args.region,
+        config=Config(
+            max_pool_connections=WORKERS,
+            retries={"max_attempts": 10, "mode": "standard"},
+        ),
+    )
+    changes = publish(
+        s3,
+        args.bucket,
+        args.prefix,
+        Path(__file__).resolve().parent,
+        full=args.full,
+    )
+    print(f"Published {len(changes)} changes to s3://{args.bucket}/")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,10 +2,12 @@
 
 """Common test utilities."""
 
-from typing import Optional
+import time
+from typing import Callable, Optional, TypeVar
 
 import kubernetes.client
 import kubernetes.stream
+import kubernetes.watch
 from tenacity import (
     retry,
     retry_if_exception_type,
@@ -13,44 +15,146 @@ from tenacity import (
     wait_fixed,
 )
 
+from . import timing
+
+
+T = TypeVar("T")
+
+# Label identifying the application a pod belongs to.
+NAME_LABEL = "app.kubernetes.io/name"
+
+
+@timing.traced(category="k8s")
+def watch_pods(
+    k8s: kubernetes.client.CoreV1Api,
+    namespace: str,
+    check: Callable[[dict[str, kubernetes.client.V1Pod]], Optional[T]],
+    *,
+    timeout: float,
+    label_selector: Optional[str] = None,
+    field_selector: Optional[str] = None,
+) -> T:
+    """
+    Wait for the pods in a namespace to reach some state.
+
+    The pods are listed once, and then watched from the list's
+    resourceVersion, so ``check`` is called as soon as any matching pod
+    changes rather than on a polling interval.  If the watch expires (HTTP
+    410 Gone) or the server closes it, the pods are listed again and the
+    watch resumed.
+
+    :param check:
+        Called with the current pods, keyed by UID, after the initial list and
+        after every watch event.  Returns a non-None result once the pods are
+        in the expected state.
+
+    :param timeout:
+        Maximum time to wait in seconds.
+
+    :param label_selector:
+        Restrict the pods to those matching this label selector.
+
+    :param field_selector:
+        Restrict the pods to those matching this field selector.
+
+    :raises AssertionError:
+        If the pods don't reach the expected state within ``timeout``.
+
+    :returns:
+        The first non-None result of ``check``.
+
+    """
+    deadline = time.monotonic() + timeout
+    selectors = {}
+    if label_selector is not None:
+        selectors["label_selector"] = label_selector
+    if field_selector is not None:
+        selectors["field_selector"] = field_selector
+
+    while True:
+        pod_list = k8s.list_namespaced_pod(namespace, **selectors)
+        pods = {pod.metadata.uid: pod for pod in pod_list.items}
+        if (result := check(pods)) is not None:
+            return result
+
+        resource_version = pod_list.metadata.resource_version
+        watch = kubernetes.watch.Watch()
+        try:
+            for event in watch.stream(
+                k8s.list_namespaced_pod,
+                namespace,
+                resource_version=resource_version,
+                timeout_seconds=max(1, int(deadline - time.monotonic())),
+                **selectors,
+            ):
+                pod = event["object"]
+                if event["type"] == "DELETED":
+                    pods.pop(pod.metadata.uid, None)
+                elif event["type"] in ("ADDED", "MODIFIED"):
+                    pods[pod.metadata.uid] = pod
+                else:
+                    continue
+                if (result := check(pods)) is not None:
+                    return result
+                if time.monotonic() >= deadline:
+                    break
+        except kubernetes.client.ApiException as e:
+            if e.status != 410:
+                raise
+        finally:
+            watch.stop()
+
+        if time.monotonic() >= deadline:
+            raise AssertionError(
+                f"Pods in namespace {namespace!r} did not reach the expected "
+                f"state within {timeout}s"
+            )
+
+
+def _is_running_xrd_pod(pod: kubernetes.client.V1Pod) -> bool:
+    try:
+        return (
+            pod.metadata.labels.get(NAME_LABEL).startswith("xrd")
+            and pod.status.container_statuses.__len__() == 1
+            and pod.status.container_statuses[0].state.running is not None
+        )
+    except AttributeError:
+        return False
+
 
-@retry(
-    wait=wait_fixed(5),
-    stop=stop_after_delay(120),
-    retry=retry_if_exception_type(AssertionError),
-)
 def get_running_xrd_pods(
     k8s: kubernetes.client.CoreV1Api,
     *,
     num_expected: Optional[int] = None,
+    namespace: str = "default",
+    timeout: float = 120,
 ) -> list[kubernetes.client.V1Pod]:
     """Returns a list of running XRd pods.
 
     These pods have 'xrd' in the name label, consist of exactly one container,
     and the one container is in running state.
 
-    If ``num_expected`` is provided, this function additionally asserts that
-    the number of such XRd pods is as expected.
+    If ``num_expected`` is provided, this function additionally waits (up to
+    ``timeout`` seconds) for the number of such XRd pods to be as expected,
+    raising `AssertionError` if it isn't.
 
     """
-    pods = []
-    for pod in k8s.list_namespaced_pod("default").items:
-        try:
-            if (
-                pod.metadata.labels.get("app.kubernetes.io/name").startswith(
-                    "xrd"
-                )
-                and pod.status.container_statuses.__len__() == 1
-                and pod.status.container_statuses[0].state.running is not None
-            ):
-                pods.append(pod)
-        except AttributeError:
-            pass
-
-    if num_expected is not None:
-        assert len(pods) == num_expected
 
-    return pods
+    def check(
+        pods: dict[str, kubernetes.client.V1Pod],
+    ) -> Optional[list[kubernetes.client.V1Pod]]:
+        running = [pod for pod in pods.values() if _is_running_xrd_pod(pod)]
+        if num_expected is None or len(running) == num_expected:
+            return running
+        return None
+
+    return watch_pods(
+        k8s,
+        namespace,
+        check,
+        timeout=timeout,
+        label_selector=NAME_LABEL,
+    )
 
 
 def container_exec(
@@ -72,22 +176,29 @@ def container_exec(
     )
 
 
-@retry(
-    wait=wait_fixed(5),
-    stop=stop_after_delay(120),
-    retry=retry_if_exception_type(AssertionError),
-)
 def assert_pod_terminated(
-    k8s: kubernetes.client.CoreV1Api, pod: kubernetes.client.V1Pod
+    k8s: kubernetes.client.CoreV1Api,
+    pod: kubernetes.client.V1Pod,
+    *,
+    timeout: float = 120,
 ) -> None:
-    """Assert a pod has terminated."""
-    current_pods = k8s.list_namespaced_pod(
-        pod.metadata.namespace or "default"
-    ).items
-    for current_pod in current_pods:
-        assert current_pod.metadata.uid != pod.metadata.uid
+    """
+    Assert a pod has terminated, waiting up to ``timeout`` seconds.
+
+    A replacement pod with the same name (e.g. from a StatefulSet) does not
+    count as the original pod.
+
+    """
+    watch_pods(
+        k8s,
+        pod.metadata.namespace or "default",
+        lambda pods: True if pod.metadata.uid not in pods else None,
+        timeout=timeout,
+        field_selector=f"metadata.name={pod.metadata.name}",
+    )
 
 
+@timing.traced(category="retry")
 @retry(
     wait=wait_fixed(5),
     stop=stop_after_delay(120),
@@ -103,6 +214,7 @@ def assert_ping_success(
     ), f"Ping destination address {dest} did not succeed: {output}"
 
 
+@timing.traced(category="retry")
 @retry(
     wait=wait_fixed(5),
     stop=stop_after_delay(120),
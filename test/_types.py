@@ -5,6 +5,7 @@ __all__ = (
     "Kubectl",
     "KubernetesVersion",
     "Platform",
+    "PodExec",
 )
 
 import dataclasses
@@ -35,3 +36,6 @@ class Image:
 
 
 Kubectl = Callable[..., subprocess.CompletedProcess[str]]
+
+# Runs a command in a pod: ``pod_exec(pod_name, *command, **kwargs)``.
+PodExec = Callable[..., subprocess.CompletedProcess[str]]
@@ -2,17 +2,34 @@
 
 """Pytest hooks and fixtures."""
 
+import contextlib
+import functools
+import logging
+import os
+import shutil
 import subprocess
 import warnings
 from pathlib import Path
-from typing import Optional
+from typing import Any, Optional
 
 import boto3
+import kubernetes.client
+import kubernetes.config
 import pytest
 
-from . import utils
-from ._types import Image, Kubectl, KubernetesVersion, Platform
+from . import restart_latency, sharding, stack_cache, timing, utils
+from ._types import Image, Kubectl, KubernetesVersion, Platform, PodExec
+from .fake_cluster import (
+    BIN_DIR,
+    EXAMPLE_RELEASE,
+    STATE_DIR_ENV,
+    FakeCluster,
+    FakeCoreV1Api,
+    FakeStorageV1Api,
+    Latencies,
+)
 from .helm import Helm
+from .pod_shell import PodShellPool
 
 
 # `taskcat._amiupdater.AMIUpdater` passes an absolute path to
@@ -24,12 +41,39 @@ with warnings.catch_warnings():
     from taskcat.testing import CFNTest
 
 
+logger = logging.getLogger(__name__)
+
+# The taskcat test which brings up the stack used by the tests.
+STACK_TEST_NAME = "xrd-example-overlay"
+
+# Helm repository of the quickstart example's chart, per the Overlay
+# HelmRepositories mapping of xrd-example-cf.yaml.
+EXAMPLE_REPOSITORY = "https://ios-xr.github.io/xrd-eks"
+
+
 def pytest_addoption(parser: pytest.Parser) -> None:
+    group = parser.getgroup("backend", "Backend")
+    group.addoption(
+        "--backend",
+        choices=["eks", "fake"],
+        default="eks",
+        help="Cluster to run the tests against: an EKS cluster brought up in "
+        "AWS, or a local fake cluster for benchmarking the test harness "
+        "offline (see fake_cluster.py) (default: %(default)s)",
+    )
+    group.addoption(
+        "--fake-latency-scale",
+        type=float,
+        default=1.0,
+        help="Factor to scale the fake cluster's simulated latencies by "
+        "(default: %(default)s)",
+    )
+
     group = parser.getgroup("aws_and_eks", "AWS and EKS")
     group.addoption(
         "--aws-region",
-        required=True,
-        help="AWS region in which to run the tests (required)",
+        help="AWS region in which to run the tests (required for the eks "
+        "backend)",
     )
     group.addoption(
         "--aws-skip-bringup",
@@ -41,12 +85,24 @@ def pytest_addoption(parser: pytest.Parser) -> None:
         action="store_true",
         help="Do not teardown the AWS resources",
     )
+    group.addoption(
+        "--aws-reuse-stack",
+        action="store_true",
+        help="Reuse an existing stack brought up with the same templates, "
+        "parameters and Kubernetes version (updating it if only nested "
+        "templates have changed), and keep the stack after the tests",
+    )
     group.addoption(
         "--eks-kubernetes-version",
         type=KubernetesVersion,
         choices=list(KubernetesVersion),
         help="Kubernetes control plane version",
     )
+    group.addoption(
+        "--eks-cluster-name",
+        help="EKS cluster name (default: per the taskcat config), e.g. to "
+        "run several stacks in one region",
+    )
 
     group = parser.getgroup("xrd", "XRd")
     group.addoption(
@@ -71,10 +127,157 @@ def pytest_addoption(parser: pytest.Parser) -> None:
         "'latest')",
     )
 
+    group = parser.getgroup("benchmark", "Benchmarks")
+    group.addoption(
+        "--restart-benchmark",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Number of times to restart an XRd pod with a persistent volume "
+        "in the restart latency benchmark, or 0 to skip it (default: "
+        "%(default)s)",
+    )
+    group.addoption(
+        "--restart-benchmark-storage-classes",
+        nargs="+",
+        default=["gp2", "gp3", "io2"],
+        help="Space-separated list of StorageClasses to compare in the "
+        "restart latency benchmark; those named for EBS volume types are "
+        "created if necessary (default: 'gp2 gp3 io2')",
+    )
+
+    group = parser.getgroup("overlay", "Overlay stability")
+    group.addoption(
+        "--overlay-stability-samples",
+        type=int,
+        default=3,
+        metavar="N",
+        help="Number of times to sample the Overlay example once it has "
+        "converged (default: %(default)s)",
+    )
+    group.addoption(
+        "--ping-loss-budget",
+        type=float,
+        metavar="FRACTION",
+        help="Fail if more than this fraction of pings is lost across the "
+        "Overlay samples (default: only report the loss)",
+    )
+    group.addoption(
+        "--ping-rtt-p99-budget",
+        type=float,
+        metavar="MS",
+        help="Fail if the p99 of the pings' average RTTs across the Overlay "
+        "samples exceeds this many ms (default: only report the p99)",
+    )
+
+    group = parser.getgroup("timing", "Timing")
+    group.addoption(
+        "--trace-file",
+        type=Path,
+        help="File to write a Chrome trace (JSON) of the session's phases to",
+    )
+    group.addoption(
+        "--timing-summary",
+        type=int,
+        default=10,
+        metavar="N",
+        help="Number of slowest phases to summarize at the end of the "
+        "session, or 0 for none (default: %(default)s)",
+    )
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_fixture_setup(
+    fixturedef: pytest.FixtureDef, request: pytest.FixtureRequest
+) -> None:
+    with timing.span(
+        f"fixture {fixturedef.argname}", "fixture", scope=fixturedef.scope
+    ):
+        yield
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_setup(item: pytest.Item) -> None:
+    with timing.span("setup", "test", test=item.nodeid):
+        yield
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_call(item: pytest.Item) -> None:
+    with timing.span(item.nodeid, "test"):
+        yield
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_teardown(item: pytest.Item) -> None:
+    with timing.span("teardown", "test", test=item.nodeid):
+        yield
+
+
+def pytest_sessionfinish(session: pytest.Session) -> None:
+    if fname := session.config.option.trace_file:
+        if worker := sharding.worker_id():
+            fname = fname.with_name(f"{fname.stem}-{worker}{fname.suffix}")
+        timing.tracer.write_chrome_trace(fname)
+
+    # Send the phases and restart latencies of a pytest-xdist worker to the
+    # controller, which prints the summaries.
+    if hasattr(session.config, "workeroutput"):
+        session.config.workeroutput["timing_phases"] = timing.tracer.phases()
+        session.config.workeroutput["restart_latency"] = {
+            name: {
+                phase: list(durations)
+                for phase, durations in samples.columns.items()
+            }
+            for name, samples in restart_latency.results.items()
+        }
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_testnodedown(node: Any, error: Optional[str]) -> None:
+    """Collect the results of a pytest-xdist worker."""
+    output = getattr(node, "workeroutput", {})
+    timing.tracer.merge(output.get("timing_phases", {}))
+    for name, columns in output.get("restart_latency", {}).items():
+        restart_latency.results.setdefault(
+            name, restart_latency.RestartSamples()
+        ).extend(columns)
+
+
+def pytest_terminal_summary(
+    terminalreporter: pytest.TerminalReporter, config: pytest.Config
+) -> None:
+    if (n := config.option.timing_summary) and timing.tracer.phases():
+        terminalreporter.section(f"{n} slowest phases")
+        for name, count, total, longest in timing.tracer.slowest(n):
+            terminalreporter.write_line(
+                f"{total:9.1f}s total  {longest:9.1f}s max  {count:5d}x  "
+                f"{name}"
+            )
+        if fname := config.option.trace_file:
+            terminalreporter.write_line(f"Chrome trace written to {fname}")
+
+    for name, samples in restart_latency.results.items():
+        terminalreporter.section(
+            f"Restart latency: {name} ({len(samples)} restarts)"
+        )
+        terminalreporter.write_line(samples.summary())
+
 
 def pytest_collection_modifyitems(
     config: pytest.Config, items: list[pytest.Item]
 ) -> None:
+    # Only tests which use the cluster need a region, e.g. not those of the
+    # Lambda functions.
+    if (
+        config.option.backend == "eks"
+        and not config.option.aws_region
+        and any("stack" in item.fixturenames for item in items)
+    ):
+        raise pytest.UsageError(
+            "`--aws-region` is required for `--backend=eks`"
+        )
+
     new_items = []
     for item in items:
         if mark := item.get_closest_marker("platform"):
@@ -99,6 +302,17 @@ def pytest_collection_modifyitems(
                     )
                 )
 
+        if (
+            item.get_closest_marker("benchmark")
+            and not config.option.restart_benchmark
+        ):
+            item.add_marker(
+                pytest.mark.skip(
+                    "Benchmark skipped since `--restart-benchmark` was not "
+                    "provided"
+                )
+            )
+
         # Make sure any items marked 'quickstart' are run first.
         if item.get_closest_marker("quickstart"):
             new_items.insert(0, item)
@@ -166,6 +380,13 @@ def pytest_generate_tests(metafunc: pytest.Metafunc) -> None:
                 ids=ids,
             )
 
+    if "storage_class" in metafunc.fixturenames:
+        metafunc.parametrize(
+            "storage_class",
+            argvalues=metafunc.config.option.restart_benchmark_storage_classes,
+            indirect=True,
+        )
+
 
 @pytest.fixture(scope="session")
 def taskcat_config(request: pytest.FixtureRequest) -> taskcat.Config:
@@ -177,29 +398,237 @@ def taskcat_config(request: pytest.FixtureRequest) -> taskcat.Config:
     )
 
 
+def _stack_parameters(request: pytest.FixtureRequest) -> dict[str, str]:
+    """Return the stack Parameters given as pytest arguments."""
+    parameters = {}
+    if version := request.config.option.eks_kubernetes_version:
+        parameters["KubernetesVersion"] = str(version)
+    if cluster_name := request.config.option.eks_cluster_name:
+        parameters["ClusterName"] = cluster_name
+        parameters["EKSClusterName"] = cluster_name
+    return parameters
+
+
+def _stack_kubernetes_version(taskcat_config: taskcat.Config) -> str:
+    """Return the Kubernetes version of the XRd Overlay stack: its
+    ``KubernetesVersion`` parameter if set, or else the template's
+    default."""
+    test_config = taskcat_config.config.tests[STACK_TEST_NAME]
+    parameters = {
+        **taskcat_config.config.general.parameters,
+        **(test_config.parameters or {}),
+    }
+    if "KubernetesVersion" in parameters:
+        return str(parameters["KubernetesVersion"])
+    template = taskcat_config.get_templates()[STACK_TEST_NAME].template
+    return str(template["Parameters"]["KubernetesVersion"]["Default"])
+
+
+def _stack_bucket(
+    request: pytest.FixtureRequest, taskcat_config: taskcat.Config
+) -> str:
+    """Return the name of the S3 bucket the stack is brought up from, as
+    taskcat names it for the project's ``s3_bucket``."""
+    test_config = taskcat_config.config.tests[STACK_TEST_NAME]
+    bucket = test_config.s3_bucket or taskcat_config.config.project.s3_bucket
+    if not bucket:
+        raise pytest.UsageError(
+            "taskcat's project `s3_bucket` must be configured, as the stack "
+            "is brought up from it"
+        )
+    if test_config.s3_regional_buckets:
+        bucket = f"{bucket}-{request.config.option.aws_region}"
+    return bucket
+
+
+def _check_stack_bucket_region(
+    request: pytest.FixtureRequest, taskcat_config: taskcat.Config
+) -> None:
+    """Check the stack's S3 bucket is in the stack's region, as Lambda
+    functions can only be deployed from a bucket in their own region."""
+    region = request.config.option.aws_region
+    bucket = _stack_bucket(request, taskcat_config)
+    s3 = boto3.client("s3", region_name=region)
+    # Buckets in us-east-1 have no location constraint.
+    location = (
+        s3.get_bucket_location(Bucket=bucket)["LocationConstraint"]
+        or "us-east-1"
+    )
+    if location != region:
+        raise pytest.UsageError(
+            f"S3 bucket {bucket} is in {location}, not {region}: publish a "
+            f"bucket in each region (see taskcat's `s3_regional_buckets`)"
+        )
+
+
+def _stack_fingerprint(
+    request: pytest.FixtureRequest, taskcat_config: taskcat.Config
+) -> stack_cache.Fingerprint:
+    """
+    Fingerprint the configuration of the XRd Overlay stack, from the
+    resources published to its S3 bucket.
+
+    Local changes to the templates, AMI assets and Lambda packages which
+    haven't been published are logged, as the stack won't include them.
+
+    """
+    project_root = Path(__file__).resolve().parent.parent
+    test_config = taskcat_config.config.tests[STACK_TEST_NAME]
+    version = request.config.option.eks_kubernetes_version
+    bucket = _stack_bucket(request, taskcat_config)
+    prefix = f"{taskcat_config.config.project.name}/"
+    s3 = boto3.client("s3", region_name=request.config.option.aws_region)
+    if unpublished := stack_cache.unpublished(
+        s3, bucket, prefix, project_root
+    ):
+        logger.warning(
+            "Local changes not published to s3://%s/%s, so not in the "
+            "stack: %s",
+            bucket,
+            prefix,
+            ", ".join(unpublished),
+        )
+    return stack_cache.fingerprint(
+        s3,
+        bucket,
+        prefix,
+        Path(test_config.template).name,
+        {
+            **taskcat_config.config.general.parameters,
+            **(test_config.parameters or {}),
+            **_stack_parameters(request),
+        },
+        str(version) if version else None,
+    )
+
+
+def _reuse_stack(
+    request: pytest.FixtureRequest,
+    taskcat_config: taskcat.Config,
+    fp: stack_cache.Fingerprint,
+) -> bool:
+    """
+    Look for an existing XRd Overlay stack to reuse, updating it if its
+    nested templates have changed.
+
+    :returns:
+        Whether there is a stack to reuse.
+
+    """
+    cf = boto3.client(
+        "cloudformation", region_name=request.config.option.aws_region
+    )
+    match = stack_cache.find_stack(
+        cf,
+        fp,
+        name_prefix=f"tCaT-{taskcat_config.config.project.name}-"
+        f"{STACK_TEST_NAME}-",
+    )
+    if match is None:
+        return False
+    if not match.exact:
+        logger.info(
+            "Templates changed for stack %s: %s",
+            match.stack_name,
+            ", ".join(match.changed_templates),
+        )
+        stack_cache.update_stack(cf, match.stack_name, fp)
+    logger.info("Reusing stack %s", match.stack_name)
+    return True
+
+
+@pytest.fixture(scope="session")
+def fake_cluster(request: pytest.FixtureRequest) -> Optional[FakeCluster]:
+    """
+    Fixture which provides the fake cluster with ``--backend=fake``, or None
+    otherwise.
+
+    The fake cluster starts with the quickstart example installed, and is
+    shared by all the workers of a test run.  The fake ``helm`` and
+    ``kubectl`` are put first on the PATH for the session.
+
+    """
+    if request.config.option.backend != "fake":
+        yield None
+        return
+
+    latencies = Latencies().scaled(request.config.option.fake_latency_scale)
+    with sharding.run_lock("fake-cluster"):
+        cluster = FakeCluster.create(
+            sharding._run_dir() / "fake-cluster", latencies=latencies
+        )
+        if not cluster.releases("default"):
+            cluster.install(
+                EXAMPLE_RELEASE, f"xrd/{EXAMPLE_RELEASE}", "default", {}
+            )
+
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv(STATE_DIR_ENV, str(cluster.state_dir))
+        mp.setenv("PATH", f"{BIN_DIR}{os.pathsep}{os.environ['PATH']}")
+        yield cluster
+
+    if sharding.worker_id() is None:
+        shutil.rmtree(cluster.state_dir)
+
+
 @pytest.fixture(scope="session")
 def stack(
     request: pytest.FixtureRequest,
-    taskcat_config: taskcat.Config,
+    fake_cluster: Optional[FakeCluster],
 ) -> None:
     """Bringup and teardown the XRd Overlay stack."""
-    # Run the taskcat test to provision the AWS resources.
-    test: Optional[CFNTest] = None
-    if not request.config.option.aws_skip_bringup:
-        test = CFNTest(
-            config=taskcat_config,
-            test_names="xrd-example-overlay",
-            regions=request.config.option.aws_region,
-            skip_upload=True,
-            dont_wait_for_delete=False,
+    if fake_cluster is not None:
+        yield
+        return
+
+    taskcat_config = request.getfixturevalue("taskcat_config")
+    reuse = request.config.option.aws_reuse_stack
+    skip_bringup = request.config.option.aws_skip_bringup
+    if sharding.worker_id() is not None and not (reuse or skip_bringup):
+        raise pytest.UsageError(
+            "`--aws-reuse-stack` or `--aws-skip-bringup` must be given to "
+            "run tests in parallel, so all workers use the same stack"
         )
-        # Set any Parameters given as pytest arguments.
-        if version := request.config.option.eks_kubernetes_version:
-            test.config.config.tests["xrd-example-overlay"].parameters[
-                "KubernetesVersion"
-            ] = str(version)
 
-        test.run()
+    # With pytest-xdist, the first worker brings up the stack and the other
+    # workers then find it and reuse it.
+    if sharding.worker_id() is not None:
+        lock = sharding.run_lock("stack")
+    else:
+        lock = contextlib.nullcontext()
+
+    test: Optional[CFNTest] = None
+    with lock:
+        reused = False
+        if reuse and not skip_bringup:
+            fp = _stack_fingerprint(request, taskcat_config)
+            with timing.span("stack reuse lookup", "stack"):
+                reused = _reuse_stack(request, taskcat_config, fp)
+
+        # Run the taskcat test to provision the AWS resources.
+        if not skip_bringup and not reused:
+            _check_stack_bucket_region(request, taskcat_config)
+            test = CFNTest(
+                config=taskcat_config,
+                test_names=STACK_TEST_NAME,
+                regions=request.config.option.aws_region,
+                skip_upload=True,
+                dont_wait_for_delete=False,
+            )
+            # Set any Parameters given as pytest arguments.
+            test.config.config.tests[STACK_TEST_NAME].parameters.update(
+                _stack_parameters(request)
+            )
+            # Tag the stack so it can be reused by later sessions.
+            if reuse:
+                test_config = test.config.config.tests[STACK_TEST_NAME]
+                test_config.tags = {
+                    **(test_config.tags or {}),
+                    **{t["Key"]: t["Value"] for t in fp.tags()},
+                }
+
+            with timing.span("taskcat bringup", "stack"):
+                test.run()
 
     try:
         # Ensure the Kubernetes config is updated.
@@ -211,27 +640,77 @@ def stack(
                 "--region",
                 request.config.option.aws_region,
                 "--name",
-                taskcat_config.config.general.parameters["ClusterName"],
+                request.config.option.eks_cluster_name
+                or taskcat_config.config.general.parameters["ClusterName"],
             ],
+            log_output=True,
+            stream=True,
         )
 
         yield
 
     finally:
-        if test is not None and not request.config.option.aws_skip_teardown:
-            test.clean_up()
-
-            # Delete the XRd AMI that was created.
-            cf = boto3.client("cloudformation")
-            version = request.config.option.eks_kubernetes_version.replace(".", "-")
+        if (
+            test is not None
+            and not request.config.option.aws_skip_teardown
+            and not reuse
+        ):
+            with timing.span("taskcat teardown", "stack"):
+                test.clean_up()
+
+            # Delete the XRd AMI that was created, which is named for the
+            # stack's Kubernetes version.
+            cf = boto3.client(
+                "cloudformation",
+                region_name=request.config.option.aws_region,
+            )
+            version = _stack_kubernetes_version(test.config).replace(".", "-")
             cf.delete_stack(StackName=f"xrd-quickstart-AMI-{version}")
 
 
 @pytest.fixture(scope="session")
-def kubectl(stack: None) -> Kubectl:
+def namespace(k8s: kubernetes.client.CoreV1Api) -> str:
+    """
+    Fixture which provides the namespace for the tests, which is created if
+    necessary.
+
+    This is "default", unless running under pytest-xdist in which case each
+    worker has its own namespace (see `sharding`).
+
+    """
+    namespace = sharding.worker_namespace()
+    if namespace == "default":
+        yield namespace
+        return
+
+    try:
+        k8s.create_namespace(
+            kubernetes.client.V1Namespace(
+                metadata=kubernetes.client.V1ObjectMeta(name=namespace)
+            )
+        )
+    except kubernetes.client.ApiException as e:
+        if e.status != 409:
+            raise
+    yield namespace
+    k8s.delete_namespace(namespace)
+
+
+@pytest.fixture(scope="session")
+def admission(k8s: kubernetes.client.CoreV1Api) -> sharding.Admission:
+    """
+    Fixture which provides admission of tests onto nodes with capacity for
+    them (see `sharding.Admission`).
+
+    """
+    return sharding.Admission(k8s)
+
+
+@pytest.fixture(scope="session")
+def kubectl(stack: None, namespace: str) -> Kubectl:
     """
     Fixture which provides a function to run a ``kubectl`` command, within the
-    context of the XRd cluster.
+    context of the XRd cluster and the tests' namespace.
 
     """
 
@@ -249,20 +728,125 @@ def kubectl(stack: None) -> Kubectl:
             The completed ``kubectl`` process.
 
         """
-        return utils.run_cmd(["kubectl", *args], **kwargs)
+        return utils.run_cmd(
+            ["kubectl", "--namespace", namespace, *args], **kwargs
+        )
 
     return run_kubectl
 
 
 @pytest.fixture(scope="session")
-def helm(stack: None) -> Helm:
+def k8s(
+    stack: None, fake_cluster: Optional[FakeCluster]
+) -> kubernetes.client.CoreV1Api:
     """
-    Fixture which provides an instance of the `Helm` wrapper, within the
+    Fixture which provides a Kubernetes API client, within the context of the
+    XRd cluster.
+
+    """
+    if fake_cluster is not None:
+        return FakeCoreV1Api(fake_cluster)
+    return kubernetes.client.CoreV1Api(
+        api_client=kubernetes.config.new_client_from_config()
+    )
+
+
+@pytest.fixture(scope="session")
+def storage(
+    k8s: kubernetes.client.CoreV1Api, fake_cluster: Optional[FakeCluster]
+) -> kubernetes.client.StorageV1Api:
+    """
+    Fixture which provides a Kubernetes storage API client, within the
     context of the XRd cluster.
 
     """
-    helm = Helm()
+    if fake_cluster is not None:
+        return FakeStorageV1Api(fake_cluster)
+    return kubernetes.client.StorageV1Api(api_client=k8s.api_client)
+
+
+@pytest.fixture(scope="session")
+def pod_exec(
+    k8s: kubernetes.client.CoreV1Api,
+    namespace: str,
+    fake_cluster: Optional[FakeCluster],
+) -> PodExec:
+    """
+    Fixture which provides a function to run a command in a pod.
+
+    Unlike ``kubectl exec``, this keeps shells open in each pod for the whole
+    session, so repeated commands (e.g. in polling loops) don't each pay for a
+    new process and API connection, while concurrent commands in the same pod
+    each get their own shell.  See `PodShellPool.run`.
+
+    """
+    if fake_cluster is not None:
+        yield functools.partial(fake_cluster.run_in_pod, namespace=namespace)
+        return
+
+    pool = PodShellPool(k8s, namespace=namespace)
+    yield pool.run
+    pool.close()
+
+
+@pytest.fixture(scope="session")
+def helm(k8s: kubernetes.client.CoreV1Api, namespace: str) -> Helm:
+    """
+    Fixture which provides an instance of the `Helm` wrapper, within the
+    context of the XRd cluster and the tests' namespace.
+
+    The repository index is only refreshed if it is more than an hour old, and
+    releases are cached (see `Helm`).
+
+    """
+    helm = Helm(k8s=k8s, namespace=namespace)
     helm.repo_add(
-        "xrd", "https://ios-xr.github.io/xrd-helm", force_update=True
+        "xrd",
+        "https://ios-xr.github.io/xrd-helm",
+        force_update=True,
+        max_index_age=3600,
     )
     return helm
+
+
+@pytest.fixture(scope="session")
+def example_release(
+    helm: Helm, namespace: str, fake_cluster: Optional[FakeCluster]
+) -> None:
+    """
+    Fixture for tests which uninstall all the releases in the tests'
+    namespace.
+
+    If that is "default" (i.e. not running under pytest-xdist), the
+    quickstart example installed there by the stack is reinstalled at the end
+    of the session if it was uninstalled, so a later session reusing the
+    stack still finds it.  The fake cluster reinstalls it itself.
+
+    """
+    if fake_cluster is not None or namespace != "default":
+        yield
+        return
+
+    try:
+        release = helm.status(EXAMPLE_RELEASE)
+    except (ValueError, subprocess.CalledProcessError):
+        logger.warning("No %s release to restore", EXAMPLE_RELEASE)
+        yield
+        return
+
+    yield
+
+    if helm.list(filter=f"^{EXAMPLE_RELEASE}$"):
+        return
+    chart = release["chart"]["metadata"]
+    logger.info("Reinstalling %s", EXAMPLE_RELEASE)
+    helm.repo_add(
+        "xrd-eks", EXAMPLE_REPOSITORY, force_update=True, max_index_age=3600
+    )
+    helm.install(
+        f"xrd-eks/{chart['name']}",
+        name=EXAMPLE_RELEASE,
+        version=chart["version"],
+        values=release.get("config") or {},
+        wait=True,
+    )
@@ -0,0 +1,997 @@
+# fake_cluster.py
+
+"""
+A local stand-in for the XRd EKS cluster, for running the test harness
+offline (``--backend=fake``).
+
+The cluster's state is held in a JSON file in a directory shared by:
+
+- `FakeCoreV1Api`, a stand-in for the parts of the Kubernetes API client used
+  by the tests (listing pods, nodes and Helm release Secrets);
+- fake ``helm`` and ``kubectl`` executables (in ``fake_bin/``), which
+  implement the subcommands used by the tests;
+- `FakeCluster.run_in_pod`, a stand-in for `PodShellPool.run`.
+
+No processes run in the background: pod lifecycles are simulated from
+timestamps, e.g. a pod is Ready a configurable latency after it is created,
+and commands which wait (e.g. ``helm install --wait``) sleep until then.
+Commands run in pods return canned XR CLI output.
+
+This is intended for measuring and regression testing the overhead of the
+test harness itself, not for testing XRd.
+
+"""
+
+__all__ = (
+    "FakeCluster",
+    "FakeCoreV1Api",
+    "FakeStorageV1Api",
+    "Latencies",
+    "helm_main",
+    "kubectl_main",
+)
+
+import base64
+import contextlib
+import dataclasses
+import datetime
+import fcntl
+import gzip
+import json
+import os
+import re
+import shlex
+import subprocess
+import sys
+import time
+import uuid
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Iterator, Optional
+
+
+# Environment variable giving the state directory, for the fake executables.
+STATE_DIR_ENV = "XRD_FAKE_CLUSTER_DIR"
+
+# Directory containing the fake executables.
+BIN_DIR = Path(__file__).resolve().parent / "fake_bin"
+
+# Name of the quickstart example release.
+EXAMPLE_RELEASE = "xrd-example"
+
+
+@dataclasses.dataclass
+class Latencies:
+    """
+    Simulated latencies, in seconds.
+
+    .. attribute:: helm
+       Overhead of each ``helm`` command.
+
+    .. attribute:: kubectl
+       Overhead of each ``kubectl`` command.
+
+    .. attribute:: exec
+       Time to run a command in a pod.
+
+    .. attribute:: pod_start
+       Time from a pod being created to it being Ready.
+
+    .. attribute:: pod_terminate
+       Time for a pod to terminate.
+
+    .. attribute:: bgp_establish
+       Time from a pod being Ready to its BGP sessions being established.
+
+    """
+
+    helm: float = 0.2
+    kubectl: float = 0.1
+    exec: float = 0.02
+    pod_start: float = 2.0
+    pod_terminate: float = 1.0
+    bgp_establish: float = 1.0
+
+    def scaled(self, factor: float) -> "Latencies":
+        return Latencies(
+            **{k: v * factor for k, v in dataclasses.asdict(self).items()}
+        )
+
+
+class PodNotReady(Exception):
+    pass
+
+
+def _encode_release(release: dict[str, Any]) -> str:
+    """Encode a release as Secret data, as Helm does."""
+    data = gzip.compress(json.dumps(release).encode())
+    return base64.b64encode(base64.b64encode(data)).decode()
+
+
+def _merge(base: dict[str, Any], override: dict[str, Any]) -> dict[str, Any]:
+    merged = dict(base)
+    for k, v in override.items():
+        if isinstance(v, dict) and isinstance(merged.get(k), dict):
+            merged[k] = _merge(merged[k], v)
+        else:
+            merged[k] = v
+    return merged
+
+
+def _parse_set_json(arg: str) -> dict[str, Any]:
+    """Parse a ``--set-json`` argument, e.g. 'a={"b": 1},c=[2]'."""
+    values = {}
+    decoder = json.JSONDecoder()
+    i = 0
+    while i < len(arg):
+        eq = arg.index("=", i)
+        key = arg[i:eq]
+        value, i = decoder.raw_decode(arg, eq + 1)
+        target = values
+        *parents, leaf = key.split(".")
+        for parent in parents:
+            target = target.setdefault(parent, {})
+        target[leaf] = value
+        if i < len(arg) and arg[i] == ",":
+            i += 1
+    return values
+
+
+def _match_labels(labels: dict[str, str], selector: Optional[str]) -> bool:
+    """Match labels against an equality (or existence) label selector."""
+    if not selector:
+        return True
+    for term in selector.split(","):
+        key, _, value = term.partition("=")
+        if key not in labels or (value and labels[key] != value):
+            return False
+    return True
+
+
+class FakeCluster:
+    """
+    The state of a fake cluster.
+
+    Example usage::
+
+        >>> cluster = FakeCluster.create(tmp_path)
+        >>> cluster.install("xrd", "xrd/xrd-vrouter", "default", {})
+        >>> p = cluster.run_in_pod("xrd-xrd-vrouter-0", "hostname")
+
+    """
+
+    def __init__(self, state_dir: Path):
+        self.state_dir = Path(state_dir)
+        self._state_file = self.state_dir / "state.json"
+        self.latencies = Latencies(**self._load()["latencies"])
+
+    @classmethod
+    def create(
+        cls,
+        state_dir: Path,
+        *,
+        latencies: Optional[Latencies] = None,
+        nodes: int = 3,
+        hugepages_gi: int = 6,
+    ) -> "FakeCluster":
+        """Create a fake cluster, or open it if it already exists."""
+        state_dir = Path(state_dir)
+        state_dir.mkdir(parents=True, exist_ok=True)
+        if not (state_dir / "state.json").exists():
+            state = {
+                "latencies": dataclasses.asdict(latencies or Latencies()),
+                "resource_version": 1,
+                "namespaces": ["default"],
+                "nodes": {
+                    f"fake-node-{i}": {"hugepages_gi": hugepages_gi}
+                    for i in range(1, nodes + 1)
+                },
+                "releases": {},
+                "pods": {},
+                "files": {},
+                "storage_classes": ["gp2"],
+            }
+            (state_dir / "state.json").write_text(json.dumps(state))
+        return cls(state_dir)
+
+    def _load(self) -> dict[str, Any]:
+        return json.loads(self._state_file.read_text())
+
+    @contextlib.contextmanager
+    def _state(self, write: bool = True) -> Iterator[dict[str, Any]]:
+        """Lock and load the state, saving it afterwards if ``write``."""
+        with open(self.state_dir / "state.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX if write else fcntl.LOCK_SH)
+            state = self._load()
+            yield state
+            if write:
+                state["resource_version"] += 1
+                tmp = self._state_file.with_suffix(".tmp")
+                tmp.write_text(json.dumps(state))
+                tmp.replace(self._state_file)
+
+    # -------------------------------------------------------------------------
+    # Releases and pods.
+
+    def _create_pods(
+        self, state: dict[str, Any], release: dict[str, Any]
+    ) -> None:
+        now = time.time()
+        values = release["config"]
+        node = values.get("nodeSelector", {}).get(
+            "kubernetes.io/hostname", next(iter(state["nodes"]))
+        )
+        hugepages = 3 if release["app"] == "xrd-vrouter" else 0
+        for component in release["components"]:
+            name = f"{release['name']}-{component}-0"
+            key = f"{release['namespace']}/{name}"
+            state["pods"][key] = {
+                "name": name,
+                "namespace": release["namespace"],
+                "uid": str(uuid.uuid4()),
+                "release": release["name"],
+                "app": release["app"],
+                "node": node,
+                "hugepages_gi": hugepages,
+                "persistent": bool(
+                    values.get("persistence", {}).get("enabled")
+                ),
+                "created": now,
+                "ready": now + self.latencies.pod_start,
+            }
+            if not values.get("persistence", {}).get("enabled"):
+                state["files"].pop(key, None)
+
+    def _delete_pods(self, state: dict[str, Any], namespace: str, name: str):
+        for key in [
+            k
+            for k, pod in state["pods"].items()
+            if pod["namespace"] == namespace and pod["release"] == name
+        ]:
+            del state["pods"][key]
+            state["files"].pop(key, None)
+
+    def _wait_ready(self, keys: list[str], timeout: float) -> bool:
+        """Sleep until the given pods are Ready, or the timeout expires."""
+        with self._state(write=False) as state:
+            ready = max(
+                (
+                    state["pods"][k]["ready"]
+                    for k in keys
+                    if k in state["pods"]
+                ),
+                default=0,
+            )
+        delay = ready - time.time()
+        if delay > timeout:
+            time.sleep(timeout)
+            return False
+        time.sleep(max(0, delay))
+        return True
+
+    def _release_pods(self, namespace: str, name: str) -> list[str]:
+        with self._state(write=False) as state:
+            return [
+                k
+                for k, pod in state["pods"].items()
+                if pod["namespace"] == namespace and pod["release"] == name
+            ]
+
+    def install(
+        self,
+        name: str,
+        chart: str,
+        namespace: str,
+        values: dict[str, Any],
+        *,
+        wait: bool = False,
+    ) -> dict[str, Any]:
+        """
+        Install a release.
+
+        :raises ValueError:
+            If the release already exists.
+
+        """
+        app = chart.rsplit("/", 1)[-1]
+        if app == EXAMPLE_RELEASE:
+            components = ["xrd1", "xrd2"]
+        else:
+            components = [app]
+        with self._state() as state:
+            key = f"{namespace}/{name}"
+            if key in state["releases"]:
+                raise ValueError(
+                    f"cannot re-use a name that is still in use: {name}"
+                )
+            release = {
+                "name": name,
+                "namespace": namespace,
+                "chart": app,
+                "app": app if app != EXAMPLE_RELEASE else "xrd-vrouter",
+                "components": components,
+                "version": 1,
+                "status": "deployed",
+                "config": values,
+                "resource_version": str(state["resource_version"]),
+            }
+            state["releases"][key] = release
+            self._create_pods(state, release)
+        if wait:
+            self._wait_ready(self._release_pods(namespace, name), 300)
+        return release
+
+    def upgrade(
+        self,
+        name: str,
+        namespace: str,
+        values: dict[str, Any],
+        *,
+        reuse_values: bool = False,
+        wait: bool = False,
+    ) -> dict[str, Any]:
+        """
+        Upgrade a release, restarting its pods.
+
+        :raises ValueError:
+            If the release doesn't exist.
+
+        """
+        with self._state() as state:
+            release = state["releases"].get(f"{namespace}/{name}")
+            if release is None:
+                raise ValueError(f'"{name}" has no deployed releases')
+            if reuse_values:
+                values = _merge(release["config"], values)
+            release["config"] = values
+            release["version"] += 1
+            release["resource_version"] = str(state["resource_version"])
+            self._delete_pods(state, namespace, name)
+            self._create_pods(state, release)
+        if wait:
+            self._wait_ready(self._release_pods(namespace, name), 300)
+        return release
+
+    def uninstall(self, name: str, namespace: str, *, wait: bool = False):
+        """
+        Uninstall a release.
+
+        :raises ValueError:
+            If the release doesn't exist.
+
+        """
+        with self._state() as state:
+            if state["releases"].pop(f"{namespace}/{name}", None) is None:
+                raise ValueError(f"uninstall: Release not loaded: {name}")
+            self._delete_pods(state, namespace, name)
+        if wait:
+            time.sleep(self.latencies.pod_terminate)
+
+    def releases(self, namespace: str) -> list[dict[str, Any]]:
+        with self._state(write=False) as state:
+            return sorted(
+                (
+                    r
+                    for r in state["releases"].values()
+                    if r["namespace"] == namespace
+                ),
+                key=lambda r: r["name"],
+            )
+
+    def release(self, name: str, namespace: str) -> dict[str, Any]:
+        """
+        :raises ValueError:
+            If the release doesn't exist.
+
+        """
+        with self._state(write=False) as state:
+            release = state["releases"].get(f"{namespace}/{name}")
+        if release is None:
+            raise ValueError("release: not found")
+        return release
+
+    def restart_pod(self, name: str, namespace: str, *, wait: bool = False):
+        """
+        Delete a pod, which is then recreated (as by its StatefulSet).
+
+        :raises ValueError:
+            If the pod doesn't exist.
+
+        """
+        with self._state() as state:
+            pod = state["pods"].get(f"{namespace}/{name}")
+            if pod is None:
+                raise ValueError(f'pods "{name}" not found')
+            release = state["releases"][f"{namespace}/{pod['release']}"]
+            now = time.time() + self.latencies.pod_terminate
+            pod.update(
+                uid=str(uuid.uuid4()),
+                created=now,
+                ready=now + self.latencies.pod_start,
+            )
+            if not release["config"].get("persistence", {}).get("enabled"):
+                state["files"].pop(f"{namespace}/{name}", None)
+        if wait:
+            time.sleep(self.latencies.pod_terminate)
+
+    def wait_pod_ready(self, name: str, namespace: str, timeout: float):
+        """
+        Wait for a pod to be Ready.
+
+        :returns:
+            Whether the pod became Ready before the timeout.
+
+        """
+        return self._wait_ready([f"{namespace}/{name}"], timeout)
+
+    def pods(self, namespace: Optional[str] = None) -> list[dict[str, Any]]:
+        with self._state(write=False) as state:
+            return [
+                pod
+                for pod in state["pods"].values()
+                if namespace is None or pod["namespace"] == namespace
+            ]
+
+    # -------------------------------------------------------------------------
+    # Commands in pods.
+
+    def exec(
+        self, name: str, namespace: str, command: list[str]
+    ) -> tuple[int, str, str]:
+        """
+        Run a command in a pod.
+
+        :raises PodNotReady:
+            If the pod doesn't exist or isn't Ready.
+
+        :returns:
+            The exit status, stdout and stderr.
+
+        """
+        time.sleep(self.latencies.exec)
+        key = f"{namespace}/{name}"
+        with self._state(write=False) as state:
+            pod = state["pods"].get(key)
+            if pod is None or time.time() < pod["ready"]:
+                raise PodNotReady(f"Pod {key} is not ready")
+            release = state["releases"][f"{namespace}/{pod['release']}"]
+            files = state["files"].get(key, {})
+
+        if command[:1] == ["xrenv"]:
+            command = command[1:]
+        if command[:1] == ["hostname"]:
+            ascii = release["config"].get("config", {}).get("ascii", "")
+            m = re.search(r"^hostname (\S+)", ascii, re.MULTILINE)
+            return 0, f"{m.group(1) if m else name}\n", ""
+        if command[:1] == ["ping"] and len(command) > 1:
+            return 0, _ping_output(command[1]), ""
+        if command[:1] == ["bgp_show"]:
+            up = time.time() - pod["ready"] - self.latencies.bgp_establish
+            return 0, _bgp_output(pod, release, up), ""
+        if command[:1] == ["sysmgr_show"]:
+            return 0, "No process aborts found\n", ""
+        if command[:2] == ["/bin/bash", "-c"] and len(command) == 3:
+            return self._shell(key, files, command[2])
+        return 127, "", f"{command[0]}: command not found\n"
+
+    def _shell(
+        self, key: str, files: dict[str, str], script: str
+    ) -> tuple[int, str, str]:
+        """Run the shell scripts used by the tests (redirected echo, cat)."""
+        args = shlex.split(script)
+        if args[:1] == ["echo"] and len(args) >= 3 and args[-2] == ">":
+            with self._state() as state:
+                state["files"].setdefault(key, {})[args[-1]] = (
+                    " ".join(args[1:-2]) + "\n"
+                )
+            return 0, "", ""
+        if args[:1] == ["cat"] and len(args) == 2:
+            if args[1] not in files:
+                return 1, "", f"cat: {args[1]}: No such file or directory\n"
+            return 0, files[args[1]], ""
+        return 127, "", f"bash: {script}: not supported by the fake cluster\n"
+
+    def run_in_pod(
+        self,
+        pod_name: str,
+        *command: str,
+        namespace: str = "default",
+        timeout: float = 30,
+        check: bool = True,
+        log_output: bool = False,
+    ) -> subprocess.CompletedProcess[str]:
+        """
+        Run a command in a pod, as `PodShellPool.run`.
+
+        :raises ConnectionError:
+            If the pod isn't Ready.
+
+        """
+        try:
+            rc, stdout, stderr = self.exec(pod_name, namespace, list(command))
+        except PodNotReady as e:
+            raise ConnectionError(str(e)) from e
+        p = subprocess.CompletedProcess(
+            list(command), rc, stdout=stdout, stderr=stderr
+        )
+        if check:
+            p.check_returncode()
+        return p
+
+
+def _ping_output(address: str) -> str:
+    return (
+        "Sending 5, 100-byte ICMP Echos to %s, timeout is 2 seconds:\n"
+        "!!!!!\n"
+        "Success rate is 100 percent (5/5), round-trip min/avg/max = 1/1/2 "
+        "ms\n" % address
+    )
+
+
+def _bgp_output(
+    pod: dict[str, Any], release: dict[str, Any], up: float
+) -> str:
+    """
+    Return ``bgp_show -n -br`` output with a session to each other XRd in the
+    release, whose loopback is 1.0.0.1<n> for component 'xrd<n>'.
+
+    """
+    lines = [
+        "Neighbor        Spk    AS Description                          "
+        "Up/Down  NBRState"
+    ]
+    for component in release["components"]:
+        if f"-{component}-" in pod["name"] or not component[-1:].isdigit():
+            continue
+        if up >= 0:
+            up_down = time.strftime("%H:%M:%S", time.gmtime(up))
+            state = "Established"
+        else:
+            up_down, state = "never", "Active"
+        lines.append(
+            f"1.0.0.1{component[-1]:<8}  0     1{'':38} {up_down} {state}"
+        )
+    return "\n".join(lines) + "\n"
+
+
+def _timestamp(t: float) -> datetime.datetime:
+    return datetime.datetime.fromtimestamp(t, datetime.timezone.utc)
+
+
+def _attached(pod: dict[str, Any]) -> float:
+    """When a pod's volume is attached: a quarter of the way to Ready."""
+    return pod["created"] + (pod["ready"] - pod["created"]) / 4
+
+
+def _started(pod: dict[str, Any]) -> float:
+    """When a pod's container is started: half way to Ready."""
+    return pod["created"] + (pod["ready"] - pod["created"]) / 2
+
+
+class FakeCoreV1Api:
+    """
+    A stand-in for `kubernetes.client.CoreV1Api`, implementing the calls used
+    by the test harness.  Objects are returned as `SimpleNamespace` objects
+    with the attributes the harness uses.
+
+    """
+
+    def __init__(self, cluster: FakeCluster):
+        self._cluster = cluster
+
+    def _pod(self, pod: dict[str, Any]) -> SimpleNamespace:
+        now = time.time()
+        ready = now >= pod["ready"]
+        started = now >= _started(pod)
+        limits = {}
+        if pod["hugepages_gi"]:
+            limits["hugepages-1Gi"] = f"{pod['hugepages_gi']}Gi"
+        return SimpleNamespace(
+            metadata=SimpleNamespace(
+                name=pod["name"],
+                namespace=pod["namespace"],
+                uid=pod["uid"],
+                creation_timestamp=_timestamp(pod["created"]),
+                labels={
+                    "app.kubernetes.io/name": pod["app"],
+                    "app.kubernetes.io/instance": pod["release"],
+                },
+            ),
+            spec=SimpleNamespace(
+                node_name=pod["node"],
+                containers=[
+                    SimpleNamespace(
+                        name="main",
+                        resources=SimpleNamespace(
+                            requests=limits, limits=limits
+                        ),
+                    )
+                ],
+            ),
+            status=SimpleNamespace(
+                phase="Running" if started else "Pending",
+                conditions=[
+                    SimpleNamespace(
+                        type="PodScheduled",
+                        status="True",
+                        last_transition_time=_timestamp(pod["created"]),
+                    ),
+                    SimpleNamespace(
+                        type="Ready",
+                        status=str(ready),
+                        last_transition_time=_timestamp(
+                            pod["ready"] if ready else pod["created"]
+                        ),
+                    ),
+                ],
+                container_statuses=[
+                    SimpleNamespace(
+                        ready=ready,
+                        state=SimpleNamespace(
+                            running=(
+                                SimpleNamespace(
+                                    started_at=_timestamp(_started(pod))
+                                )
+                                if started
+                                else None
+                            )
+                        ),
+                    )
+                ],
+            ),
+        )
+
+    def _list(self, items: list[Any]) -> SimpleNamespace:
+        with self._cluster._state(write=False) as state:
+            version = str(state["resource_version"])
+        return SimpleNamespace(
+            items=items, metadata=SimpleNamespace(resource_version=version)
+        )
+
+    def list_namespaced_pod(
+        self,
+        namespace: str,
+        *,
+        label_selector: Optional[str] = None,
+        field_selector: Optional[str] = None,
+        watch: bool = False,
+        **kwargs,
+    ) -> SimpleNamespace:
+        if watch:
+            raise NotImplementedError("Watches aren't supported")
+        pods = [self._pod(p) for p in self._cluster.pods(namespace)]
+        name = None
+        if field_selector and field_selector.startswith("metadata.name="):
+            name = field_selector.partition("=")[2]
+        return self._list(
+            [
+                p
+                for p in pods
+                if _match_labels(p.metadata.labels, label_selector)
+                and (name is None or p.metadata.name == name)
+            ]
+        )
+
+    def read_namespaced_pod(
+        self, name: str, namespace: str, **kwargs
+    ) -> SimpleNamespace:
+        for pod in self._cluster.pods(namespace):
+            if pod["name"] == name:
+                return self._pod(pod)
+        raise ValueError(f'pods "{name}" not found')
+
+    def list_namespaced_event(
+        self,
+        namespace: str,
+        *,
+        field_selector: Optional[str] = None,
+        **kwargs,
+    ) -> SimpleNamespace:
+        """List the events of pods, which are generated from their state."""
+        uid = None
+        if field_selector and field_selector.startswith("involvedObject.uid="):
+            uid = field_selector.partition("=")[2]
+        now = time.time()
+        events = []
+        for pod in self._cluster.pods(namespace):
+            if uid is not None and pod["uid"] != uid:
+                continue
+            reasons = [("Scheduled", pod["created"])]
+            if pod["persistent"]:
+                reasons.append(("SuccessfulAttachVolume", _attached(pod)))
+            reasons.append(("Started", _started(pod)))
+            events.extend(
+                SimpleNamespace(
+                    metadata=SimpleNamespace(creation_timestamp=_timestamp(t)),
+                    involved_object=SimpleNamespace(
+                        name=pod["name"], uid=pod["uid"]
+                    ),
+                    reason=reason,
+                    event_time=None,
+                    first_timestamp=_timestamp(t),
+                )
+                for reason, t in reasons
+                if t <= now
+            )
+        return self._list(events)
+
+    def list_pod_for_all_namespaces(self, **kwargs) -> SimpleNamespace:
+        return self._list([self._pod(p) for p in self._cluster.pods()])
+
+    def list_node(self, **kwargs) -> SimpleNamespace:
+        with self._cluster._state(write=False) as state:
+            nodes = state["nodes"]
+        return self._list(
+            [
+                SimpleNamespace(
+                    metadata=SimpleNamespace(name=name),
+                    spec=SimpleNamespace(unschedulable=None),
+                    status=SimpleNamespace(
+                        allocatable={
+                            "hugepages-1Gi": f"{node['hugepages_gi']}Gi"
+                        }
+                    ),
+                )
+                for name, node in nodes.items()
+            ]
+        )
+
+    def list_namespaced_secret(
+        self, namespace: str, *, label_selector: Optional[str] = None
+    ) -> SimpleNamespace:
+        secrets = []
+        for r in self._cluster.releases(namespace):
+            labels = {
+                "owner": "helm",
+                "name": r["name"],
+                "status": r["status"],
+                "version": str(r["version"]),
+            }
+            if not _match_labels(labels, label_selector):
+                continue
+            data = {
+                "name": r["name"],
+                "namespace": namespace,
+                "version": r["version"],
+                "info": {"status": r["status"]},
+                "chart": {
+                    "metadata": {"name": r["chart"], "version": "0.0.0"},
+                    "values": {},
+                },
+                "config": r["config"],
+            }
+            secrets.append(
+                SimpleNamespace(
+                    metadata=SimpleNamespace(
+                        name=f"sh.helm.release.v1.{r['name']}.v{r['version']}",
+                        labels=labels,
+                        resource_version=r["resource_version"],
+                    ),
+                    data={"release": _encode_release(data)},
+                )
+            )
+        return self._list(secrets)
+
+    def create_namespace(self, body: Any, **kwargs) -> None:
+        with self._cluster._state() as state:
+            if body.metadata.name not in state["namespaces"]:
+                state["namespaces"].append(body.metadata.name)
+
+    def delete_namespace(self, name: str, **kwargs) -> None:
+        with self._cluster._state() as state:
+            if name in state["namespaces"]:
+                state["namespaces"].remove(name)
+            for key in [k for k in state["releases"] if k.startswith(name)]:
+                del state["releases"][key]
+            for key in [k for k in state["pods"] if k.startswith(name)]:
+                del state["pods"][key]
+
+
+class FakeStorageV1Api:
+    """
+    A stand-in for `kubernetes.client.StorageV1Api`, implementing the calls
+    used by the test harness.
+
+    """
+
+    def __init__(self, cluster: FakeCluster):
+        self._cluster = cluster
+
+    def list_storage_class(self, **kwargs) -> SimpleNamespace:
+        with self._cluster._state(write=False) as state:
+            names = state["storage_classes"]
+        return SimpleNamespace(
+            items=[
+                SimpleNamespace(metadata=SimpleNamespace(name=name))
+                for name in names
+            ]
+        )
+
+    def create_storage_class(self, body: Any, **kwargs) -> None:
+        with self._cluster._state() as state:
+            if body.metadata.name not in state["storage_classes"]:
+                state["storage_classes"].append(body.metadata.name)
+
+
+# -----------------------------------------------------------------------------
+# Fake executables.
+
+
+def _pop_flag(args: list[str], flag: str) -> bool:
+    if flag in args:
+        args.remove(flag)
+        return True
+    return False
+
+
+def _pop_option(args: list[str], option: str) -> list[str]:
+    """Remove all instances of an option, returning their values."""
+    values = []
+    i = 0
+    while i < len(args):
+        if args[i] == option:
+            values.append(args[i + 1])
+            del args[i : i + 2]
+        elif args[i].startswith(f"{option}="):
+            values.append(args[i].partition("=")[2])
+            del args[i]
+        else:
+            i += 1
+    return values
+
+
+def _open_cluster() -> FakeCluster:
+    return FakeCluster(Path(os.environ[STATE_DIR_ENV]))
+
+
+def helm_main(argv: list[str]) -> int:
+    """Implement the ``helm`` subcommands used by the `Helm` wrapper."""
+    cluster = _open_cluster()
+    time.sleep(cluster.latencies.helm)
+    args = list(argv)
+    namespace = (_pop_option(args, "--namespace") or ["default"])[-1]
+    _pop_option(args, "--kubeconfig")
+    output_json = (_pop_option(args, "--output") or [""])[-1] == "json"
+    wait = _pop_flag(args, "--wait")
+    dry_run = _pop_flag(args, "--dry-run")
+    values = {}
+    for arg in _pop_option(args, "--set-json"):
+        values = _merge(values, _parse_set_json(arg))
+    for fname in _pop_option(args, "--values"):
+        # Only JSON values files are supported (JSON is valid YAML).
+        values = _merge(values, json.loads(Path(fname).read_text() or "{}"))
+    for flag in ("--dependency-update", "--devel", "--force-update"):
+        _pop_flag(args, flag)
+
+    try:
+        if args[:2] == ["repo", "add"]:
+            print(f'"{args[2]}" has been added to your repositories')
+        elif args[:1] == ["install"]:
+            if _pop_flag(args, "--generate-name"):
+                chart = args[1]
+                name = f"{chart.rsplit('/', 1)[-1]}-{int(time.time())}"
+            else:
+                name, chart = args[1:3]
+            if dry_run:
+                release = {"name": name, "namespace": namespace}
+            else:
+                release = cluster.install(
+                    name, chart, namespace, values, wait=wait
+                )
+            if output_json:
+                print(json.dumps(_status(release)))
+        elif args[:1] == ["upgrade"]:
+            reuse_values = _pop_flag(args, "--reuse-values")
+            _pop_flag(args, "--reset-values")
+            if not dry_run:
+                cluster.upgrade(
+                    args[1],
+                    namespace,
+                    values,
+                    reuse_values=reuse_values,
+                    wait=wait,
+                )
+        elif args[:1] == ["uninstall"]:
+            if not dry_run:
+                cluster.uninstall(args[1], namespace, wait=wait)
+            print(f'release "{args[1]}" uninstalled')
+        elif args[:1] == ["list"]:
+            pattern = (_pop_option(args, "--filter") or [None])[-1]
+            print(
+                json.dumps(
+                    [
+                        {
+                            "name": r["name"],
+                            "namespace": namespace,
+                            "revision": str(r["version"]),
+                            "status": r["status"],
+                            "chart": f"{r['chart']}-0.0.0",
+                        }
+                        for r in cluster.releases(namespace)
+                        if pattern is None or re.search(pattern, r["name"])
+                    ]
+                )
+            )
+        elif args[:1] == ["status"]:
+            print(json.dumps(_status(cluster.release(args[1], namespace))))
+        elif args[:2] == ["get", "values"]:
+            print(json.dumps(cluster.release(args[2], namespace)["config"]))
+        else:
+            print(f"Error: unsupported command: {argv}", file=sys.stderr)
+            return 1
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+def _status(release: dict[str, Any]) -> dict[str, Any]:
+    return {
+        "name": release["name"],
+        "namespace": release["namespace"],
+        "version": release.get("version", 1),
+        "info": {"status": release.get("status", "pending-install")},
+        "config": release.get("config", {}),
+    }
+
+
+def kubectl_main(argv: list[str]) -> int:
+    """Implement the ``kubectl`` subcommands used by the tests."""
+    cluster = _open_cluster()
+    time.sleep(cluster.latencies.kubectl)
+    args = list(argv)
+    namespace = (
+        _pop_option(args, "--namespace") or _pop_option(args, "-n")
+    ) or ["default"]
+    namespace = namespace[-1]
+    wait = _pop_flag(args, "--wait")
+
+    def pod_name(arg: str) -> str:
+        return arg.split("/", 1)[1] if arg.startswith("pod/") else arg
+
+    try:
+        if args[:1] == ["exec"]:
+            command = args[args.index("--") + 1 :]
+            try:
+                rc, stdout, stderr = cluster.exec(
+                    pod_name(args[1]), namespace, command
+                )
+            except PodNotReady as e:
+                print(f"error: {e}", file=sys.stderr)
+                return 1
+            sys.stdout.write(stdout)
+            sys.stderr.write(stderr)
+            return rc
+        if args[:1] == ["delete"]:
+            name = pod_name(args[1])
+            cluster.restart_pod(name, namespace, wait=wait)
+            print(f'pod "{name}" deleted')
+            return 0
+        if args[:1] == ["wait"]:
+            timeout = (_pop_option(args, "--timeout") or ["30s"])[-1]
+            _pop_option(args, "--for")
+            name = pod_name(args[1])
+            if not cluster.wait_pod_ready(
+                name, namespace, float(timeout.rstrip("s"))
+            ):
+                print(
+                    f"error: timed out waiting for the condition on pods/"
+                    f"{name}",
+                    file=sys.stderr,
+                )
+                return 1
+            print(f"pod/{name} condition met")
+            return 0
+        if args[:2] == ["get", "pods"]:
+            for pod in cluster.pods(namespace):
+                ready = time.time() >= pod["ready"]
+                print(
+                    f"{pod['name']}  {'1/1' if ready else '0/1'}  "
+                    f"{'Running' if ready else 'Pending'}"
+                )
+            return 0
+    except ValueError as e:
+        print(f"Error from server (NotFound): {e}", file=sys.stderr)
+        return 1
+    print(f"error: unsupported command: {argv}", file=sys.stderr)
+    return 1
@@ -5,14 +5,87 @@ __all__ = (
     "Release",
 )
 
+import base64
+import concurrent.futures
 import dataclasses
 import functools
+import gzip
 import inspect
 import json
+import os
+import re
+import threading
+import time
 from pathlib import Path
-from typing import Optional, Union
+from typing import Any, Callable, Iterable, Optional, TypeVar, Union
 
-from . import utils
+import kubernetes.client
+
+from . import timing, utils
+
+
+T = TypeVar("T")
+
+# Statuses of the releases shown by `helm list` by default.
+_LIST_STATUSES = ("deployed", "failed")
+
+
+def _repo_index_age(name: str, url: str) -> Optional[float]:
+    """
+    Return the age in seconds of a repository's cached index, or None if the
+    repository isn't configured with the given URL or has no cached index.
+
+    """
+    config_home = Path(
+        os.environ.get("XDG_CONFIG_HOME", Path.home() / ".config")
+    )
+    cache_home = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache"))
+    repo_config = Path(
+        os.environ.get(
+            "HELM_REPOSITORY_CONFIG",
+            config_home / "helm" / "repositories.yaml",
+        )
+    )
+    repo_cache = Path(
+        os.environ.get(
+            "HELM_REPOSITORY_CACHE", cache_home / "helm" / "repository"
+        )
+    )
+    try:
+        if f"url: {url}\n" not in repo_config.read_text():
+            return None
+        return (
+            time.time() - (repo_cache / f"{name}-index.yaml").stat().st_mtime
+        )
+    except OSError:
+        return None
+
+
+def _decode_release(secret: kubernetes.client.V1Secret) -> dict[str, Any]:
+    """
+    Decode a Helm v3 release Secret.
+
+    The release is stored as JSON, gzipped (by default) and base64 encoded
+    by Helm, and then base64 encoded again as Secret data.
+
+    """
+    data = base64.b64decode(base64.b64decode(secret.data["release"]))
+    if data[:2] == b"\x1f\x8b":
+        data = gzip.decompress(data)
+    return json.loads(data)
+
+
+def _merge_values(
+    base: dict[str, Any], override: dict[str, Any]
+) -> dict[str, Any]:
+    """Merge Helm values, as for ``helm get values --all``."""
+    merged = dict(base)
+    for k, v in override.items():
+        if isinstance(v, dict) and isinstance(merged.get(k), dict):
+            merged[k] = _merge_values(merged[k], v)
+        else:
+            merged[k] = v
+    return merged
 
 
 @dataclasses.dataclass
@@ -51,6 +124,20 @@ class Helm:
         Kubernetes namespace.  This is passed as a global flag to all Helm
         subcommands.
 
+    .. attribute:: max_concurrency
+        Maximum number of Helm subcommands run at once by the batch methods,
+        e.g. `uninstall_all`.
+
+    .. attribute:: k8s
+        Kubernetes API client for the same cluster.  If None, all operations
+        run the Helm CLI.
+
+    If a Kubernetes API client is given, the read-only operations (`list`,
+    `status` and `get_values`) decode the Helm release Secrets directly
+    rather than running Helm, which costs one API call rather than a Helm
+    process.  Decoded releases are cached until their Secret changes.  All
+    other operations run the Helm CLI.
+
     """
 
     def __init__(
@@ -58,9 +145,19 @@ class Helm:
         *,
         kubeconfig: Optional[Path] = None,
         namespace: Optional[str] = None,
+        max_concurrency: int = 8,
+        k8s: Optional[kubernetes.client.CoreV1Api] = None,
     ) -> "Helm":
         self.kubeconfig = kubeconfig
         self.namespace = namespace
+        self.max_concurrency = max_concurrency
+        self.k8s = k8s
+        # Decoded releases, by namespace and then Secret name, with the
+        # resourceVersion of the Secret they were decoded from.
+        self._releases: dict[str, dict[str, tuple[str, dict[str, Any]]]] = {}
+        self._releases_lock = threading.Lock()
+        # Repositories added by this instance, by name.
+        self._repos: dict[str, str] = {}
 
     def subcommand(*, name: Union[str, list[str]]):
         """
@@ -78,6 +175,10 @@ class Helm:
             ...     p = yield ["foo", "--bar", "baz"]
             ...     return p.stdout
 
+        If the function returns None, or the generator returns without
+        yielding, Helm is not run; this is used to skip calls which would
+        change nothing.
+
         :param name:
             Name of the subcommand.  For nested subcommands, this is a list of
             strings, e.g. ``name=["foo", "bar"]`` corresponds to the subcommand
@@ -91,7 +192,7 @@ class Helm:
                 if not isinstance(name, list):
                     helm_args = [name]
                 else:
-                    helm_args = name
+                    helm_args = list(name)
 
                 if kubeconfig := kwargs.get("kubeconfig", parent.kubeconfig):
                     helm_args.extend(["--kubeconfig", str(kubeconfig)])
@@ -103,11 +204,24 @@ class Helm:
 
                 if is_generator_func:
                     generator = func(parent, *args, **kwargs)
-                    helm_args.extend(next(generator))
+                    try:
+                        helm_args.extend(next(generator))
+                    except StopIteration as exc:
+                        return exc.value
                 else:
-                    helm_args.extend(func(parent, *args, **kwargs))
-
-                p = utils.run_cmd(["helm", *helm_args], log_output=True)
+                    if (func_args := func(parent, *args, **kwargs)) is None:
+                        return None
+                    helm_args.extend(func_args)
+
+                # Stream the output so progress of long-running commands
+                # (e.g. with --wait) is visible, keeping all of stdout since
+                # it may be parsed.
+                p = utils.run_cmd(
+                    ["helm", *helm_args],
+                    log_output=True,
+                    stream=True,
+                    max_lines=None,
+                )
 
                 if is_generator_func:
                     try:
@@ -133,6 +247,7 @@ class Helm:
         devel: bool = False,
         dry_run: bool = False,
         values: Union[str, list[str], dict[str, str], None] = None,
+        version: Optional[str] = None,
         wait: bool = False,
         **kwargs,
     ) -> Release:
@@ -177,6 +292,9 @@ class Helm:
                 values = [values]
             args.extend(["--values", *values])
 
+        if version is not None:
+            args.extend(["--version", version])
+
         if wait:
             args.append("--wait")
 
@@ -259,7 +377,7 @@ class Helm:
         wait: bool = False,
         **kwargs,
     ) -> None:
-        """Install a Helm chart.  Parameters are per ``helm uninstall``."""
+        """Uninstall a Helm release.  Parameters are per ``helm uninstall``."""
         if isinstance(release, str):
             args = [release]
         else:
@@ -273,27 +391,279 @@ class Helm:
 
         return args
 
+    def _run_concurrently(self, calls: Iterable[Callable[[], T]]) -> list[T]:
+        """
+        Run calls concurrently, at most `max_concurrency` at a time.
+
+        All calls are run to completion, even if some fail.
+
+        :raises Exception:
+            The exception raised by the first call to fail, if any.
+
+        :returns:
+            The results of the calls, in order.
+
+        """
+        calls = list(calls)
+        if not calls:
+            return []
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(self.max_concurrency, len(calls))
+        ) as executor:
+            futures = [executor.submit(call) for call in calls]
+            concurrent.futures.wait(futures)
+        return [future.result() for future in futures]
+
+    def install_many(
+        self, installs: Iterable[dict[str, Any]], **kwargs
+    ) -> list[Release]:
+        """
+        Install several Helm charts concurrently.
+
+        Example usage::
+
+            >>> helm.install_many(
+            ...     [
+            ...         {"chart": "xrd/xrd-vrouter", "name": "xrd1"},
+            ...         {"chart": "xrd/xrd-vrouter", "name": "xrd2"},
+            ...     ],
+            ...     wait=True,
+            ... )
+
+        :param installs:
+            Keyword arguments to `install` for each chart.
+
+        :param kwargs:
+            Keyword arguments to `install` common to all charts.
+
+        :returns:
+            A `Release` for each installed chart, in order.
+
+        """
+        return self._run_concurrently(
+            functools.partial(self.install, **{**kwargs, **install})
+            for install in installs
+        )
+
+    def uninstall_all(
+        self,
+        releases: Optional[Iterable[Union[str, Release]]] = None,
+        **kwargs,
+    ) -> None:
+        """
+        Uninstall several Helm releases concurrently.
+
+        :param releases:
+            Releases to uninstall (default: all releases, per `list`).
+
+        :param kwargs:
+            Keyword arguments to `uninstall`.
+
+        """
+        if releases is None:
+            releases = self.list(
+                **{
+                    k: v
+                    for k, v in kwargs.items()
+                    if k in ("kubeconfig", "namespace")
+                }
+            )
+        self._run_concurrently(
+            functools.partial(self.uninstall, release, **kwargs)
+            for release in releases
+        )
+
+    def _is_native(self, kwargs: dict[str, Any]) -> bool:
+        """
+        Whether releases can be read via the Kubernetes API client, i.e.
+        there is one and it is for the same cluster as the Helm command.
+
+        """
+        return self.k8s is not None and (
+            kwargs.get("kubeconfig", self.kubeconfig) == self.kubeconfig
+        )
+
+    @timing.traced(category="helm")
+    def _read_releases(
+        self, namespace: Optional[str] = None, name: Optional[str] = None
+    ) -> list[dict[str, Any]]:
+        """
+        Read the latest revision of each release from the Helm release
+        Secrets, or just of the given release.
+
+        """
+        namespace = namespace or self.namespace or "default"
+        label_selector = "owner=helm"
+        if name is not None:
+            label_selector += f",name={name}"
+        secrets = self.k8s.list_namespaced_secret(
+            namespace, label_selector=label_selector
+        ).items
+
+        latest = {}
+        for secret in secrets:
+            labels = secret.metadata.labels
+            prev = latest.get(labels["name"])
+            if prev is None or int(labels["version"]) > int(
+                prev.metadata.labels["version"]
+            ):
+                latest[labels["name"]] = secret
+
+        with self._releases_lock:
+            cache = self._releases.setdefault(namespace, {})
+            if name is None:
+                # Drop the releases whose Secrets have been deleted.
+                cache = self._releases[namespace] = {
+                    s.metadata.name: cache[s.metadata.name]
+                    for s in secrets
+                    if s.metadata.name in cache
+                }
+            releases = []
+            for secret in latest.values():
+                version = secret.metadata.resource_version
+                cached = cache.get(secret.metadata.name)
+                if cached is None or cached[0] != version:
+                    cached = (version, _decode_release(secret))
+                    cache[secret.metadata.name] = cached
+                releases.append(cached[1])
+        return releases
+
+    def _read_release(
+        self, name: str, namespace: Optional[str] = None
+    ) -> dict[str, Any]:
+        """
+        Read the latest revision of a release from its Helm release Secrets.
+
+        :raises ValueError:
+            If the release doesn't exist.
+
+        """
+        releases = self._read_releases(namespace, name)
+        if not releases:
+            raise ValueError(f"Release not found: {name}")
+        return releases[0]
+
     @subcommand(name="list")
     def list(
         self,
         *,
         filter: Optional[str] = None,
+        **kwargs,
     ) -> list[Release]:
+        """List Helm releases.  Parameters are per ``helm list``."""
+        if self._is_native(kwargs):
+            releases = [
+                r
+                for r in self._read_releases(kwargs.get("namespace"))
+                if r["info"]["status"] in _LIST_STATUSES
+                and (filter is None or re.search(filter, r["name"]))
+            ]
+            return [
+                Release(
+                    r["name"],
+                    "{name}-{version}".format(**r["chart"]["metadata"]),
+                )
+                for r in sorted(releases, key=lambda r: r["name"])
+            ]
+
         args = ["--output", "json"]
 
         if filter is not None:
-            args.append("--filter", filter)
+            args.extend(["--filter", filter])
 
         p = yield args
         data = json.loads(p.stdout)
 
         return [Release(d["name"], d["chart"]) for d in data]
 
+    @subcommand(name="status")
+    def status(self, release: Union[str, Release], **kwargs) -> dict[str, Any]:
+        """
+        Get the status of a Helm release.
+
+        :returns:
+            The release, per ``helm status --output json``.
+
+        """
+        name = release if isinstance(release, str) else release.name
+
+        if self._is_native(kwargs):
+            return self._read_release(name, kwargs.get("namespace"))
+
+        p = yield [name, "--output", "json"]
+
+        return json.loads(p.stdout)
+
+    @subcommand(name=["get", "values"])
+    def get_values(
+        self,
+        release: Union[str, Release],
+        *,
+        all_values: bool = False,
+        **kwargs,
+    ) -> dict[str, Any]:
+        """
+        Get the values of a Helm release.
+
+        :param all_values:
+            Whether to include the chart's default values, rather than just
+            the user-supplied values.
+
+        :returns:
+            The values, per ``helm get values --output json``.
+
+        """
+        name = release if isinstance(release, str) else release.name
+
+        if self._is_native(kwargs):
+            data = self._read_release(name, kwargs.get("namespace"))
+            values = data.get("config") or {}
+            if all_values:
+                values = _merge_values(
+                    data["chart"].get("values") or {}, values
+                )
+            return values
+
+        args = [name, "--output", "json"]
+
+        if all_values:
+            args.append("--all")
+
+        p = yield args
+
+        return json.loads(p.stdout) or {}
+
     @subcommand(name=["repo", "add"])
-    def repo_add(self, name: str, url: str, *, force_update: bool = False):
+    def repo_add(
+        self,
+        name: str,
+        url: str,
+        *,
+        force_update: bool = False,
+        max_index_age: Optional[float] = None,
+    ):
+        """
+        Add a chart repository.  Parameters are per ``helm repo add``, plus:
+
+        :param max_index_age:
+            If given, skip adding the repository if it is already configured
+            with the same URL and its cached index is younger than this many
+            seconds, even if ``force_update`` is set.
+
+        """
+        if self._repos.get(name) == url and not force_update:
+            return None
+        if max_index_age is not None:
+            age = _repo_index_age(name, url)
+            if age is not None and age < max_index_age:
+                self._repos[name] = url
+                return None
+
         args = [name, url]
 
         if force_update:
             args.append("--force-update")
 
-        return args
+        _ = yield args
+
+        self._repos[name] = url
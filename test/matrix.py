@@ -0,0 +1,241 @@
+# matrix.py
+
+"""
+Run the tests against a matrix of AWS regions and Kubernetes versions.
+
+One pytest process is run per (region, version) cell, all at the same time,
+so the whole matrix takes about as long as the slowest cell.  Each cell
+brings up its own stack, with its own EKS cluster name and kubeconfig so the
+cells don't interfere.  The cells' JUnit XML reports are merged into one,
+with each test suite and test case labelled with its cell.
+
+Example usage::
+
+    python matrix.py                                        \\
+        --aws-region us-east-1 us-west-2                    \\
+        --eks-kubernetes-version 1.23 1.24                  \\
+        --junitxml results.xml                              \\
+        --                                                  \\
+        --xrd-vrouter-repository $REGISTRY/xrd/xrd-vrouter
+
+Arguments after ``--`` are passed to every pytest process.
+
+"""
+
+import argparse
+import dataclasses
+import itertools
+import os
+import subprocess
+import sys
+import time
+import xml.etree.ElementTree as ET
+from pathlib import Path
+from typing import Optional
+
+
+TEST_DIR = Path(__file__).resolve().parent
+
+
+@dataclasses.dataclass
+class Cell:
+    """A (region, version) cell of the matrix, and its results."""
+
+    region: str
+    version: str
+    output_dir: Path
+    returncode: Optional[int] = None
+    duration: float = 0
+
+    @property
+    def name(self) -> str:
+        return f"{self.region}-{self.version}"
+
+    @property
+    def cluster_name(self) -> str:
+        return f"xrd-cluster-{self.version.replace('.', '-')}"
+
+    @property
+    def junitxml(self) -> Path:
+        return self.output_dir / f"{self.name}.xml"
+
+    def pytest_args(self) -> list[str]:
+        return [
+            "--aws-region",
+            self.region,
+            "--eks-kubernetes-version",
+            self.version,
+            "--eks-cluster-name",
+            self.cluster_name,
+            "--junitxml",
+            str(self.junitxml),
+            "--log-file",
+            str(self.output_dir / f"{self.name}.log"),
+            "--log-file-level",
+            "debug",
+        ]
+
+
+def run_cells(cells: list[Cell], pytest_args: list[str]) -> None:
+    """Run pytest for all cells concurrently, and wait for them to finish."""
+    procs = []
+    for cell in cells:
+        env = {
+            **os.environ,
+            # Separate kubeconfig per cell, since 'aws eks update-kubeconfig'
+            # also sets the current context.
+            "KUBECONFIG": str(cell.output_dir / f"{cell.name}.kubeconfig"),
+        }
+        out = open(cell.output_dir / f"{cell.name}.out", "w")
+        print(f"[{cell.name}] Starting, output in {out.name}")
+        procs.append(
+            (
+                cell,
+                subprocess.Popen(
+                    [
+                        sys.executable,
+                        "-m",
+                        "pytest",
+                        *cell.pytest_args(),
+                        *pytest_args,
+                    ],
+                    cwd=TEST_DIR,
+                    env=env,
+                    stdin=subprocess.DEVNULL,
+                    stdout=out,
+                    stderr=subprocess.STDOUT,
+                ),
+                out,
+                time.monotonic(),
+            )
+        )
+
+    # Poll rather than wait for each in turn, so each cell's duration is
+    # recorded when it actually finishes.
+    while procs:
+        time.sleep(1)
+        for cell, proc, out, start in list(procs):
+            if proc.poll() is None:
+                continue
+            cell.returncode = proc.returncode
+            cell.duration = time.monotonic() - start
+            out.close()
+            procs.remove((cell, proc, out, start))
+            print(
+                f"[{cell.name}] Finished with exit code {cell.returncode} "
+                f"after {cell.duration:.0f}s"
+            )
+
+
+def merge_reports(cells: list[Cell], fname: Path) -> None:
+    """
+    Merge the cells' JUnit XML reports into one, labelling each test suite
+    and test case with its cell.
+
+    """
+    merged = ET.Element("testsuites")
+    for cell in cells:
+        try:
+            root = ET.parse(cell.junitxml).getroot()
+        except (OSError, ET.ParseError):
+            # The cell failed before writing a report, e.g. in bringup.
+            suite = ET.SubElement(
+                merged,
+                "testsuite",
+                name=cell.name,
+                tests="1",
+                errors="1",
+                failures="0",
+                skipped="0",
+            )
+            case = ET.SubElement(
+                suite, "testcase", classname=cell.name, name="session"
+            )
+            ET.SubElement(
+                case,
+                "error",
+                message=f"pytest exited with code {cell.returncode} and no "
+                "report",
+            )
+            continue
+        suites = [root] if root.tag == "testsuite" else list(root)
+        for suite in suites:
+            suite.set("name", f"{cell.name}.{suite.get('name', 'pytest')}")
+            for case in suite.iter("testcase"):
+                case.set(
+                    "classname", f"{cell.name}.{case.get('classname', '')}"
+                )
+            merged.append(suite)
+
+    for attr in ("tests", "errors", "failures", "skipped"):
+        merged.set(
+            attr,
+            str(sum(int(s.get(attr, 0)) for s in merged.iter("testsuite"))),
+        )
+    ET.ElementTree(merged).write(fname, encoding="utf-8", xml_declaration=True)
+
+
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Run the tests against a matrix of AWS regions and "
+        "Kubernetes versions, concurrently.",
+    )
+    parser.add_argument(
+        "--aws-region",
+        nargs="+",
+        required=True,
+        help="AWS regions in which to run the tests",
+    )
+    parser.add_argument(
+        "--eks-kubernetes-version",
+        nargs="+",
+        required=True,
+        help="Kubernetes control plane versions",
+    )
+    parser.add_argument(
+        "--junitxml",
+        type=Path,
+        default=Path("results.xml"),
+        help="File to write the merged JUnit XML report to (default: "
+        "%(default)s)",
+    )
+    parser.add_argument(
+        "--output-dir",
+        type=Path,
+        default=Path("matrix-results"),
+        help="Directory for each cell's output, logs and report (default: "
+        "%(default)s)",
+    )
+    parser.add_argument(
+        "pytest_args",
+        nargs="*",
+        help="Arguments passed to pytest (after '--')",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    args = parse_args(argv)
+    args.output_dir = args.output_dir.resolve()
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+
+    cells = [
+        Cell(region, version, args.output_dir)
+        for region, version in itertools.product(
+            args.aws_region, args.eks_kubernetes_version
+        )
+    ]
+    run_cells(cells, args.pytest_args)
+    merge_reports(cells, args.junitxml)
+
+    print(f"Merged report written to {args.junitxml}")
+    for cell in cells:
+        print(
+            f"  {cell.name:<24} exit code {cell.returncode}, "
+            f"{cell.duration:.0f}s"
+        )
+    return max(cell.returncode for cell in cells)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,8 +4,55 @@
 import nox
 
 
+# Only run the tests by default; the other sessions are run explicitly.
+nox.options.sessions = ["test"]
+
+
 @nox.session
 def test(session: nox.Session) -> None:
     session.install("--upgrade", "pip")
     session.install("-r", "requirements.txt")
     session.run("pytest", *session.posargs)
+
+
+# Tests which need neither AWS nor a cluster.  These are run in their own
+# environment, since moto's requirements conflict with taskcat's, and without
+# conftest.py, which needs taskcat.
+UNIT_TESTS = [
+    "test_defirqaffinity.py",
+    "test_hugetlb_reserve_pages.py",
+    "test_lambdas.py",
+    "test_publish_s3.py",
+    "test_stack_cache.py",
+    "test_utils.py",
+    "test_xr_output.py",
+]
+
+
+@nox.session
+def unit(session: nox.Session) -> None:
+    session.install("--upgrade", "pip")
+    session.install("-r", "requirements-unit.txt")
+    session.run("pytest", "--noconftest", *UNIT_TESTS, *session.posargs)
+
+
+@nox.session
+def matrix(session: nox.Session) -> None:
+    session.install("--upgrade", "pip")
+    session.install("-r", "requirements.txt")
+    session.run("python", "matrix.py", *session.posargs)
+
+
+@nox.session
+def benchmark(session: nox.Session) -> None:
+    session.install("--upgrade", "pip")
+    session.install("-r", "requirements.txt")
+    session.run(
+        "pytest",
+        "--backend=fake",
+        "--xrd-control-plane-repository=fake/xrd-control-plane",
+        "--xrd-vrouter-repository=fake/xrd-vrouter",
+        "--trace-file=benchmark-trace.json",
+        "--timing-summary=20",
+        *session.posargs,
+    )
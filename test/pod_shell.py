@@ -0,0 +1,310 @@
+# pod_shell.py
+
+__all__ = (
+    "PodShell",
+    "PodShellPool",
+)
+
+import contextlib
+import logging
+import shlex
+import subprocess
+import threading
+import time
+import uuid
+from typing import Iterator, Optional
+
+import kubernetes.client
+import kubernetes.stream
+
+
+logger = logging.getLogger(__name__)
+
+
+class PodShell:
+    """
+    A long-lived interactive shell in a pod's container.
+
+    Running a command with ``kubectl exec`` costs a process fork, kubeconfig
+    parsing, an API handshake and a websocket upgrade.  A `PodShell` pays
+    these once, and then runs each command by writing it to the shell's
+    stdin, followed by a unique marker which delimits the command's output and
+    exit status.
+
+    Commands are run one at a time; concurrent callers are serialized.  Use
+    a `PodShellPool` to run commands in the same pod concurrently.
+
+    Example usage::
+
+        >>> shell = PodShell(k8s, "xrd-xrd-vrouter-0")
+        >>> p = shell.run(["xrenv", "ping", "10.0.0.1"])
+        >>> shell.close()
+
+    .. attribute:: pod_name
+        Name of the pod.
+
+    .. attribute:: namespace
+        Namespace of the pod.
+
+    """
+
+    def __init__(
+        self,
+        k8s: kubernetes.client.CoreV1Api,
+        pod_name: str,
+        namespace: str = "default",
+        *,
+        container: Optional[str] = None,
+        shell: str = "/bin/sh",
+    ):
+        self.pod_name = pod_name
+        self.namespace = namespace
+        # `kubernetes.stream.stream` swaps out its client's ``call_api`` while
+        # connecting, which isn't thread-safe, so each shell has its own
+        # client rather than sharing one with other shells and REST calls.
+        self._k8s = kubernetes.client.CoreV1Api(
+            kubernetes.client.ApiClient(k8s.api_client.configuration)
+        )
+        self._container = container
+        self._shell = shell
+        self._lock = threading.Lock()
+        self._resp = None
+
+    def _connect(self) -> None:
+        logger.debug(
+            "Opening shell in pod %s/%s", self.namespace, self.pod_name
+        )
+        kwargs = {}
+        if self._container is not None:
+            kwargs["container"] = self._container
+        try:
+            self._resp = kubernetes.stream.stream(
+                self._k8s.connect_post_namespaced_pod_exec,
+                self.pod_name,
+                self.namespace,
+                command=[self._shell],
+                stdin=True,
+                stdout=True,
+                stderr=True,
+                tty=False,
+                _preload_content=False,
+                **kwargs,
+            )
+        except kubernetes.client.ApiException as e:
+            raise ConnectionError(
+                f"Failed to open shell in pod {self.namespace}/"
+                f"{self.pod_name}: {e.status} {e.reason}"
+            ) from e
+
+    def is_open(self) -> bool:
+        return self._resp is not None and self._resp.is_open()
+
+    def close(self) -> None:
+        """Close the shell.  It is reopened if another command is run."""
+        if self._resp is not None:
+            self._resp.close()
+            self._resp = None
+
+    def run(
+        self,
+        command: list[str],
+        *,
+        timeout: float = 30,
+        check: bool = True,
+        log_output: bool = False,
+    ) -> subprocess.CompletedProcess[str]:
+        """
+        Run a command in the shell.
+
+        :param command:
+            The command to run.
+
+        :param timeout:
+            Maximum time to wait for the command in seconds.  On timeout the
+            shell is closed, since it is still running the command.
+
+        :param check:
+            Whether to raise if the command returns non-zero exit status.
+
+        :param log_output:
+            Whether to log the output.
+
+        :raises subprocess.CalledProcessError:
+            If ``check`` is set and the command returns non-zero exit status.
+
+        :raises subprocess.TimeoutExpired:
+            If the command times out.
+
+        :raises ConnectionError:
+            If the shell can't be opened, or closes while running the command.
+
+        :returns:
+            A completed process object, as from `utils.run_cmd`.
+
+        """
+        with self._lock:
+            if not self.is_open():
+                self._connect()
+            try:
+                p = self._run(command, timeout)
+            except BaseException:
+                self.close()
+                raise
+
+        if log_output:
+            logger.debug("Command stdout:\n%s", p.stdout.strip("\n"))
+            logger.debug("Command stderr:\n%s", p.stderr.strip("\n"))
+        if check:
+            p.check_returncode()
+        return p
+
+    def _run(
+        self, command: list[str], timeout: float
+    ) -> subprocess.CompletedProcess[str]:
+        logger.debug(
+            "Running command in pod %s/%s: %r",
+            self.namespace,
+            self.pod_name,
+            shlex.join(command),
+        )
+        marker = f"__pod_shell_{uuid.uuid4().hex}__"
+        # Output a newline before each marker so it is at the start of a line
+        # even if the command's output isn't newline terminated.  Redirect the
+        # command's stdin so it can't consume the rest of the stream.
+        self._resp.write_stdin(
+            f"{shlex.join(command)} </dev/null; "
+            f"printf '\\n{marker} %d\\n' $?; "
+            f"printf '\\n{marker}\\n' >&2\n"
+        )
+
+        deadline = time.monotonic() + timeout
+        stdout = stderr = ""
+        stdout_end = stderr_end = -1
+        while stdout_end < 0 or stderr_end < 0:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise subprocess.TimeoutExpired(
+                    command, timeout, output=stdout, stderr=stderr
+                )
+            if not self._resp.is_open():
+                raise ConnectionError(
+                    f"Shell in pod {self.namespace}/{self.pod_name} closed"
+                )
+            self._resp.update(timeout=min(remaining, 1))
+            if self._resp.peek_stdout():
+                stdout += self._resp.read_stdout()
+                stdout_end = stdout.find(f"\n{marker} ")
+                # Wait for the whole exit status line.
+                if stdout_end >= 0 and "\n" not in stdout[stdout_end + 1 :]:
+                    stdout_end = -1
+            if self._resp.peek_stderr():
+                stderr += self._resp.read_stderr()
+                stderr_end = stderr.find(f"\n{marker}\n")
+
+        status = stdout[stdout_end:].split()[1]
+        return subprocess.CompletedProcess(
+            command,
+            int(status),
+            stdout=stdout[:stdout_end],
+            stderr=stderr[:stderr_end],
+        )
+
+
+class PodShellPool:
+    """
+    A pool of `PodShell` objects, opened on first use.
+
+    Each command is run in an idle shell in the pod, so concurrent commands in
+    the same pod (e.g. checks run with `utils.run_checks`) run in parallel,
+    each in its own shell.  Up to ``max_shells_per_pod`` shells are opened per
+    pod, after which callers wait for an idle one.
+
+    Example usage::
+
+        >>> pool = PodShellPool(k8s)
+        >>> p = pool.run("xrd-xrd-vrouter-0", "xrenv", "ping", "10.0.0.1")
+        >>> pool.close()
+
+    """
+
+    def __init__(
+        self,
+        k8s: kubernetes.client.CoreV1Api,
+        *,
+        namespace: str = "default",
+        max_shells_per_pod: int = 4,
+    ):
+        self._k8s = k8s
+        self._namespace = namespace
+        self._max_shells_per_pod = max_shells_per_pod
+        # All shells, and the idle ones, by namespace and pod name.
+        self._shells: dict[tuple[str, str], list[PodShell]] = {}
+        self._idle: dict[tuple[str, str], list[PodShell]] = {}
+        self._cond = threading.Condition()
+
+    @contextlib.contextmanager
+    def shell(
+        self, pod_name: str, namespace: Optional[str] = None
+    ) -> Iterator[PodShell]:
+        """
+        Check out an idle shell for a pod, creating one if there is none and
+        the pod has fewer than ``max_shells_per_pod``, or otherwise waiting
+        for one to be returned.
+
+        """
+        key = (namespace or self._namespace, pod_name)
+        with self._cond:
+            while True:
+                shells = self._shells.setdefault(key, [])
+                idle = self._idle.setdefault(key, [])
+                if idle:
+                    shell = idle.pop()
+                    break
+                if len(shells) < self._max_shells_per_pod:
+                    shell = PodShell(self._k8s, pod_name, key[0])
+                    shells.append(shell)
+                    break
+                self._cond.wait()
+        try:
+            yield shell
+        finally:
+            with self._cond:
+                # The pool may have been closed meanwhile.
+                if shell in self._shells.get(key, []):
+                    self._idle[key].append(shell)
+                else:
+                    shell.close()
+                self._cond.notify()
+
+    def run(
+        self,
+        pod_name: str,
+        *command: str,
+        namespace: Optional[str] = None,
+        **kwargs,
+    ) -> subprocess.CompletedProcess[str]:
+        """
+        Run a command in a pod.
+
+        If the shell has closed, e.g. because the pod was restarted, it is
+        reopened once before giving up with `ConnectionError`.
+
+        :param kwargs:
+            Passed through to `PodShell.run`.
+
+        """
+        with self.shell(pod_name, namespace) as shell:
+            try:
+                return shell.run(list(command), **kwargs)
+            except ConnectionError:
+                return shell.run(list(command), **kwargs)
+
+    def close(self) -> None:
+        """Close all shells."""
+        with self._cond:
+            for shells in self._shells.values():
+                for shell in shells:
+                    shell.close()
+            self._shells.clear()
+            self._idle.clear()
+            self._cond.notify_all()
@@ -0,0 +1,248 @@
+# restart_latency.py
+
+"""
+Measurement of how long an XRd pod takes to come back after it is deleted.
+
+Each restart is split into phases using the new pod's conditions, container
+status and events, all timestamped by the cluster:
+
+- ``terminate``: from the delete request until the pod is recreated;
+- ``schedule``: until the pod is scheduled onto a node;
+- ``attach``: until its persistent volume is attached (zero if it has none);
+- ``start``: until its container is started, including mounting volumes and
+  pulling the image;
+- ``ready``: until the pod is Ready, i.e. XR has booted.
+
+Kubernetes timestamps have a resolution of one second, so each phase is only
+accurate to within a second; the ``terminate`` phase is also subject to clock
+skew between the test host and the cluster.
+
+"""
+
+__all__ = (
+    "PHASES",
+    "Restart",
+    "RestartSamples",
+    "ensure_storage_class",
+    "measure_restart",
+    "results",
+)
+
+import array
+import dataclasses
+import datetime
+import logging
+from typing import Optional
+
+import kubernetes.client
+
+from . import timing, xr_output
+from ._types import Kubectl
+
+
+logger = logging.getLogger(__name__)
+
+PHASES = ("terminate", "schedule", "attach", "start", "ready")
+
+# EBS volume types for which a StorageClass is created if there isn't one.
+EBS_VOLUME_TYPES = ("gp2", "gp3", "io1", "io2", "sc1", "st1")
+
+# Provisioned IOPS per GiB of volume for io1 and io2 StorageClasses.
+EBS_IOPS_PER_GB = "50"
+
+
+def ensure_storage_class(
+    storage: kubernetes.client.StorageV1Api, name: str
+) -> None:
+    """
+    Ensure there is a StorageClass, creating one backed by the EBS CSI driver
+    if it is named for an EBS volume type.
+
+    :raises ValueError:
+        If there is no such StorageClass, and it isn't an EBS volume type.
+
+    """
+    if name in (sc.metadata.name for sc in storage.list_storage_class().items):
+        return
+    if name not in EBS_VOLUME_TYPES:
+        raise ValueError(f"No StorageClass {name!r}")
+
+    parameters = {"type": name}
+    if name.startswith("io"):
+        parameters["iopsPerGB"] = EBS_IOPS_PER_GB
+    logger.info("Creating StorageClass %s", name)
+    storage.create_storage_class(
+        kubernetes.client.V1StorageClass(
+            metadata=kubernetes.client.V1ObjectMeta(name=name),
+            provisioner="ebs.csi.aws.com",
+            parameters=parameters,
+            volume_binding_mode="WaitForFirstConsumer",
+        )
+    )
+
+
+@dataclasses.dataclass
+class Restart:
+    """
+    Timestamps of the events in a pod restart.
+
+    .. attribute:: attached
+       When the pod's volume was attached, or None if it has no volume to
+       attach (or the event has expired).
+
+    """
+
+    deleted: datetime.datetime
+    created: datetime.datetime
+    scheduled: datetime.datetime
+    attached: Optional[datetime.datetime]
+    started: datetime.datetime
+    ready: datetime.datetime
+
+    def phases(self) -> dict[str, float]:
+        """Return the duration of each phase, in seconds."""
+        attached = self.attached or self.scheduled
+        times = (
+            self.deleted,
+            self.created,
+            self.scheduled,
+            attached,
+            self.started,
+            self.ready,
+        )
+        return {
+            phase: max(0.0, (end - start).total_seconds())
+            for phase, start, end in zip(PHASES, times, times[1:])
+        }
+
+    @property
+    def total(self) -> float:
+        return (self.ready - self.deleted).total_seconds()
+
+
+def _condition_time(
+    pod: kubernetes.client.V1Pod, condition: str
+) -> datetime.datetime:
+    for c in pod.status.conditions or []:
+        if c.type == condition and c.status == "True":
+            return c.last_transition_time
+    raise ValueError(f"Pod {pod.metadata.name} is not {condition}")
+
+
+def _event_time(event: kubernetes.client.CoreV1Event) -> datetime.datetime:
+    return (
+        event.event_time
+        or event.first_timestamp
+        or event.metadata.creation_timestamp
+    )
+
+
+@timing.traced(category="k8s")
+def measure_restart(
+    k8s: kubernetes.client.CoreV1Api,
+    kubectl: Kubectl,
+    pod_name: str,
+    *,
+    namespace: str = "default",
+    timeout: float = 600,
+) -> Restart:
+    """
+    Delete a pod, wait for it to be recreated and Ready, and return the
+    timestamps of the restart.
+
+    :param kubectl:
+        Function to run a ``kubectl`` command, in ``namespace``.
+
+    :param timeout:
+        Maximum time to wait for the pod to be Ready, in seconds.
+
+    """
+    deleted = datetime.datetime.now(datetime.timezone.utc)
+    kubectl("delete", f"pod/{pod_name}", "--wait")
+    kubectl(
+        "wait",
+        "--for=condition=Ready",
+        f"pod/{pod_name}",
+        f"--timeout={timeout:.0f}s",
+    )
+
+    pod = k8s.read_namespaced_pod(pod_name, namespace)
+    events = k8s.list_namespaced_event(
+        namespace, field_selector=f"involvedObject.uid={pod.metadata.uid}"
+    ).items
+    attached = [
+        _event_time(e) for e in events if e.reason == "SuccessfulAttachVolume"
+    ]
+    restart = Restart(
+        deleted=deleted,
+        created=pod.metadata.creation_timestamp,
+        scheduled=_condition_time(pod, "PodScheduled"),
+        attached=min(attached) if attached else None,
+        started=pod.status.container_statuses[0].state.running.started_at,
+        ready=_condition_time(pod, "Ready"),
+    )
+    logger.info(
+        "Pod %s restarted in %.0fs: %s",
+        pod_name,
+        restart.total,
+        restart.phases(),
+    )
+    return restart
+
+
+class RestartSamples:
+    """
+    A columnar table of pod restarts, with a column of durations per phase.
+
+    Example usage::
+
+        >>> samples = RestartSamples()
+        >>> samples.append(measure_restart(k8s, kubectl, "xrd-xrd-vrouter-0"))
+        >>> samples.percentile("total", 99)
+
+    """
+
+    def __init__(self):
+        self.columns = {
+            phase: array.array("d") for phase in (*PHASES, "total")
+        }
+
+    def __len__(self) -> int:
+        return len(self.columns["total"])
+
+    def append(self, restart: Restart) -> None:
+        for phase, duration in restart.phases().items():
+            self.columns[phase].append(duration)
+        self.columns["total"].append(restart.total)
+
+    def extend(self, columns: dict[str, list[float]]) -> None:
+        """
+        Add the restarts of another table, e.g. from a pytest-xdist worker,
+        given as its columns converted to lists.
+
+        """
+        for phase, durations in columns.items():
+            self.columns[phase].extend(durations)
+
+    def percentile(self, phase: str, q: float) -> float:
+        """Return a percentile of a phase's (or the total) durations."""
+        return xr_output.percentile(self.columns[phase], q)
+
+    def summary(self, quantiles: tuple[float, ...] = (50, 90, 99)) -> str:
+        """Return a table of the percentiles of each phase."""
+        lines = [
+            f"{'phase':<10}"
+            + "".join(f"{'p' + format(q, 'g'):>9}" for q in quantiles)
+        ]
+        for phase in self.columns:
+            lines.append(
+                f"{phase:<10}"
+                + "".join(
+                    f"{self.percentile(phase, q):8.1f}s" for q in quantiles
+                )
+            )
+        return "\n".join(lines)
+
+
+# Restart samples of the test session, by StorageClass.
+results: dict[str, RestartSamples] = {}
@@ -0,0 +1,272 @@
+# sharding.py
+
+"""
+Sharding of tests across pytest-xdist workers on one cluster.
+
+Each worker runs its tests in its own namespace, so Helm releases and pods of
+tests running at the same time don't clash.  Before a test installs XRd it is
+admitted onto a node with enough free capacity (1GiB hugepages, and the
+node's PCI interfaces for tests which use them); if there is none, the test
+waits until a running test releases its reservation.
+
+Reservations are recorded in a ledger file shared by the workers of a test
+run, and updated under a file lock.
+
+"""
+
+__all__ = (
+    "Admission",
+    "Requirements",
+    "Reservation",
+    "run_lock",
+    "worker_id",
+    "worker_namespace",
+)
+
+import contextlib
+import dataclasses
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import Iterator, Optional
+
+import kubernetes.client
+
+
+logger = logging.getLogger(__name__)
+
+# Prefix of the namespaces used by the workers.
+NAMESPACE_PREFIX = "xrd-test-"
+
+# 1GiB hugepages requested by the xrd-vrouter chart by default.
+VROUTER_HUGEPAGES_GI = 3
+
+
+def worker_id() -> Optional[str]:
+    """Return the pytest-xdist worker ID, or None if not running under xdist."""
+    return os.environ.get("PYTEST_XDIST_WORKER")
+
+
+def worker_namespace() -> str:
+    """Return the namespace for this worker's tests."""
+    if (worker := worker_id()) is None:
+        return "default"
+    return f"{NAMESPACE_PREFIX}{worker}"
+
+
+def _run_dir() -> Path:
+    """Return a directory shared by all the workers of this test run."""
+    run_id = os.environ.get("PYTEST_XDIST_TESTRUNUID", str(os.getpid()))
+    path = Path(tempfile.gettempdir()) / f"xrd-eks-test-{run_id}"
+    path.mkdir(exist_ok=True)
+    return path
+
+
+@contextlib.contextmanager
+def run_lock(name: str) -> Iterator[None]:
+    """Hold a lock shared by all the workers of this test run."""
+    with open(_run_dir() / f"{name}.lock", "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _parse_gi(quantity: str) -> int:
+    """Parse a Kubernetes quantity of 1GiB hugepages, e.g. "3Gi"."""
+    if quantity.endswith("Gi"):
+        return int(quantity[:-2])
+    return int(quantity) // 2**30
+
+
+@dataclasses.dataclass
+class Requirements:
+    """
+    Node resources needed by a test.
+
+    .. attribute:: hugepages_gi
+       Number of 1GiB hugepages.
+
+    .. attribute:: pci
+       Whether the test uses the node's PCI interfaces, which can't be shared
+       with another XRd instance.
+
+    """
+
+    hugepages_gi: int = 0
+    pci: bool = False
+
+    def __bool__(self) -> bool:
+        return bool(self.hugepages_gi or self.pci)
+
+
+@dataclasses.dataclass
+class Reservation:
+    """
+    Node resources reserved for a test.
+
+    .. attribute:: node
+       Name of the node the resources are reserved on, or None if the test
+       needs no node resources.
+
+    """
+
+    key: str
+    node: Optional[str]
+    requirements: Requirements
+
+    def node_selector(self) -> dict[str, str]:
+        """Return a node selector to schedule onto the reserved node."""
+        if self.node is None:
+            return {}
+        return {"kubernetes.io/hostname": self.node}
+
+
+class Admission:
+    """
+    Admits tests onto nodes with capacity for them.
+
+    Capacity is the allocatable hugepages of each node, less those requested
+    by pods outside the workers' namespaces (e.g. the quickstart example) and
+    those reserved by other tests.  Nodes running XRd vRouter outside the
+    workers' namespaces are assumed to be using their PCI interfaces.
+
+    Example usage::
+
+        >>> admission = Admission(k8s)
+        >>> reservation = admission.reserve("test_foo", Requirements(3))
+        >>> ...
+        >>> admission.release(reservation)
+
+    """
+
+    def __init__(
+        self,
+        k8s: kubernetes.client.CoreV1Api,
+        *,
+        timeout: float = 3600,
+        interval: float = 10,
+    ):
+        self._k8s = k8s
+        self._timeout = timeout
+        self._interval = interval
+        self._ledger = _run_dir() / "reservations.json"
+
+    def _read_ledger(self) -> dict[str, dict]:
+        try:
+            return json.loads(self._ledger.read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def _write_ledger(self, ledger: dict[str, dict]) -> None:
+        self._ledger.write_text(json.dumps(ledger, indent=2))
+
+    def _free(self, ledger: dict[str, dict]) -> dict[str, Requirements]:
+        """Return the free capacity of each schedulable node."""
+        free = {}
+        for node in self._k8s.list_node().items:
+            if node.spec.unschedulable:
+                continue
+            allocatable = node.status.allocatable or {}
+            hugepages = _parse_gi(allocatable.get("hugepages-1Gi", "0"))
+            if hugepages:
+                free[node.metadata.name] = Requirements(hugepages, pci=True)
+
+        # Pods in the workers' namespaces are accounted for by their
+        # reservations, and this worker's namespace (which is "default"
+        # without pytest-xdist) is cleared before it reserves anything.
+        own_namespace = worker_namespace()
+        for pod in self._k8s.list_pod_for_all_namespaces(
+            field_selector="status.phase!=Succeeded,status.phase!=Failed"
+        ).items:
+            node = free.get(pod.spec.node_name)
+            namespace = pod.metadata.namespace
+            if (
+                node is None
+                or namespace == own_namespace
+                or namespace.startswith(NAMESPACE_PREFIX)
+            ):
+                continue
+            for container in pod.spec.containers:
+                # Hugepage requests must equal limits, so either may be set.
+                resources = container.resources
+                limits = {
+                    **((resources and resources.requests) or {}),
+                    **((resources and resources.limits) or {}),
+                }
+                if hugepages := limits.get("hugepages-1Gi"):
+                    node.hugepages_gi -= _parse_gi(hugepages)
+                    node.pci = False
+
+        for reservation in ledger.values():
+            node = free.get(reservation["node"])
+            if node is not None:
+                node.hugepages_gi -= reservation["hugepages_gi"]
+                node.pci = node.pci and not reservation["pci"]
+
+        return free
+
+    def _try_reserve(
+        self, key: str, requirements: Requirements
+    ) -> Optional[Reservation]:
+        with run_lock("admission"):
+            ledger = self._read_ledger()
+            free = self._free(ledger)
+            candidates = [
+                (name, node)
+                for name, node in free.items()
+                if node.hugepages_gi >= requirements.hugepages_gi
+                and (node.pci or not requirements.pci)
+            ]
+            if not candidates:
+                return None
+            # Prefer nodes whose PCI interfaces are already in use, keeping the
+            # others free for PCI tests, and then the most free hugepages.
+            name, _ = max(
+                candidates,
+                key=lambda c: (not c[1].pci, c[1].hugepages_gi),
+            )
+            ledger[key] = {"node": name, **dataclasses.asdict(requirements)}
+            self._write_ledger(ledger)
+        return Reservation(key, name, requirements)
+
+    def reserve(self, key: str, requirements: Requirements) -> Reservation:
+        """
+        Reserve node resources for a test, waiting until they're available.
+
+        :param key:
+            Unique identifier of the test.
+
+        :raises AssertionError:
+            If the resources aren't available within the timeout.
+
+        """
+        if not requirements:
+            return Reservation(key, None, requirements)
+
+        deadline = time.monotonic() + self._timeout
+        while (reservation := self._try_reserve(key, requirements)) is None:
+            if time.monotonic() > deadline:
+                raise AssertionError(
+                    f"No node has capacity for {requirements} after "
+                    f"{self._timeout}s"
+                )
+            logger.info("Waiting for node capacity for %s", requirements)
+            time.sleep(self._interval)
+
+        logger.info("Reserved %s on node %s", requirements, reservation.node)
+        return reservation
+
+    def release(self, reservation: Reservation) -> None:
+        """Release the resources reserved for a test."""
+        if reservation.node is None:
+            return
+        with run_lock("admission"):
+            ledger = self._read_ledger()
+            ledger.pop(reservation.key, None)
+            self._write_ledger(ledger)
@@ -0,0 +1,345 @@
+# stack_cache.py
+
+"""
+Reuse of CloudFormation stacks across test sessions.
+
+A stack brought up for the tests is tagged with a fingerprint of everything
+that determines its contents: the stack parameters, the Kubernetes version,
+and the resources in the S3 bucket the stack is brought up from (the
+CloudFormation templates, AMI assets and Lambda packages).  A later session
+with the same fingerprint can then reuse the stack rather than bringing up a
+new one.
+
+The fingerprint is of what is published to the bucket rather than of this
+checkout, as that is what the stack (and any update of it) is built from; see
+`unpublished` to find local changes which haven't been published.
+
+The templates are also fingerprinted individually, so that a stack whose
+nested templates (but not its parameters, root template, AMI assets or Lambda
+packages) have changed can be updated in place, which only touches the nested
+stacks whose templates changed.
+
+"""
+
+__all__ = (
+    "FINGERPRINT_TAG",
+    "Fingerprint",
+    "StackMatch",
+    "find_stack",
+    "fingerprint",
+    "unpublished",
+    "update_stack",
+)
+
+import dataclasses
+import hashlib
+import json
+import logging
+from pathlib import Path
+from typing import Any, Iterable, Mapping, Optional
+
+
+logger = logging.getLogger(__name__)
+
+FINGERPRINT_TAG = "xrd-eks:test-fingerprint"
+PARAMETERS_TAG = "xrd-eks:test-parameters"
+ASSETS_TAG = "xrd-eks:test-assets"
+TEMPLATE_TAG_PREFIX = "xrd-eks:template:"
+
+# Statuses of stacks which can be reused (or updated).
+REUSABLE_STATUSES = (
+    "CREATE_COMPLETE",
+    "UPDATE_COMPLETE",
+    "UPDATE_ROLLBACK_COMPLETE",
+)
+
+# Directories of the bucket (under the key prefix) the stack is built from.
+TEMPLATES_DIR = "cf-templates"
+ASSETS_DIRS = ("ami_assets", "functions/packages")
+
+
+def _digest(data: bytes) -> str:
+    # Tag values are limited to 256 characters; a truncated digest is plenty
+    # to identify a configuration.
+    return hashlib.sha256(data).hexdigest()[:32]
+
+
+@dataclasses.dataclass
+class Fingerprint:
+    """
+    A fingerprint of a stack's configuration.
+
+    .. attribute:: root_template
+       Name of the stack's (root) template.
+
+    .. attribute:: parameters
+       Digest of the stack parameters and Kubernetes version.
+
+    .. attribute:: assets
+       Digest of the AMI assets and Lambda packages.
+
+    .. attribute:: templates
+       Digest of each template, by file name.
+
+    """
+
+    root_template: str
+    parameters: str
+    assets: str
+    templates: dict[str, str]
+
+    @property
+    def value(self) -> str:
+        """The overall fingerprint."""
+        return _digest(
+            json.dumps(
+                [
+                    self.root_template,
+                    self.parameters,
+                    self.assets,
+                    self.templates,
+                ],
+                sort_keys=True,
+            ).encode()
+        )
+
+    def tags(self) -> list[dict[str, str]]:
+        """Return the stack tags recording this fingerprint."""
+        return [
+            {"Key": FINGERPRINT_TAG, "Value": self.value},
+            {"Key": PARAMETERS_TAG, "Value": self.parameters},
+            {"Key": ASSETS_TAG, "Value": self.assets},
+            *(
+                {"Key": f"{TEMPLATE_TAG_PREFIX}{name}", "Value": digest}
+                for name, digest in sorted(self.templates.items())
+            ),
+        ]
+
+
+def _list_objects(
+    s3: Any, bucket: str, prefix: str, dirs: Iterable[str]
+) -> dict[str, str]:
+    """Return the ETag of each object under the given directories of the
+    bucket, by key relative to the prefix."""
+    etags = {}
+    paginator = s3.get_paginator("list_objects_v2")
+    for d in dirs:
+        for page in paginator.paginate(Bucket=bucket, Prefix=f"{prefix}{d}/"):
+            for obj in page.get("Contents", []):
+                etags[obj["Key"][len(prefix) :]] = obj["ETag"]
+    return etags
+
+
+def fingerprint(
+    s3: Any,
+    bucket: str,
+    prefix: str,
+    root_template: str,
+    parameters: Mapping[str, Any],
+    kubernetes_version: Optional[str] = None,
+) -> Fingerprint:
+    """
+    Fingerprint a stack configuration.
+
+    The resources in the bucket are fingerprinted by their ETags, so nothing
+    is downloaded.
+
+    :param s3:
+        A boto3 S3 client.
+
+    :param bucket:
+        The bucket the stack is brought up from.
+
+    :param prefix:
+        Key prefix of the resources in the bucket, e.g. "xrd-eks/".
+
+    :param root_template:
+        File name of the stack's template.
+
+    :param parameters:
+        The stack parameters.
+
+    :param kubernetes_version:
+        The Kubernetes version, if not the default.
+
+    """
+    templates = _list_objects(s3, bucket, prefix, [TEMPLATES_DIR])
+    assets = _list_objects(s3, bucket, prefix, ASSETS_DIRS)
+    return Fingerprint(
+        root_template=root_template,
+        parameters=_digest(
+            json.dumps(
+                [
+                    {k: str(v) for k, v in parameters.items()},
+                    kubernetes_version,
+                ],
+                sort_keys=True,
+            ).encode()
+        ),
+        assets=_digest(json.dumps(assets, sort_keys=True).encode()),
+        templates={
+            key[len(TEMPLATES_DIR) + 1 :]: _digest(etag.encode())
+            for key, etag in templates.items()
+        },
+    )
+
+
+def unpublished(
+    s3: Any,
+    bucket: str,
+    prefix: str,
+    root: Path,
+    dirs: Iterable[str] = (TEMPLATES_DIR, *ASSETS_DIRS),
+) -> list[str]:
+    """
+    Find the local files which differ from those in the bucket, i.e. which
+    need publishing before a stack brought up from the bucket includes them.
+
+    A file is compared by its MD5 with the object's ETag, which is the MD5 of
+    the object's content unless it was uploaded in parts; such objects are
+    assumed to be unchanged.
+
+    :param root:
+        Root of the repository.
+
+    :returns:
+        The paths of the files, relative to the root.
+
+    """
+    dirs = tuple(dirs)
+    etags = _list_objects(s3, bucket, prefix, dirs)
+    changed = []
+    for d in dirs:
+        for path in sorted((root / d).rglob("*")):
+            if not path.is_file():
+                continue
+            key = path.relative_to(root).as_posix()
+            etag = etags.get(key, "").strip('"')
+            if "-" in etag:
+                continue
+            if etag != hashlib.md5(path.read_bytes()).hexdigest():
+                changed.append(key)
+    return changed
+
+
+@dataclasses.dataclass
+class StackMatch:
+    """
+    An existing stack for a configuration.
+
+    .. attribute:: stack_name
+       Name of the stack.
+
+    .. attribute:: changed_templates
+       Names of the templates which differ from the stack's, or empty if the
+       stack matches exactly.
+
+    """
+
+    stack_name: str
+    changed_templates: list[str]
+
+    @property
+    def exact(self) -> bool:
+        return not self.changed_templates
+
+
+def find_stack(
+    cf: Any, fp: Fingerprint, *, name_prefix: str = ""
+) -> Optional[StackMatch]:
+    """
+    Find an existing stack which was brought up with the same parameters,
+    root template, AMI assets and Lambda packages as a fingerprint.
+
+    A stack whose AMI assets or Lambda packages differ isn't a match, as
+    updating the stack in place wouldn't rebuild its AMI or redeploy the
+    functions.
+
+    A stack which matches the fingerprint exactly is preferred; otherwise the
+    stack with the fewest changed templates is returned.  Only stacks which
+    completed successfully are considered.
+
+    :param cf:
+        A boto3 CloudFormation client.
+
+    :param fp:
+        The fingerprint to match.
+
+    :param name_prefix:
+        Only consider stacks whose name starts with this prefix.
+
+    :returns:
+        The matching stack, or None if there isn't one.
+
+    """
+    best: Optional[StackMatch] = None
+    for page in cf.get_paginator("describe_stacks").paginate():
+        for stack in page["Stacks"]:
+            if not stack["StackName"].startswith(name_prefix):
+                continue
+            if stack["StackStatus"] not in REUSABLE_STATUSES:
+                continue
+            if stack.get("ParentId"):
+                continue
+            tags = {t["Key"]: t["Value"] for t in stack.get("Tags", [])}
+            if FINGERPRINT_TAG not in tags:
+                continue
+            if tags[FINGERPRINT_TAG] == fp.value:
+                return StackMatch(stack["StackName"], [])
+            if tags.get(PARAMETERS_TAG) != fp.parameters:
+                continue
+            if tags.get(ASSETS_TAG) != fp.assets:
+                continue
+            old_templates = {
+                k[len(TEMPLATE_TAG_PREFIX) :]: v
+                for k, v in tags.items()
+                if k.startswith(TEMPLATE_TAG_PREFIX)
+            }
+            if old_templates.get(fp.root_template) != (
+                fp.templates.get(fp.root_template)
+            ):
+                continue
+            changed = sorted(
+                name
+                for name in fp.templates.keys() | old_templates.keys()
+                if fp.templates.get(name) != old_templates.get(name)
+            )
+            if best is None or len(changed) < len(best.changed_templates):
+                best = StackMatch(stack["StackName"], changed)
+    return best
+
+
+def update_stack(cf: Any, stack_name: str, fp: Fingerprint) -> None:
+    """
+    Update a stack whose nested templates have changed, and retag it with a
+    new fingerprint.
+
+    The stack is updated with its previous template and parameters, so only
+    the nested stacks whose templates have changed in the bucket are updated.
+
+    :param cf:
+        A boto3 CloudFormation client.
+
+    """
+    stack = cf.describe_stacks(StackName=stack_name)["Stacks"][0]
+    new_tags = {t["Key"]: t for t in fp.tags()}
+    logger.info("Updating stack %s for changed templates", stack_name)
+    cf.update_stack(
+        StackName=stack_name,
+        UsePreviousTemplate=True,
+        Parameters=[
+            {"ParameterKey": p["ParameterKey"], "UsePreviousValue": True}
+            for p in stack.get("Parameters", [])
+        ],
+        Capabilities=stack.get("Capabilities", []),
+        Tags=[
+            *(
+                t
+                for t in stack.get("Tags", [])
+                if t["Key"] not in new_tags
+                and not t["Key"].startswith(TEMPLATE_TAG_PREFIX)
+            ),
+            *new_tags.values(),
+        ],
+    )
+    cf.get_waiter("stack_update_complete").wait(StackName=stack_name)
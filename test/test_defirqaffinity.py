@@ -0,0 +1,215 @@
+# test_defirqaffinity.py
+
+"""
+Tests for the IRQ affinity script of the tuned profile, against a synthetic
+/proc/irq and sysfs tree.
+
+These don't need AWS or a cluster, e.g.::
+
+    pytest test_defirqaffinity.py
+
+"""
+
+import importlib.util
+import json
+from pathlib import Path
+
+import pytest
+
+
+ROOT = Path(__file__).resolve().parent.parent
+SCRIPT = ROOT / "ami_assets/etc/tuned/xrd-eks-node/defirqaffinity.py"
+
+_spec = importlib.util.spec_from_file_location("defirqaffinity", SCRIPT)
+defirqaffinity = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(defirqaffinity)
+
+# The isolated CPUs, of 8 CPUs on two NUMA nodes (0-3 and 4-7).
+ISOLATED = "2-3,6-7"
+
+
+@pytest.mark.parametrize(
+    "cpulist, mask, cpumask",
+    [
+        ("0", 0x1, "1"),
+        ("1,2,5-7", 0xE6, "e6"),
+        ("0-31", 0xFFFFFFFF, "ffffffff"),
+        ("32", 1 << 32, "1,00000000"),
+        ("0,40-47", 0xFF0000000001, "ff00,00000001"),
+        ("0-71", (1 << 72) - 1, "ff,ffffffff,ffffffff"),
+        (
+            "64,127",
+            (1 << 64) | (1 << 127),
+            "80000000,00000001,00000000,00000000",
+        ),
+    ],
+)
+def test_cpumask_round_trip(cpulist: str, mask: int, cpumask: str) -> None:
+    assert defirqaffinity.parse_cpulist(cpulist) == mask
+    assert defirqaffinity.format_cpumask(mask) == cpumask
+    assert defirqaffinity.parse_cpumask(cpumask + "\n") == mask
+
+
+def test_parse_cpumask_padded() -> None:
+    """Masks read from the kernel are zero-padded to whole groups."""
+    assert defirqaffinity.parse_cpumask("00000000,00000100\n") == 1 << 8
+    assert defirqaffinity.parse_cpumask("ff\n") == 0xFF
+
+
+def test_parse_cpulist_empty_fields() -> None:
+    assert defirqaffinity.parse_cpulist("1,,3\n") == 0b1010
+    assert defirqaffinity.parse_cpulist("") == 0
+
+
+@pytest.fixture
+def irqpath(tmp_path: Path) -> Path:
+    """
+    Fixture which provides a synthetic /proc/irq tree, with all IRQs on all
+    8 CPUs.  IRQ 0 and 2 are skipped by the script.
+
+    """
+    path = tmp_path / "irq"
+    path.mkdir()
+    (path / "default_smp_affinity").write_text("ff\n")
+    for irq in ("0", "2", "24", "25", "26", "27"):
+        (path / irq).mkdir()
+        (path / irq / "smp_affinity").write_text("ff\n")
+    return path
+
+
+@pytest.fixture
+def sysfs(tmp_path: Path) -> Path:
+    """
+    Fixture which provides a synthetic sysfs tree, with a device on node 0
+    raising MSI IRQs 24 and 25, and a device on node 1 raising legacy IRQ 26.
+    IRQ 27 isn't raised by a PCI device.
+
+    """
+    path = tmp_path / "sys"
+    for address, node, cpulist, msi_irqs, irq in (
+        ("0000:00:04.0", 0, "0-3", ("24", "25"), "0"),
+        ("0000:00:05.0", 1, "4-7", (), "26"),
+    ):
+        device = path / "bus" / "pci" / "devices" / address
+        device.mkdir(parents=True)
+        (device / "numa_node").write_text(f"{node}\n")
+        (device / "local_cpulist").write_text(f"{cpulist}\n")
+        (device / "irq").write_text(f"{irq}\n")
+        for msi_irq in msi_irqs:
+            (device / "msi_irqs").mkdir(exist_ok=True)
+            (device / "msi_irqs" / msi_irq).write_text("msix\n")
+    return path
+
+
+def _masks(changes: list) -> dict[str, int]:
+    return {c.irq: c.new for c in changes}
+
+
+def test_plan_remove(irqpath: Path) -> None:
+    """Removing CPUs changes the default and every IRQ which isn't
+    skipped."""
+    (irqpath / "25" / "smp_affinity").write_text("33\n")
+    cpumask = defirqaffinity.parse_cpulist(ISOLATED)
+
+    changes = defirqaffinity.plan(str(irqpath), "remove", cpumask)
+
+    assert _masks(changes) == {
+        "default": 0x33,
+        "24": 0x33,
+        "26": 0x33,
+        "27": 0x33,
+    }
+    assert all(c.old == 0xFF for c in changes)
+
+
+def test_plan_add(irqpath: Path) -> None:
+    """Adding CPUs only changes the IRQs which don't already have them."""
+    for irq in ("24", "25", "26", "27"):
+        (irqpath / irq / "smp_affinity").write_text("33\n")
+    (irqpath / "25" / "smp_affinity").write_text("00000000,000000ff\n")
+    cpumask = defirqaffinity.parse_cpulist(ISOLATED)
+
+    changes = defirqaffinity.plan(str(irqpath), "add", cpumask)
+
+    assert _masks(changes) == {"24": 0xFF, "26": 0xFF, "27": 0xFF}
+
+
+def test_plan_placement(irqpath: Path, sysfs: Path) -> None:
+    """Device IRQs are pinned to a housekeeping CPU on the device's node,
+    spread across those CPUs, and other IRQs have the isolated CPUs
+    removed."""
+    cpumask = defirqaffinity.parse_cpulist(ISOLATED)
+
+    changes = defirqaffinity.plan_placement(str(irqpath), str(sysfs), cpumask)
+
+    assert _masks(changes) == {
+        "default": 0x33,
+        "24": 1 << 0,
+        "25": 1 << 1,
+        "26": 1 << 4,
+        "27": 0x33,
+    }
+
+
+def test_plan_placement_no_local_cpus(irqpath: Path, sysfs: Path) -> None:
+    """IRQs of a device whose node has no housekeeping CPUs, or which has no
+    NUMA affinity, are treated as for remove."""
+    device = sysfs / "bus" / "pci" / "devices" / "0000:00:04.0"
+    (device / "numa_node").write_text("-1\n")
+    cpumask = defirqaffinity.parse_cpulist("2-7")
+
+    changes = defirqaffinity.plan_placement(str(irqpath), str(sysfs), cpumask)
+
+    assert _masks(changes) == {
+        "default": 0x3,
+        "24": 0x3,
+        "25": 0x3,
+        "26": 0x3,
+        "27": 0x3,
+    }
+
+
+def test_main_place(irqpath: Path, sysfs: Path) -> None:
+    """Placement writes the changed masks, which then verify."""
+    rc = defirqaffinity.main(
+        ["place", ISOLATED, str(irqpath), f"--sysfs={sysfs}"]
+    )
+
+    assert rc == 0
+    assert (irqpath / "default_smp_affinity").read_text() == "33"
+    assert (irqpath / "24" / "smp_affinity").read_text() == "1"
+    assert (irqpath / "26" / "smp_affinity").read_text() == "10"
+    assert (irqpath / "0" / "smp_affinity").read_text() == "ff\n"
+    assert defirqaffinity.main(["verify", ISOLATED, str(irqpath)]) == 0
+
+
+def test_main_dry_run(irqpath: Path, capsys: pytest.CaptureFixture) -> None:
+    """A dry run reports the changes, and IRQs which can't be moved, without
+    making them."""
+    rc = defirqaffinity.main(["--dry-run", "remove", "0-7", str(irqpath)])
+
+    assert rc == 0
+    report = json.loads(capsys.readouterr().out)
+    assert report["changes"]["24"] == {"old": "ff", "new": "0"}
+    assert report["unmovable"] == ["24", "25", "26", "27"]
+    assert (irqpath / "24" / "smp_affinity").read_text() == "ff\n"
+    assert defirqaffinity.main(["verify", "0-7", str(irqpath)]) == 1
+
+
+def test_apply_failures(irqpath: Path) -> None:
+    """IRQs whose mask can't be written, or which the kernel doesn't move,
+    are returned as failed."""
+    cpumask = defirqaffinity.parse_cpulist(ISOLATED)
+    changes = defirqaffinity.plan(str(irqpath), "remove", cpumask)
+    # The write fails.
+    (irqpath / "24" / "smp_affinity").unlink()
+    (irqpath / "24" / "smp_affinity").mkdir()
+    # The kernel keeps the IRQ on an isolated CPU.
+    (irqpath / "25" / "effective_affinity").write_text("4\n")
+    # The kernel moves the IRQ to a housekeeping CPU.
+    (irqpath / "26" / "effective_affinity").write_text("2\n")
+
+    failed = defirqaffinity.apply(changes)
+
+    assert [c.irq for c in failed] == ["24", "25"]
+    assert (irqpath / "26" / "smp_affinity").read_text() == "33"
@@ -0,0 +1,283 @@
+# test_hugetlb_reserve_pages.py
+
+"""
+Tests for the reservation of 1GiB hugepages on XRd vRouter nodes, against a
+fake sysfs tree.
+
+These don't need AWS or a cluster, e.g.::
+
+    pytest test_hugetlb_reserve_pages.py
+
+"""
+
+import importlib.util
+import json
+from pathlib import Path
+from typing import Any
+
+import pytest
+
+
+ROOT = Path(__file__).resolve().parent.parent
+SCRIPT = ROOT / "ami_assets" / "etc" / "xrd" / "hugetlb-reserve-pages.py"
+
+_spec = importlib.util.spec_from_file_location("hugetlb_reserve_pages", SCRIPT)
+hugetlb = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(hugetlb)
+
+# PCI class codes.
+ETHERNET = "0x020000"
+NVME = "0x010802"
+
+# Pages reserved on each node at boot.
+BOOT_PAGES = 6
+
+
+class FakeKernel:
+    """
+    A fake sysfs tree, whose nodes grant at most ``limits[node]`` 1GiB
+    hugepages.  Compacting a node's memory raises its limit by
+    ``compaction_gain`` pages.
+
+    """
+
+    def __init__(self, path: Path, online: str, limits: dict[int, int]):
+        self.path = path
+        self.limits = limits
+        self.compaction_gain = 0
+        self.compactions: list[int] = []
+        nodes = path / "devices" / "system" / "node"
+        nodes.mkdir(parents=True)
+        (nodes / "online").write_text(f"{online}\n")
+        for node in hugetlb.parse_rangelist(online):
+            (nodes / f"node{node}" / hugetlb.HUGEPAGES_DIR).mkdir(parents=True)
+            self.write_pages(node, BOOT_PAGES)
+
+    def add_device(self, address: str, pci_class: str, node: int) -> None:
+        device = self.path / "bus" / "pci" / "devices" / address
+        device.mkdir(parents=True)
+        (device / "class").write_text(f"{pci_class}\n")
+        (device / "numa_node").write_text(f"{node}\n")
+
+    def write_pages(self, node: int, count: int) -> None:
+        count = min(count, self.limits.get(node, count))
+        path = Path(hugetlb.hugepages_path(str(self.path), node))
+        (path / "nr_hugepages").write_text(f"{count}\n")
+        (path / "free_hugepages").write_text(f"{count}\n")
+
+    def compact(self, node: int) -> None:
+        self.compactions.append(node)
+        if node in self.limits:
+            self.limits[node] += self.compaction_gain
+
+    def pages(self, node: int) -> int:
+        return hugetlb.node_pages(str(self.path), node).nr
+
+
+@pytest.fixture
+def kernel(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> FakeKernel:
+    """
+    Fixture which provides a fake sysfs tree, with non-contiguous nodes 0 and
+    2, an NVMe device on node 0 and a network device on node 2.
+
+    """
+    kernel = FakeKernel(tmp_path / "sys", "0,2", {})
+    kernel.add_device("0000:00:04.0", NVME, 0)
+    kernel.add_device("0000:00:05.0", ETHERNET, 2)
+    monkeypatch.setattr(
+        hugetlb,
+        "reserve_pages",
+        lambda sysfs, node, count: kernel.write_pages(node, count),
+    )
+    monkeypatch.setattr(
+        hugetlb, "compact", lambda sysfs, node: kernel.compact(node)
+    )
+    monkeypatch.delenv("XRD_PCI_DEVICES", raising=False)
+    monkeypatch.delenv("HUGEPAGES_MIN_GB", raising=False)
+    return kernel
+
+
+def _main(kernel: FakeKernel, tmp_path: Path, *args: str) -> tuple[int, Any]:
+    status_file = tmp_path / "status.json"
+    rc = hugetlb.main(
+        [
+            f"--sysfs={kernel.path}",
+            f"--status-file={status_file}",
+            *args,
+        ]
+    )
+    return rc, json.loads(status_file.read_text())
+
+
+def test_parse_rangelist() -> None:
+    assert hugetlb.parse_rangelist("0\n") == [0]
+    assert hugetlb.parse_rangelist("0,2") == [0, 2]
+    assert hugetlb.parse_rangelist("4,0-1,8-9") == [0, 1, 4, 8, 9]
+    assert hugetlb.parse_rangelist("") == []
+
+
+def test_reserve_non_contiguous(kernel: FakeKernel) -> None:
+    """Pages are reserved on a node after a gap in the online nodes, and
+    released on the others."""
+    statuses = hugetlb.reserve(str(kernel.path), 3, ["0000:00:05.0"])
+
+    assert statuses == [
+        hugetlb.NodeStatus(0, 0, 0, 0),
+        hugetlb.NodeStatus(2, 3, 3, 3),
+    ]
+    assert kernel.pages(0) == 0
+    assert kernel.pages(2) == 3
+
+
+def test_reserve_no_affinity(kernel: FakeKernel) -> None:
+    """If no device has NUMA affinity, pages are reserved on the first
+    online node."""
+    kernel.add_device("0000:00:06.0", ETHERNET, -1)
+    statuses = hugetlb.reserve(str(kernel.path), 3, ["0000:00:06.0"])
+    assert [s.granted for s in statuses] == [3, 0]
+
+
+def test_main_network_devices(
+    kernel: FakeKernel, tmp_path: Path, capsys: pytest.CaptureFixture
+) -> None:
+    """With no devices given, pages are reserved on the node local to the
+    network devices."""
+    rc, status = _main(kernel, tmp_path, "--hugepages-gb=2")
+
+    assert rc == 0
+    assert (kernel.pages(0), kernel.pages(2)) == (0, 2)
+    out = capsys.readouterr().out
+    assert "local to: 0000:00:05.0\n" in out
+    assert "node2: 2 of 2 1GiB hugepages granted (2 free)\n" in out
+    assert status["status"] == "ok"
+    assert status["nodes"]["2"] == {
+        "node": 2,
+        "requested": 2,
+        "granted": 2,
+        "free": 2,
+    }
+
+
+def test_main_pci_devices(
+    kernel: FakeKernel, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Pages are reserved on the node local to the devices in
+    ``XRD_PCI_DEVICES``."""
+    monkeypatch.setenv("XRD_PCI_DEVICES", "0000:00:04.0")
+    rc, _ = _main(kernel, tmp_path, "--hugepages-gb=2")
+    assert rc == 0
+    assert (kernel.pages(0), kernel.pages(2)) == (2, 0)
+
+
+def test_main_short_grant(
+    kernel: FakeKernel, tmp_path: Path, capsys: pytest.CaptureFixture
+) -> None:
+    """If a node is granted fewer pages than requested, the shortfall is
+    reported and the reservation fails."""
+    kernel.limits[2] = 1
+
+    rc, status = _main(kernel, tmp_path, "--hugepages-gb=3", "--retries=0")
+
+    assert rc == 1
+    out = capsys.readouterr().out
+    assert "node2: 1 of 3 1GiB hugepages granted (1 free)\n" in out
+    assert "Hugepage reservation status: failed\n" in out
+    assert status["status"] == "failed"
+    assert status["minimum"] is None
+    assert (status["requested"], status["granted"]) == (3, 1)
+
+
+def test_reserve_compaction_retry(
+    kernel: FakeKernel, capsys: pytest.CaptureFixture
+) -> None:
+    """If a node is short, its memory is compacted and the reservation
+    retried until the pages are granted."""
+    kernel.limits[2] = 1
+    kernel.compaction_gain = 1
+
+    statuses = hugetlb.reserve(str(kernel.path), 3, ["0000:00:05.0"])
+
+    assert statuses[1] == hugetlb.NodeStatus(2, 3, 3, 3)
+    assert kernel.compactions == [2, 2]
+    out = capsys.readouterr().out
+    assert out.count("node2: compacting memory and retrying\n") == 2
+
+
+def test_reserve_compaction_exhausted(kernel: FakeKernel) -> None:
+    """Compaction is retried at most ``retries`` times."""
+    kernel.limits[2] = 1
+    statuses = hugetlb.reserve(
+        str(kernel.path), 3, ["0000:00:05.0"], retries=2
+    )
+    assert statuses[1] == hugetlb.NodeStatus(2, 3, 1, 1)
+    assert kernel.compactions == [2, 2]
+
+
+def test_main_fallback(
+    kernel: FakeKernel,
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    capsys: pytest.CaptureFixture,
+) -> None:
+    """If a node is granted fewer than the minimum from ``HUGEPAGES_MIN_GB``
+    after compaction, the minimum is reserved instead, and the reservation
+    is degraded."""
+    kernel.limits[2] = 1
+    kernel.compaction_gain = 1
+    monkeypatch.setenv("HUGEPAGES_MIN_GB", "3")
+
+    rc, status = _main(kernel, tmp_path, "--hugepages-gb=4", "--retries=1")
+
+    assert rc == 0
+    assert kernel.pages(2) == 3
+    # Compacted once for the full number of pages, and once more for the
+    # minimum.
+    assert kernel.compactions == [2, 2]
+    out = capsys.readouterr().out
+    assert (
+        "node2: only 2 of 4 1GiB hugepages granted, falling back to 3\n"
+    ) in out
+    assert "node2: 3 of 4 1GiB hugepages granted (3 free)\n" in out
+    assert "Hugepage reservation status: degraded\n" in out
+    assert status["status"] == "degraded"
+    assert status["minimum"] == 3
+    assert (status["requested"], status["granted"]) == (4, 3)
+
+
+def test_main_above_minimum(
+    kernel: FakeKernel, tmp_path: Path, capsys: pytest.CaptureFixture
+) -> None:
+    """If a node is short but granted more than the minimum, it keeps the
+    pages granted rather than falling back to the minimum."""
+    kernel.limits[2] = 6
+    rc, status = _main(
+        kernel,
+        tmp_path,
+        "--hugepages-gb=8",
+        "--min-hugepages-gb=4",
+        "--retries=0",
+    )
+
+    assert rc == 0
+    assert kernel.pages(2) == 6
+    out = capsys.readouterr().out
+    assert "falling back" not in out
+    assert "node2: 6 of 8 1GiB hugepages granted (6 free)\n" in out
+    assert status["status"] == "degraded"
+    assert (status["requested"], status["granted"]) == (8, 6)
+
+
+def test_main_fallback_short(kernel: FakeKernel, tmp_path: Path) -> None:
+    """The reservation fails if a node is granted fewer pages than the
+    minimum."""
+    kernel.limits[2] = 1
+    rc, status = _main(
+        kernel,
+        tmp_path,
+        "--hugepages-gb=3",
+        "--min-hugepages-gb=2",
+        "--retries=1",
+    )
+    assert rc == 1
+    assert status["status"] == "failed"
+    assert kernel.compactions == [2, 2]
@@ -0,0 +1,587 @@
+# test_lambdas.py
+
+"""
+Tests for the Lambda functions in ``functions/source/``, against AWS services
+mocked by moto.
+
+These don't need a cluster, e.g.::
+
+    pytest test_lambdas.py
+
+"""
+
+import datetime
+import json
+import os
+import sys
+import time
+import types
+from pathlib import Path
+from typing import Any
+
+import boto3
+import kubernetes
+import pytest
+from botocore.stub import Stubber
+
+
+moto = pytest.importorskip("moto")
+
+FUNCTIONS_DIR = Path(__file__).resolve().parent.parent / "functions" / "source"
+sys.path[:0] = [
+    str(FUNCTIONS_DIR),
+    str(FUNCTIONS_DIR / "XrdAmi"),
+    str(FUNCTIONS_DIR / "XrdKubectl"),
+    str(FUNCTIONS_DIR / "XrdQsAmi"),
+]
+
+import xrd_ami  # noqa: E402
+import xrd_kubectl  # noqa: E402
+import xrd_qs_ami  # noqa: E402
+
+
+REGION = "us-east-1"
+
+# Number of other stacks in the account, to check lookups don't scale with it.
+NUM_STACKS = 500
+
+AMI_TEMPLATE = json.dumps(
+    {
+        "Resources": {"Topic": {"Type": "AWS::SNS::Topic"}},
+        "Outputs": {"AmiId": {"Value": "ami-0123456789abcdef0"}},
+    }
+)
+
+
+class CallCounter:
+    """Counts the API calls made by boto3 clients."""
+
+    def __init__(self, *clients: Any):
+        self.calls: list[str] = []
+        for client in clients:
+            client.meta.events.register_first("before-call.*.*", self._count)
+
+    def _count(self, model, **kwargs) -> None:
+        self.calls.append(model.name)
+
+
+@pytest.fixture
+def aws(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Fixture which mocks AWS services."""
+    for var in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+        monkeypatch.setenv(var, "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", REGION)
+    with moto.mock_aws():
+        yield
+
+
+@pytest.fixture
+def cfn(aws: None) -> Any:
+    """Fixture which provides a CloudFormation client, with other stacks."""
+    cfn = boto3.client("cloudformation", region_name=REGION)
+    for i in range(NUM_STACKS):
+        cfn.create_stack(
+            StackName=f"other-{i}",
+            TemplateBody=AMI_TEMPLATE,
+            Tags=[{"Key": "other", "Value": str(i)}],
+        )
+    return cfn
+
+
+@pytest.fixture
+def tagging(aws: None) -> Any:
+    """
+    Fixture which provides a stubbed Resource Groups Tagging API client; the
+    expected calls must be added to the stubber (``tagging.stubber``).
+
+    """
+    tagging = boto3.client("resourcegroupstaggingapi", region_name=REGION)
+    tagging.stubber = Stubber(tagging)
+    with tagging.stubber:
+        yield tagging
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Fixture which fails any test that sleeps rather than doing work."""
+
+    def sleep(secs: float) -> None:
+        raise AssertionError(f"Slept for {secs}s")
+
+    monkeypatch.setattr(xrd_qs_ami.time, "sleep", sleep)
+
+
+def _deadline() -> float:
+    return time.monotonic() + 600
+
+
+@pytest.fixture
+def clients(
+    monkeypatch: pytest.MonkeyPatch, cfn: Any, tagging: Any
+) -> CallCounter:
+    """
+    Fixture which makes the XrdQsAmi function use the mocked clients, and
+    counts its API calls.
+
+    """
+    monkeypatch.setattr(xrd_qs_ami, "_clients", {None: (cfn, tagging)})
+    return CallCounter(cfn, tagging)
+
+
+def _create_ami_stack(cfn: Any, stack_name: str) -> str:
+    return cfn.create_stack(
+        StackName=stack_name,
+        TemplateBody=AMI_TEMPLATE,
+        Tags=[{"Key": "xrd-quickstart", "Value": "AMI-1-23"}],
+    )["StackId"]
+
+
+def _from_template_body(method: Any) -> Any:
+    """
+    Wrap a create or update stack method to use the AMI template body, since
+    there is no bucket for the template URL.
+
+    """
+
+    def wrapper(TemplateURL: str, **kwargs) -> dict[str, Any]:
+        return method(TemplateBody=AMI_TEMPLATE, **kwargs)
+
+    return wrapper
+
+
+def test_find_stack_by_name(cfn: Any, tagging: Any) -> None:
+    stack_id = _create_ami_stack(cfn, "xrd-quickstart-AMI-1-23")
+    counter = CallCounter(cfn, tagging)
+
+    stack = xrd_qs_ami.find_stack(cfn, tagging, "xrd-quickstart", "AMI-1-23")
+
+    assert stack["StackId"] == stack_id
+    assert counter.calls == ["DescribeStacks"]
+
+
+def test_find_stack_by_tag(cfn: Any, tagging: Any) -> None:
+    stack_id = _create_ami_stack(cfn, "renamed-ami-stack")
+    tagging.stubber.add_response(
+        "get_resources",
+        {"ResourceTagMappingList": [{"ResourceARN": stack_id}]},
+        {
+            "TagFilters": [{"Key": "xrd-quickstart", "Values": ["AMI-1-23"]}],
+            "ResourceTypeFilters": ["cloudformation:stack"],
+        },
+    )
+    counter = CallCounter(cfn, tagging)
+
+    stack = xrd_qs_ami.find_stack(cfn, tagging, "xrd-quickstart", "AMI-1-23")
+
+    assert stack["StackId"] == stack_id
+    assert counter.calls == [
+        "DescribeStacks",
+        "GetResources",
+        "DescribeStacks",
+    ]
+
+
+def test_find_stack_missing(cfn: Any, tagging: Any) -> None:
+    tagging.stubber.add_response(
+        "get_resources", {"ResourceTagMappingList": []}
+    )
+    assert (
+        xrd_qs_ami.find_stack(cfn, tagging, "xrd-quickstart", "AMI-1-23")
+        is None
+    )
+
+
+def test_get_stack_cached(cfn: Any, clients: CallCounter) -> None:
+    _create_ami_stack(cfn, "xrd-quickstart-AMI-1-23")
+    clients.calls.clear()
+    now = [0.0]
+    cache = xrd_qs_ami.StackCache(ttl=30, clock=lambda: now[0])
+
+    for _ in range(3):
+        stack = xrd_qs_ami.get_stack(
+            "xrd-quickstart", "AMI-1-23", deadline=_deadline(), cache=cache
+        )
+        assert stack["StackStatus"] == "CREATE_COMPLETE"
+    assert clients.calls == ["DescribeStacks"]
+
+    now[0] = 31
+    xrd_qs_ami.get_stack(
+        "xrd-quickstart", "AMI-1-23", deadline=_deadline(), cache=cache
+    )
+    assert clients.calls == ["DescribeStacks"] * 2
+
+
+def test_put_stack_creates_stack(
+    cfn: Any,
+    tagging: Any,
+    clients: CallCounter,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(
+        cfn, "create_stack", _from_template_body(cfn.create_stack)
+    )
+    tagging.stubber.add_response(
+        "get_resources", {"ResourceTagMappingList": []}
+    )
+    cache = xrd_qs_ami.StackCache()
+
+    ami_id = xrd_qs_ami.put_stack(
+        "AMI-1-23",
+        None,
+        "https://example.com/xrd-eks-ami-cf.yaml",
+        {"KubernetesVersion": "1.23"},
+        "xrd-quickstart",
+        deadline=_deadline(),
+        cache=cache,
+    )
+
+    assert ami_id == "ami-0123456789abcdef0"
+    stack = cfn.describe_stacks(StackName="xrd-quickstart-AMI-1-23")
+    assert stack["Stacks"][0]["Tags"] == [
+        {"Key": "xrd-quickstart", "Value": "AMI-1-23"}
+    ]
+    # The stack is cached, so isn't looked up again.
+    calls = len(clients.calls)
+    xrd_qs_ami.get_stack(
+        "xrd-quickstart", "AMI-1-23", deadline=_deadline(), cache=cache
+    )
+    assert len(clients.calls) == calls
+
+
+def test_put_stack_conflict(
+    cfn: Any,
+    tagging: Any,
+    clients: CallCounter,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """
+    Another invocation creates the stack between this one looking for it and
+    creating it, so this one uses that stack rather than racing.
+
+    """
+    _create_ami_stack(cfn, "xrd-quickstart-AMI-1-23")
+    find_stack = xrd_qs_ami.find_stack
+    lookups = []
+
+    def find_stack_late(*args) -> Any:
+        lookups.append(args)
+        return find_stack(*args) if len(lookups) > 1 else None
+
+    monkeypatch.setattr(xrd_qs_ami, "find_stack", find_stack_late)
+    for method in ("create_stack", "update_stack"):
+        monkeypatch.setattr(
+            cfn, method, _from_template_body(getattr(cfn, method))
+        )
+    clients.calls.clear()
+
+    ami_id = xrd_qs_ami.put_stack(
+        "AMI-1-23",
+        None,
+        "https://example.com/xrd-eks-ami-cf.yaml",
+        {"KubernetesVersion": "1.23"},
+        "xrd-quickstart",
+        deadline=_deadline(),
+        cache=xrd_qs_ami.StackCache(),
+    )
+
+    assert ami_id == "ami-0123456789abcdef0"
+    assert clients.calls.count("CreateStack") == 1
+    assert len(lookups) == 2
+
+
+def test_waiter_deadline(cfn: Any, monkeypatch: pytest.MonkeyPatch) -> None:
+    """The wait for a stack operation stops at the deadline, without sleeping
+    past it."""
+    monkeypatch.setattr(
+        xrd_qs_ami,
+        "_describe_stack",
+        lambda cfn, stack: {"StackStatus": "CREATE_IN_PROGRESS"},
+    )
+    with pytest.raises(RuntimeError, match="timed out"):
+        xrd_qs_ami.waiter(cfn, "create", "stack-id", time.monotonic() + 1)
+
+
+@pytest.fixture
+def ec2(aws: None, monkeypatch: pytest.MonkeyPatch) -> Any:
+    """Fixture which makes the AMI function use a mocked EC2 client."""
+    ec2 = boto3.client("ec2", region_name=REGION)
+    monkeypatch.setattr(xrd_ami, "_ec2", ec2)
+    return ec2
+
+
+def _record(responses: list[tuple[str, Any]]) -> Any:
+    """Return a replacement for `cfn_response.send` which records the status
+    and physical ID of the responses sent."""
+
+    def send(event, context, status, data, physical_id=None, **kwargs):
+        responses.append((status, physical_id))
+
+    return send
+
+
+@pytest.fixture
+def responses(monkeypatch: pytest.MonkeyPatch) -> list[tuple[str, Any]]:
+    """Fixture which records the custom resource responses sent."""
+    responses = []
+    monkeypatch.setattr(xrd_ami.cfn_response, "send", _record(responses))
+    return responses
+
+
+def _stopped_instance(ec2: Any) -> str:
+    image_id = ec2.describe_images(Owners=["amazon"])["Images"][0]["ImageId"]
+    instance_id = ec2.run_instances(ImageId=image_id, MinCount=1, MaxCount=1)[
+        "Instances"
+    ][0]["InstanceId"]
+    ec2.stop_instances(InstanceIds=[instance_id])
+    return instance_id
+
+
+def test_ami_poll(ec2: Any, responses: list[tuple[str, Any]]) -> None:
+    """The image is created once the instance stops, and the response is sent
+    when it is available."""
+    state = {
+        "Event": {
+            "RequestType": "Create",
+            "ResourceProperties": {
+                "InstanceId": _stopped_instance(ec2),
+                "ImageName": "xrd-ami",
+            },
+        },
+        "PhysicalResourceId": "log-stream",
+        "Deadline": time.time() + 600,
+        "Wait": 0,
+        "Done": False,
+    }
+
+    state = xrd_ami.handler(state, None)
+    image_id = state["PhysicalResourceId"]
+    assert image_id.startswith("ami-")
+    assert not state["Done"] and not responses
+
+    # A retried poll finds the image already created.
+    retried = xrd_ami.handler({**state, "PhysicalResourceId": None}, None)
+    assert retried["PhysicalResourceId"] == image_id
+
+    state = xrd_ami.handler(state, None)
+    assert state["Done"]
+    assert responses == [("SUCCESS", image_id)]
+
+
+def test_ami_poll_error(responses: list[tuple[str, Any]]) -> None:
+    state = {
+        "Event": {"RequestType": "Create"},
+        "PhysicalResourceId": "log-stream",
+        "Error": {
+            "Error": "RuntimeError",
+            "Cause": json.dumps({"errorMessage": "Image failed"}),
+        },
+    }
+    assert xrd_ami.handler(state, None)["Done"]
+    assert responses == [("FAILED", "log-stream")]
+
+
+def test_ami_next_wait() -> None:
+    now = datetime.datetime(2026, 1, 1, 0, 10, tzinfo=datetime.timezone.utc)
+    started = now - datetime.timedelta(seconds=30)
+    snapshot = {"State": "pending", "StartTime": started}
+
+    # 60% done in 30s, so 20s to go.
+    assert xrd_ami.next_wait([{**snapshot, "Progress": "60%"}], now) == 20
+    # The slowest snapshot decides, within the bounds.
+    assert (
+        xrd_ami.next_wait(
+            [
+                {**snapshot, "Progress": "1%"},
+                {**snapshot, "State": "completed", "Progress": "100%"},
+            ],
+            now,
+        )
+        == xrd_ami.MAX_WAIT
+    )
+    assert (
+        xrd_ami.next_wait([{**snapshot, "Progress": "99%"}], now)
+        == xrd_ami.MIN_WAIT
+    )
+    # No progress to estimate from.
+    assert (
+        xrd_ami.next_wait([{**snapshot, "Progress": ""}], now)
+        == xrd_ami.DEFAULT_WAIT
+    )
+
+
+def test_ami_delete(ec2: Any, responses: list[tuple[str, Any]]) -> None:
+    image_id = ec2.create_image(
+        InstanceId=_stopped_instance(ec2), Name="xrd-ami"
+    )["ImageId"]
+    snapshots = xrd_ami._snapshot_ids(
+        ec2.describe_images(ImageIds=[image_id])["Images"][0]
+    )
+    assert snapshots
+
+    xrd_ami.handler(
+        {"RequestType": "Delete", "PhysicalResourceId": image_id}, None
+    )
+
+    assert responses == [("SUCCESS", image_id)]
+    assert not ec2.describe_images(Owners=["self"])["Images"]
+    assert not ec2.describe_snapshots(
+        Filters=[{"Name": "snapshot-id", "Values": snapshots}]
+    )["Snapshots"]
+
+    # A resource which failed before creating an image has nothing to delete.
+    xrd_ami.handler(
+        {"RequestType": "Delete", "PhysicalResourceId": "log-stream"}, None
+    )
+    assert responses[-1] == ("SUCCESS", "log-stream")
+
+
+def test_kubectl_parse_set_env() -> None:
+    assert xrd_kubectl.parse_set_env(
+        ["ds", "aws-node", "-n", "kube-system", "MAX_ENI=1"]
+    ) == ("daemonset", "aws-node", "kube-system", {"MAX_ENI": "1"})
+    assert xrd_kubectl.parse_set_env(["deploy/web", "A=1", "B=x=y"]) == (
+        "deployment",
+        "web",
+        "default",
+        {"A": "1", "B": "x=y"},
+    )
+    with pytest.raises(ValueError, match="kind"):
+        xrd_kubectl.parse_set_env(["pod/web", "A=1"])
+    with pytest.raises(ValueError, match="option"):
+        xrd_kubectl.parse_set_env(["ds/aws-node", "--all", "A=1"])
+
+
+def test_kubectl_set_env(monkeypatch: pytest.MonkeyPatch) -> None:
+    """``set env`` sends a strategic merge patch of each container's env."""
+    daemonset = {
+        "apiVersion": "apps/v1",
+        "kind": "DaemonSet",
+        "metadata": {"name": "aws-node", "namespace": "kube-system"},
+        "spec": {
+            "selector": {},
+            "template": {
+                "spec": {
+                    "containers": [
+                        {"name": "aws-node"},
+                        {"name": "aws-eks-nodeagent"},
+                    ]
+                }
+            },
+        },
+    }
+    requests = []
+
+    def call_api(
+        self: Any,
+        method: str,
+        url: str,
+        header_params: dict[str, str],
+        body: Any,
+        *args,
+        **kwargs,
+    ) -> Any:
+        requests.append((method, url, header_params, body))
+        return kubernetes.client.rest.RESTResponse(
+            types.SimpleNamespace(
+                status=200,
+                reason="OK",
+                data=json.dumps(daemonset).encode(),
+                headers={"Content-Type": "application/json"},
+            )
+        )
+
+    monkeypatch.setattr(kubernetes.client.ApiClient, "call_api", call_api)
+    api_client = kubernetes.client.ApiClient(
+        kubernetes.client.Configuration(host="https://eks.example.com")
+    )
+
+    output = xrd_kubectl.run_command(
+        api_client, "set env ds aws-node -n kube-system MAX_ENI=1 A=b"
+    )
+
+    assert output == "daemonset/aws-node env updated"
+    path = "https://eks.example.com/apis/apps/v1/namespaces/kube-system/"
+    assert [(method, url) for method, url, _, _ in requests] == [
+        ("GET", f"{path}daemonsets/aws-node"),
+        ("PATCH", f"{path}daemonsets/aws-node?fieldManager=xrd-kubectl"),
+    ]
+    _, _, headers, body = requests[1]
+    assert headers["Content-Type"] == "application/strategic-merge-patch+json"
+    env = [{"name": "MAX_ENI", "value": "1"}, {"name": "A", "value": "b"}]
+    assert body == {
+        "spec": {
+            "template": {
+                "spec": {
+                    "containers": [
+                        {"name": "aws-node", "env": env},
+                        {"name": "aws-eks-nodeagent", "env": env},
+                    ]
+                }
+            }
+        }
+    }
+
+
+def test_kubectl_kubeconfig_cached(
+    aws: None, monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+) -> None:
+    """The cluster is described once, and its kubeconfig reused until the
+    token is due to expire."""
+    monkeypatch.setattr(xrd_kubectl, "KUBECONFIG_DIR", str(tmp_path))
+    monkeypatch.setattr(xrd_kubectl, "_clusters", {})
+    eks = boto3.client("eks", region_name=REGION)
+    eks.create_cluster(
+        name="xrd-cluster",
+        roleArn="arn:aws:iam::123456789012:role/eks",
+        resourcesVpcConfig={},
+    )
+    counter = CallCounter(eks)
+
+    path = xrd_kubectl.kubeconfig(eks, "xrd-cluster")
+    written = Path(path).read_text()
+    assert "k8s-aws-v1." in written
+    assert xrd_kubectl.kubeconfig(eks, "xrd-cluster") == path
+    assert Path(path).read_text() == written
+    assert counter.calls == ["DescribeCluster"]
+
+    # Expired tokens are replaced.
+    expired = time.time() - xrd_kubectl.TOKEN_TTL - 1
+    os.utime(path, (expired, expired))
+    assert xrd_kubectl.kubeconfig(eks, "xrd-cluster") == path
+    assert Path(path).stat().st_mtime > expired
+    assert counter.calls == ["DescribeCluster"]
+
+
+def test_kubectl_handler_commands(
+    monkeypatch: pytest.MonkeyPatch, responses: list[tuple[str, Any]]
+) -> None:
+    """A resource's commands are run in order, in one invocation."""
+    monkeypatch.setattr(xrd_kubectl.cfn_response, "send", _record(responses))
+    monkeypatch.setattr(xrd_kubectl.boto3, "client", lambda *a, **kw: None)
+    monkeypatch.setattr(xrd_kubectl, "kubeconfig", lambda eks, name: name)
+    monkeypatch.setattr(xrd_kubectl, "_api_client", lambda path: path)
+    commands = []
+
+    def run_command(api_client: Any, command: str) -> str:
+        commands.append((api_client, command))
+        return command
+
+    monkeypatch.setattr(xrd_kubectl, "run_command", run_command)
+
+    xrd_kubectl.handler(
+        {
+            "RequestType": "Create",
+            "PhysicalResourceId": "cluster-config",
+            "ResourceProperties": {
+                "ClusterName": "xrd-cluster",
+                "Commands": ["set env ds aws-node MAX_ENI=1", "apply -f x"],
+            },
+        },
+        types.SimpleNamespace(log_stream_name="log-stream"),
+    )
+
+    assert commands == [
+        ("xrd-cluster", "set env ds aws-node MAX_ENI=1"),
+        ("xrd-cluster", "apply -f x"),
+    ]
+    assert responses == [("SUCCESS", "cluster-config")]
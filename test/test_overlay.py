@@ -2,29 +2,65 @@
 
 """End-to-end tests for the Overlay application."""
 
-
+import concurrent.futures
+import functools
+import logging
 import subprocess
 
+import kubernetes.client
 import pytest
 
-from . import utils
-from ._types import Kubectl, Platform
+from . import utils, xr_output
+from ._types import Platform, PodExec
 from .helm import Helm
 
 
+logger = logging.getLogger(__name__)
+
 pytestmark = pytest.mark.platform(Platform.XRD_VROUTER)
 
 
+# The quickstart example is installed by the stack in the default namespace,
+# rather than the tests' namespace, so override the fixtures to use it.
+
+
+@pytest.fixture(scope="module")
+def helm(k8s: kubernetes.client.CoreV1Api) -> Helm:
+    return Helm(k8s=k8s, namespace="default")
+
+
+@pytest.fixture(scope="module")
+def pod_exec(pod_exec: PodExec) -> PodExec:
+    return functools.partial(pod_exec, namespace="default")
+
+
+def _bgp_show(pod_exec: PodExec, pod_name: str) -> str:
+    """Return the brief BGP neighbor output of an XRd pod."""
+    p = pod_exec(
+        pod_name,
+        "xrenv",
+        "bgp_show",
+        "-V",
+        "default",
+        "-n",
+        "-br",
+        "-instance",
+        "default",
+        log_output=True,
+    )
+    return p.stdout
+
+
 def check_bgp_established(
-    kubectl: Kubectl,
+    pod_exec: PodExec,
     pod_name: str,
     neighbor: str,
 ) -> bool:
     """
     Check whether a BGP session is established with the given neighbor.
 
-    :param kubectl:
-        Kubectl context.
+    :param pod_exec:
+        Function to run a command in a pod.
 
     :param pod_name:
         Pod from which to check BGP connectivity.
@@ -38,42 +74,25 @@ def check_bgp_established(
 
     """
     try:
-        p = kubectl(
-            "exec",
-            pod_name,
-            "--",
-            "xrenv",
-            "bgp_show",
-            "-V",
-            "default",
-            "-n",
-            "-br",
-            "-instance",
-            "default",
-            log_output=True,
-        )
-    except subprocess.CalledProcessError:
+        output = _bgp_show(pod_exec, pod_name)
+    except (
+        subprocess.CalledProcessError,
+        subprocess.TimeoutExpired,
+        ConnectionError,
+    ):
         return False
 
-    # Example output:
-    #
-    # Neighbor        Spk    AS Description                          Up/Down  NBRState
-    # 10.1.0.2          0     1                                      00:17:12 Established
-    # 100.0.0.1         0     1                                      00:15:44 Established
-    #
-    # Grab the fifth column of the correct neighbour.
-    for line in p.stdout.strip().splitlines():
-        cols = line.split()
-        if cols[0] == neighbor:
-            if cols[4] == "Established":
-                return True
-            break
+    for n in xr_output.parse_bgp_brief(output):
+        if n.neighbor == neighbor:
+            return n.established
 
     return False
 
 
 @pytest.mark.quickstart
-def test_quickstart(kubectl: Kubectl, helm: Helm) -> None:
+def test_quickstart(
+    request: pytest.FixtureRequest, pod_exec: PodExec, helm: Helm
+) -> None:
     """XRd QuickStart should install the example Overlay application."""
     expected_release_name = "xrd-example"
 
@@ -83,48 +102,72 @@ def test_quickstart(kubectl: Kubectl, helm: Helm) -> None:
     release = releases[0]
     assert release.name == expected_release_name
 
-    if not utils.wait_until(
-        5,
-        60,
-        check_bgp_established,
-        kubectl,
-        f"{expected_release_name}-xrd1-0",
-        "1.0.0.12",
-    ):
-        assert False, f"BGP not established"
-
-    if not utils.wait_until(
-        5,
-        60,
-        check_bgp_established,
-        kubectl,
-        f"{expected_release_name}-xrd2-0",
-        "1.0.0.11",
-    ):
-        assert False, f"BGP not established"
-
-    for address in ("10.0.2.12", "10.0.3.12"):
-        if not utils.wait_until(
-            5,
-            60,
-            utils.check_ping,
-            kubectl,
-            f"{expected_release_name}-xrd1-0",
-            address,
-        ):
-            assert (
-                False
-            ), f"Could not ping {address} from f{expected_release_name}-xrd1-0"
-
-    for address in ("10.0.2.11", "10.0.3.11"):
-        if not utils.wait_until(
-            5,
-            60,
-            utils.check_ping,
-            kubectl,
-            f"{expected_release_name}-xrd2-0",
-            address,
-        ):
-            assert (
-                False
-            ), f"Could not ping {address} from f{expected_release_name}-xrd2-0"
+    xrd1 = f"{expected_release_name}-xrd1-0"
+    xrd2 = f"{expected_release_name}-xrd2-0"
+    neighbors = {xrd1: "1.0.0.12", xrd2: "1.0.0.11"}
+    pings = {
+        xrd1: ("10.0.2.12", "10.0.3.12"),
+        xrd2: ("10.0.2.11", "10.0.3.11"),
+    }
+    checks = [
+        utils.Check(
+            f"BGP established from {pod_name} to {neighbor}",
+            functools.partial(
+                check_bgp_established, pod_exec, pod_name, neighbor
+            ),
+        )
+        for pod_name, neighbor in neighbors.items()
+    ]
+    for pod_name, addresses in pings.items():
+        for address in addresses:
+            checks.append(
+                utils.Check(
+                    f"Ping {address} from {pod_name}",
+                    functools.partial(
+                        utils.check_ping, pod_exec, pod_name, address
+                    ),
+                )
+            )
+
+    utils.assert_checks(checks)
+
+    # Once converged, the overlay should stay up: sample it a few times, each
+    # time running all the commands at once, and check no BGP session resets.
+    # The ping loss and RTTs are reported, and checked against any budgets
+    # given.
+    options = request.config.option
+    ping_samples = xr_output.PingSamples()
+    bgp_samples = xr_output.BgpSamples()
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        for _ in range(options.overlay_stability_samples):
+            ping_futures = [
+                executor.submit(pod_exec, pod_name, "xrenv", "ping", address)
+                for pod_name, addresses in pings.items()
+                for address in addresses
+            ]
+            bgp_futures = {
+                pod_name: executor.submit(_bgp_show, pod_exec, pod_name)
+                for pod_name in neighbors
+            }
+            for future in ping_futures:
+                ping_samples.append(
+                    xr_output.parse_ping(future.result().stdout)
+                )
+            for pod_name, future in bgp_futures.items():
+                bgp_samples.append(
+                    n
+                    for n in xr_output.parse_bgp_brief(future.result())
+                    if n.neighbor == neighbors[pod_name]
+                )
+
+    loss = ping_samples.loss()
+    rtt_p99 = ping_samples.rtt_percentile(99)
+    logger.info("Ping loss %.1f%%, RTT p99 %.1f ms", loss * 100, rtt_p99)
+    request.node.user_properties.append(("ping_loss", loss))
+    request.node.user_properties.append(("ping_rtt_p99", rtt_p99))
+    if options.ping_loss_budget is not None:
+        assert loss <= options.ping_loss_budget
+    if options.ping_rtt_p99_budget is not None:
+        assert rtt_p99 <= options.ping_rtt_p99_budget
+    for neighbor in neighbors.values():
+        assert bgp_samples.flaps(neighbor) == 0, neighbor
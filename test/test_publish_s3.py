@@ -0,0 +1,172 @@
+# test_publish_s3.py
+
+"""
+Tests for the incremental publishing of the XRd S3 bucket, against S3 mocked
+by moto.
+
+These don't need AWS or a cluster, e.g.::
+
+    pytest test_publish_s3.py
+
+"""
+
+import json
+import sys
+from pathlib import Path
+from typing import Any
+
+import boto3
+import pytest
+
+
+moto = pytest.importorskip("moto")
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import publish_s3  # noqa: E402
+
+
+REGION = "us-east-1"
+BUCKET = "123456789012-xrd-quickstart"
+PREFIX = "xrd-eks/"
+
+LAMBDA = "GetCallerArn/lambda.zip"
+LAMBDA_KEY = (
+    f"{PREFIX}submodules/quickstart-amazon-eks/functions/packages/{LAMBDA}"
+)
+
+
+@pytest.fixture
+def s3(monkeypatch: pytest.MonkeyPatch) -> Any:
+    """
+    Fixture which provides an S3 client, with an empty XRd bucket and a
+    versioned QuickStart bucket.  The client records the API calls made
+    (``s3.calls``).
+
+    """
+    for var in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+        monkeypatch.setenv(var, "testing")
+    with moto.mock_aws():
+        s3 = boto3.client("s3", region_name=REGION)
+        s3.create_bucket(Bucket=BUCKET)
+        s3.create_bucket(Bucket=publish_s3.QUICKSTART_BUCKET)
+        s3.put_bucket_versioning(
+            Bucket=publish_s3.QUICKSTART_BUCKET,
+            VersioningConfiguration={"Status": "Enabled"},
+        )
+        s3.calls = []
+        s3.meta.events.register_first(
+            "before-call.s3.*",
+            lambda model, **kwargs: s3.calls.append(model.name),
+        )
+        yield s3
+
+
+@pytest.fixture
+def lambdas(s3: Any) -> dict[str, str]:
+    """Fixture which provides a pinned Lambda, with a newer version."""
+    key = f"{publish_s3.QUICKSTART_PREFIX}{LAMBDA}"
+    version = s3.put_object(
+        Bucket=publish_s3.QUICKSTART_BUCKET, Key=key, Body=b"pinned"
+    )["VersionId"]
+    s3.put_object(Bucket=publish_s3.QUICKSTART_BUCKET, Key=key, Body=b"newer")
+    s3.calls.clear()
+    return {LAMBDA: version}
+
+
+@pytest.fixture
+def root(tmp_path: Path) -> Path:
+    """Fixture which provides a checkout to publish."""
+    files = {
+        "cf-templates/xrd-example-cf.yaml": "Resources: {}\n",
+        "cf-templates/xrd-eks-ami-cf.yaml": "Resources: {}\n",
+        "ami_assets/etc/xrd/xrd-vrouter-build-ami.sh": "#!/bin/bash\n",
+        "functions/packages/XrdAmi/lambda.zip": "zip",
+        "submodules/quickstart-amazon-eks/templates/eks.yaml": "{}\n",
+        "README.md": "Not published\n",
+    }
+    for name, content in files.items():
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+    return tmp_path
+
+
+def _keys(s3: Any) -> set[str]:
+    return {
+        obj["Key"]
+        for obj in s3.list_objects_v2(Bucket=BUCKET).get("Contents", [])
+    }
+
+
+def _publish(s3: Any, root: Path, lambdas: dict[str, str], **kwargs) -> Any:
+    changes = publish_s3.publish(
+        s3, BUCKET, PREFIX, root, lambdas=lambdas, **kwargs
+    )
+    s3.calls.clear()
+    return changes
+
+
+def test_publish_first(s3: Any, root: Path, lambdas: dict[str, str]) -> None:
+    """With no manifest, everything is published, and keys which aren't in
+    the checkout are deleted."""
+    s3.put_object(Bucket=BUCKET, Key=f"{PREFIX}cf-templates/old.yaml")
+    s3.put_object(Bucket=BUCKET, Key="unrelated")
+
+    changes = _publish(s3, root, lambdas)
+
+    assert len(changes.upload) == 5
+    assert changes.copy == [LAMBDA_KEY]
+    assert changes.delete == [f"{PREFIX}cf-templates/old.yaml"]
+    assert _keys(s3) == {
+        "unrelated",
+        f"{PREFIX}{publish_s3.MANIFEST_KEY}",
+        f"{PREFIX}ami_assets/etc/xrd/xrd-vrouter-build-ami.sh",
+        f"{PREFIX}cf-templates/xrd-eks-ami-cf.yaml",
+        f"{PREFIX}cf-templates/xrd-example-cf.yaml",
+        f"{PREFIX}functions/packages/XrdAmi/lambda.zip",
+        f"{PREFIX}submodules/quickstart-amazon-eks/templates/eks.yaml",
+        LAMBDA_KEY,
+    }
+    # The pinned version of the Lambda is copied, not the latest.
+    body = s3.get_object(Bucket=BUCKET, Key=LAMBDA_KEY)["Body"].read()
+    assert body == b"pinned"
+    manifest_key = PREFIX + publish_s3.MANIFEST_KEY
+    manifest = json.load(
+        s3.get_object(Bucket=BUCKET, Key=manifest_key)["Body"]
+    )
+    assert manifest == publish_s3.build_manifest(root, PREFIX, lambdas=lambdas)
+
+
+def test_publish_incremental(
+    s3: Any, root: Path, lambdas: dict[str, str]
+) -> None:
+    """Republishing only uploads and deletes what changed."""
+    _publish(s3, root, lambdas)
+
+    changes = _publish(s3, root, lambdas)
+    assert len(changes) == 0
+
+    (root / "cf-templates/xrd-example-cf.yaml").write_text("Resources: {}\n#")
+    (root / "cf-templates/xrd-eks-ami-cf.yaml").unlink()
+    changes = publish_s3.publish(s3, BUCKET, PREFIX, root, lambdas=lambdas)
+
+    assert changes.upload == [f"{PREFIX}cf-templates/xrd-example-cf.yaml"]
+    assert changes.copy == []
+    assert changes.delete == [f"{PREFIX}cf-templates/xrd-eks-ami-cf.yaml"]
+    assert sorted(s3.calls) == [
+        "DeleteObjects",
+        "GetObject",
+        "PutObject",
+        "PutObject",
+    ]
+    assert f"{PREFIX}cf-templates/xrd-eks-ami-cf.yaml" not in _keys(s3)
+
+
+def test_publish_full(s3: Any, root: Path, lambdas: dict[str, str]) -> None:
+    """A full publish ignores the manifest."""
+    _publish(s3, root, lambdas)
+    changes = _publish(s3, root, lambdas, full=True)
+    assert len(changes.upload) == 5
+    assert changes.copy == [LAMBDA_KEY]
@@ -3,29 +3,60 @@
 """End-to-end tests for the Singleton application."""
 
 import datetime
+import functools
+import logging
 import subprocess
 import textwrap
 
+import kubernetes.client
 import pytest
 
-from . import utils
-from ._types import Image, Kubectl, Platform
+from . import restart_latency, sharding, utils
+from ._types import Image, Kubectl, Platform, PodExec
 from .helm import Helm
 
 
+logger = logging.getLogger(__name__)
+
+
 @pytest.fixture(autouse=True)
-def uninstall_releases(helm: Helm) -> None:
-    """Uninstall all Helm releases before and after each test case."""
-    for release in helm.list():
-        helm.uninstall(release, wait=True)
+def reservation(
+    request: pytest.FixtureRequest,
+    image: Image,
+    admission: sharding.Admission,
+    helm: Helm,
+    example_release: None,
+) -> sharding.Reservation:
+    """
+    Reserve node resources for the test case, so test cases can run in
+    parallel up to the cluster's capacity.  Test cases which use the node's
+    PCI interfaces are marked ``pci``.
 
-    yield
+    All Helm releases in the test case's namespace are uninstalled before the
+    resources are reserved and again before they are released, so nothing
+    else in the namespace uses them.  The quickstart example is restored at
+    the end of the session (see `example_release`).
 
-    for release in helm.list():
-        helm.uninstall(release, wait=True)
+    """
+    requirements = sharding.Requirements()
+    if image.platform is Platform.XRD_VROUTER:
+        requirements.hugepages_gi = sharding.VROUTER_HUGEPAGES_GI
+    if request.node.get_closest_marker("pci"):
+        requirements.pci = True
+
+    helm.uninstall_all(wait=True)
+    reservation = admission.reserve(request.node.nodeid, requirements)
+    yield reservation
+    helm.uninstall_all(wait=True)
+    admission.release(reservation)
 
 
-def test_install(image: Image, kubectl: Kubectl, helm: Helm) -> None:
+def test_install(
+    image: Image,
+    kubectl: Kubectl,
+    helm: Helm,
+    reservation: sharding.Reservation,
+) -> None:
     release = helm.install(
         f"xrd/{image.platform}",
         name="xrd",
@@ -34,12 +65,42 @@ def test_install(image: Image, kubectl: Kubectl, helm: Helm) -> None:
                 "repository": image.repository,
                 "tag": image.tag,
             },
+            "nodeSelector": reservation.node_selector(),
         },
         wait=True,
     )
 
 
-def test_upgrade(image: Image, kubectl: Kubectl, helm: Helm) -> None:
+def test_get_values(
+    image: Image,
+    helm: Helm,
+    reservation: sharding.Reservation,
+) -> None:
+    """Values read from the release Secrets are those Helm reports."""
+    values = {
+        "image": {
+            "repository": image.repository,
+            "tag": image.tag,
+        },
+        "nodeSelector": reservation.node_selector(),
+    }
+    release = helm.install(f"xrd/{image.platform}", name="xrd", values=values)
+    config = {"config": {"ascii": "hostname foo"}}
+    helm.upgrade(release, reuse_values=True, values=config)
+
+    assert helm.k8s is not None
+    assert helm.get_values(release) == {**values, **config}
+    cli = Helm(kubeconfig=helm.kubeconfig, namespace=helm.namespace)
+    assert helm.get_values(release) == cli.get_values(release)
+    assert helm.list() == cli.list()
+
+
+def test_upgrade(
+    image: Image,
+    pod_exec: PodExec,
+    helm: Helm,
+    reservation: sharding.Reservation,
+) -> None:
     release = helm.install(
         f"xrd/{image.platform}",
         name="xrd",
@@ -48,6 +109,7 @@ def test_upgrade(image: Image, kubectl: Kubectl, helm: Helm) -> None:
                 "repository": image.repository,
                 "tag": image.tag,
             },
+            "nodeSelector": reservation.node_selector(),
         },
         wait=True,
     )
@@ -68,24 +130,21 @@ def test_upgrade(image: Image, kubectl: Kubectl, helm: Helm) -> None:
     # for the new config to get applied, so use a predicate.
     def check_hostname(expected_hostname: str) -> bool:
         try:
-            p = kubectl(
-                "exec",
+            p = pod_exec(
                 f"xrd-{image.platform}-0",
-                "--",
                 "hostname",
                 log_output=True,
             )
-        except subprocess.CalledProcessError:
+        except (
+            subprocess.CalledProcessError,
+            subprocess.TimeoutExpired,
+            ConnectionError,
+        ):
             return False
 
         return expected_hostname in p.stdout
 
-    if not utils.wait_until(
-        5,
-        60,
-        check_hostname,
-        "foo",
-    ):
+    if not utils.poll(functools.partial(check_hostname, "foo"), timeout=60):
         assert False, f"Hostname not updated"
 
 
@@ -93,6 +152,7 @@ def test_persistence(
     image: Image,
     kubectl: Kubectl,
     helm: Helm,
+    reservation: sharding.Reservation,
 ) -> None:
     """
     Check it is possible to write to a persistent volume used by the XRd Pod,
@@ -107,6 +167,7 @@ def test_persistence(
                 "repository": image.repository,
                 "tag": image.tag,
             },
+            "nodeSelector": reservation.node_selector(),
             "persistence": {
                 "enabled": True,
             },
@@ -137,8 +198,102 @@ def test_persistence(
     assert now in p.stdout
 
 
+@pytest.fixture
+def storage_class(
+    request: pytest.FixtureRequest, storage: kubernetes.client.StorageV1Api
+) -> str:
+    """
+    Fixture which provides each StorageClass given in
+    ``--restart-benchmark-storage-classes``, creating it if necessary.
+
+    """
+    try:
+        restart_latency.ensure_storage_class(storage, request.param)
+    except ValueError as e:
+        pytest.skip(str(e))
+    return request.param
+
+
+@pytest.mark.benchmark
+def test_persistence_restart_latency(
+    request: pytest.FixtureRequest,
+    image: Image,
+    kubectl: Kubectl,
+    k8s: kubernetes.client.CoreV1Api,
+    namespace: str,
+    helm: Helm,
+    reservation: sharding.Reservation,
+    storage_class: str,
+) -> None:
+    """
+    Measure how long an XRd Pod with a persistent volume takes to come back
+    after it is deleted, over ``--restart-benchmark`` restarts, and check its
+    data persists throughout.
+
+    """
+    helm.install(
+        f"xrd/{image.platform}",
+        name="xrd",
+        values={
+            "image": {
+                "repository": image.repository,
+                "tag": image.tag,
+            },
+            "nodeSelector": reservation.node_selector(),
+            "persistence": {
+                "enabled": True,
+                "storageClass": storage_class,
+            },
+        },
+        wait=True,
+    )
+
+    pod_name = f"xrd-{image.platform}-0"
+    now = str(datetime.datetime.now())
+    kubectl(
+        "exec",
+        pod_name,
+        "--",
+        "/bin/bash",
+        "-c",
+        f"echo {now} > /xr-storage/out.txt",
+    )
+
+    samples = restart_latency.results.setdefault(
+        f"{storage_class}, {image.platform}:{image.tag}",
+        restart_latency.RestartSamples(),
+    )
+    for _ in range(request.config.option.restart_benchmark):
+        samples.append(
+            restart_latency.measure_restart(
+                k8s, kubectl, pod_name, namespace=namespace
+            )
+        )
+    logger.info(
+        "Restart latency with %s:\n%s", storage_class, samples.summary()
+    )
+    request.node.user_properties.append(
+        ("restart_latency_p99", samples.percentile("total", 99))
+    )
+
+    p = kubectl(
+        "exec",
+        pod_name,
+        "--",
+        "/bin/bash",
+        "-c",
+        "cat /xr-storage/out.txt",
+    )
+    assert now in p.stdout
+
+
 @pytest.mark.platform(Platform.XRD_CONTROL_PLANE)
-def test_default_cni(image: Image, kubectl: Kubectl, helm: Helm) -> None:
+def test_default_cni(
+    image: Image,
+    pod_exec: PodExec,
+    helm: Helm,
+    reservation: sharding.Reservation,
+) -> None:
     """
     Check configuration of an XR interface backed by the default CNI interface.
 
@@ -152,16 +307,15 @@ def test_default_cni(image: Image, kubectl: Kubectl, helm: Helm) -> None:
                 "repository": image.repository,
                 "tag": image.tag,
             },
+            "nodeSelector": reservation.node_selector(),
             "config": {
-                "ascii": textwrap.dedent(
-                    f"""
+                "ascii": textwrap.dedent(f"""
                     hostname xrd
                     interface Gi0/0/0/0
                      ipv4 address {address} 255.255.255.0
                     !
 
-                    """
-                ).strip(),
+                    """).strip(),
             },
             "interfaces": [
                 {
@@ -173,14 +327,23 @@ def test_default_cni(image: Image, kubectl: Kubectl, helm: Helm) -> None:
         wait=True,
     )
 
-    if not utils.wait_until(
-        5, 60, utils.check_ping, kubectl, f"xrd-{image.platform}-0", address
+    if not utils.poll(
+        functools.partial(
+            utils.check_ping, pod_exec, f"xrd-{image.platform}-0", address
+        ),
+        timeout=60,
     ):
         assert False, f"Could not ping {address}"
 
 
 @pytest.mark.platform(Platform.XRD_VROUTER)
-def test_pci_last(image: Image, kubectl: Kubectl, helm: Helm):
+@pytest.mark.pci
+def test_pci_last(
+    image: Image,
+    pod_exec: PodExec,
+    helm: Helm,
+    reservation: sharding.Reservation,
+):
     """
     Check configuration of XR interfaces backed by PCI interfaces using the
     ``last: n`` Helm chart value.
@@ -195,16 +358,15 @@ def test_pci_last(image: Image, kubectl: Kubectl, helm: Helm):
                 "repository": image.repository,
                 "tag": image.tag,
             },
+            "nodeSelector": reservation.node_selector(),
             "config": {
-                "ascii": textwrap.dedent(
-                    f"""
+                "ascii": textwrap.dedent(f"""
                     hostname xrd
                     interface Hu0/0/0/0
                      ipv4 address {address} 255.255.255.0
                     !
 
-                    """
-                ).strip(),
+                    """).strip(),
             },
             "interfaces": [
                 {
@@ -218,7 +380,10 @@ def test_pci_last(image: Image, kubectl: Kubectl, helm: Helm):
         wait=True,
     )
 
-    if not utils.wait_until(
-        5, 60, utils.check_ping, kubectl, f"xrd-{image.platform}-0", address
+    if not utils.poll(
+        functools.partial(
+            utils.check_ping, pod_exec, f"xrd-{image.platform}-0", address
+        ),
+        timeout=60,
     ):
         assert False, f"Could not ping {address}"
@@ -0,0 +1,310 @@
+# test_stack_cache.py
+
+"""
+Tests for the lookup and update of reusable stacks, against CloudFormation and
+S3 mocked by moto.
+
+These don't need AWS or a cluster, e.g.::
+
+    pytest test_stack_cache.py
+
+"""
+
+import datetime
+import json
+from pathlib import Path
+from typing import Any
+
+import boto3
+import pytest
+from botocore.stub import Stubber
+
+from . import stack_cache
+
+
+moto = pytest.importorskip("moto")
+
+REGION = "us-east-1"
+BUCKET = "xrd-quickstart-us-east-1"
+PREFIX = "xrd-eks/"
+
+ROOT_TEMPLATE = "xrd-example-cf.yaml"
+NESTED_TEMPLATE = "xrd-eks-new-vpc-cf.yaml"
+
+PARAMETERS = {"ClusterName": "xrd-cluster", "Application": "Overlay"}
+
+STACK_TEMPLATE = json.dumps(
+    {
+        "Parameters": {
+            "ClusterName": {"Type": "String", "Default": "default"}
+        },
+        "Resources": {"Topic": {"Type": "AWS::SNS::Topic"}},
+    }
+)
+
+STACK_PREFIX = "tCaT-xrd-eks-xrd-example-overlay-"
+
+
+@pytest.fixture
+def aws(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Fixture which mocks AWS services."""
+    for var in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+        monkeypatch.setenv(var, "testing")
+    with moto.mock_aws():
+        yield
+
+
+@pytest.fixture
+def s3(aws: None) -> Any:
+    """Fixture which provides an S3 client, with a published bucket."""
+    s3 = boto3.client("s3", region_name=REGION)
+    s3.create_bucket(Bucket=BUCKET)
+    for key, body in {
+        f"cf-templates/{ROOT_TEMPLATE}": "Resources: {}\n",
+        f"cf-templates/{NESTED_TEMPLATE}": "Resources: {}\n",
+        "ami_assets/etc/xrd/bootstrap.sh": "#!/bin/bash\n",
+        "functions/packages/XrdAmi/lambda.zip": "zip",
+        "README.md": "Not fingerprinted\n",
+    }.items():
+        _publish(s3, key, body)
+    return s3
+
+
+@pytest.fixture
+def cf(aws: None) -> Any:
+    """Fixture which provides a CloudFormation client, with other stacks."""
+    cf = boto3.client("cloudformation", region_name=REGION)
+    cf.create_stack(StackName="unrelated", TemplateBody=STACK_TEMPLATE)
+    cf.create_stack(
+        StackName=f"{STACK_PREFIX}untagged", TemplateBody=STACK_TEMPLATE
+    )
+    return cf
+
+
+def _publish(s3: Any, key: str, body: str) -> None:
+    s3.put_object(Bucket=BUCKET, Key=f"{PREFIX}{key}", Body=body.encode())
+
+
+def _fingerprint(s3: Any, **kwargs) -> stack_cache.Fingerprint:
+    return stack_cache.fingerprint(
+        s3,
+        BUCKET,
+        PREFIX,
+        kwargs.pop("root_template", ROOT_TEMPLATE),
+        kwargs.pop("parameters", PARAMETERS),
+        **kwargs,
+    )
+
+
+def _create_stack(cf: Any, name: str, fp: stack_cache.Fingerprint) -> str:
+    name = f"{STACK_PREFIX}{name}"
+    cf.create_stack(
+        StackName=name,
+        TemplateBody=STACK_TEMPLATE,
+        Parameters=[
+            {"ParameterKey": "ClusterName", "ParameterValue": "xrd-cluster"}
+        ],
+        Tags=fp.tags(),
+    )
+    return name
+
+
+def _tags(cf: Any, name: str) -> dict[str, str]:
+    stack = cf.describe_stacks(StackName=name)["Stacks"][0]
+    return {t["Key"]: t["Value"] for t in stack["Tags"]}
+
+
+def test_find_stack_exact(s3: Any, cf: Any) -> None:
+    """A stack with the same fingerprint is found, and needs no update."""
+    fp = _fingerprint(s3)
+    name = _create_stack(cf, "a", fp)
+
+    match = stack_cache.find_stack(cf, fp, name_prefix=STACK_PREFIX)
+
+    assert match == stack_cache.StackMatch(name, [])
+    assert match.exact
+    # The fingerprint is of the bucket, not of what isn't published from it.
+    _publish(s3, "README.md", "Changed\n")
+    assert _fingerprint(s3) == fp
+
+
+def test_find_stack_other_parameters(s3: Any, cf: Any) -> None:
+    """A stack with different parameters isn't found."""
+    _create_stack(cf, "a", _fingerprint(s3))
+    fp = _fingerprint(s3, parameters={**PARAMETERS, "ClusterName": "other"})
+    assert stack_cache.find_stack(cf, fp, name_prefix=STACK_PREFIX) is None
+    fp = _fingerprint(s3, kubernetes_version="1.24")
+    assert stack_cache.find_stack(cf, fp, name_prefix=STACK_PREFIX) is None
+
+
+@pytest.mark.parametrize(
+    "key",
+    [
+        "ami_assets/etc/xrd/bootstrap.sh",
+        "functions/packages/XrdAmi/lambda.zip",
+    ],
+)
+def test_find_stack_assets_changed(s3: Any, cf: Any, key: str) -> None:
+    """A stack whose AMI assets or Lambda packages have changed in the bucket
+    isn't found, as updating it in place wouldn't apply the change."""
+    _create_stack(cf, "a", _fingerprint(s3))
+    _publish(s3, key, "changed")
+    fp = _fingerprint(s3)
+    assert stack_cache.find_stack(cf, fp, name_prefix=STACK_PREFIX) is None
+
+
+def test_find_stack_nested_template_changed(
+    s3: Any, cf: Any, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """A stack whose nested templates have changed in the bucket is found,
+    and updating it retags it so it then matches exactly."""
+    # CloudFormation updates a stack whose tags have changed, even if its
+    # template and parameters haven't, but moto rejects such updates.
+    monkeypatch.setattr(
+        moto.cloudformation.responses.CloudFormationResponse,
+        "_validate_different_update",
+        lambda *args: None,
+    )
+    old_fp = _fingerprint(s3)
+    name = _create_stack(cf, "a", old_fp)
+    _publish(s3, f"cf-templates/{NESTED_TEMPLATE}", "Resources: {} # new\n")
+    _publish(s3, "cf-templates/xrd-new-cf.yaml", "Resources: {}\n")
+    fp = _fingerprint(s3)
+    assert fp.value != old_fp.value
+
+    match = stack_cache.find_stack(cf, fp, name_prefix=STACK_PREFIX)
+
+    assert match == stack_cache.StackMatch(
+        name, [NESTED_TEMPLATE, "xrd-new-cf.yaml"]
+    )
+    assert not match.exact
+
+    stack_cache.update_stack(cf, name, fp)
+
+    tags = _tags(cf, name)
+    assert tags[stack_cache.FINGERPRINT_TAG] == fp.value
+    assert tags == {t["Key"]: t["Value"] for t in fp.tags()}
+    stack = cf.describe_stacks(StackName=name)["Stacks"][0]
+    assert stack["StackStatus"] == "UPDATE_COMPLETE"
+    assert stack_cache.find_stack(
+        cf, fp, name_prefix=STACK_PREFIX
+    ) == stack_cache.StackMatch(name, [])
+
+
+def test_find_stack_fewest_changes(s3: Any, cf: Any) -> None:
+    """Of several stacks with changed templates, the one with the fewest
+    changes is found."""
+    _create_stack(cf, "a", _fingerprint(s3))
+    _publish(s3, f"cf-templates/{NESTED_TEMPLATE}", "Resources: {} # new\n")
+    name = _create_stack(cf, "b", _fingerprint(s3))
+    _publish(s3, "cf-templates/xrd-new-cf.yaml", "Resources: {}\n")
+
+    match = stack_cache.find_stack(
+        cf, _fingerprint(s3), name_prefix=STACK_PREFIX
+    )
+
+    assert match == stack_cache.StackMatch(name, ["xrd-new-cf.yaml"])
+
+
+def test_find_stack_root_template_changed(s3: Any, cf: Any) -> None:
+    """A stack whose root template has changed isn't found, as an update
+    uses the stack's previous root template."""
+    _create_stack(cf, "a", _fingerprint(s3))
+    _publish(s3, f"cf-templates/{ROOT_TEMPLATE}", "Resources: {} # new\n")
+    fp = _fingerprint(s3)
+    assert stack_cache.find_stack(cf, fp, name_prefix=STACK_PREFIX) is None
+
+
+def test_find_stack_ignored(s3: Any, cf: Any) -> None:
+    """Stacks with another name prefix, nested stacks and stacks which
+    failed aren't found."""
+    fp = _fingerprint(s3)
+    _create_stack(cf, "a", fp)
+    assert stack_cache.find_stack(cf, fp, name_prefix="other-") is None
+
+    stubber = Stubber(cf)
+    stubber.add_response(
+        "describe_stacks",
+        {
+            "Stacks": [
+                _stack("nested", fp, ParentId="parent"),
+                _stack("failed", fp, StackStatus="ROLLBACK_COMPLETE"),
+            ]
+        },
+        {},
+    )
+    with stubber:
+        assert stack_cache.find_stack(cf, fp, name_prefix=STACK_PREFIX) is None
+
+
+def _stack(name: str, fp: stack_cache.Fingerprint, **kwargs) -> dict:
+    return {
+        "StackName": f"{STACK_PREFIX}{name}",
+        "CreationTime": datetime.datetime(2023, 1, 1),
+        "StackStatus": "CREATE_COMPLETE",
+        "Tags": fp.tags(),
+        **kwargs,
+    }
+
+
+def test_find_stack_pagination(s3: Any, cf: Any) -> None:
+    """Stacks on later pages of ``DescribeStacks`` are found."""
+    fp = _fingerprint(s3)
+    old_fp = stack_cache.Fingerprint(
+        fp.root_template,
+        fp.parameters,
+        fp.assets,
+        {**fp.templates, NESTED_TEMPLATE: "old"},
+    )
+    stubber = Stubber(cf)
+    stubber.add_response(
+        "describe_stacks",
+        {"Stacks": [_stack("a", old_fp)], "NextToken": "2"},
+        {},
+    )
+    stubber.add_response(
+        "describe_stacks",
+        {"Stacks": [_stack("b", fp)]},
+        {"NextToken": "2"},
+    )
+
+    with stubber:
+        match = stack_cache.find_stack(cf, fp, name_prefix=STACK_PREFIX)
+
+    stubber.assert_no_pending_responses()
+    assert match == stack_cache.StackMatch(f"{STACK_PREFIX}b", [])
+
+
+def test_unpublished(s3: Any, tmp_path: Path) -> None:
+    """Local files which differ from the bucket are found."""
+    files = {
+        f"cf-templates/{ROOT_TEMPLATE}": "Resources: {}\n",
+        f"cf-templates/{NESTED_TEMPLATE}": "Resources: {} # new\n",
+        "cf-templates/xrd-new-cf.yaml": "Resources: {}\n",
+        "ami_assets/etc/xrd/bootstrap.sh": "#!/bin/bash\n",
+        "functions/packages/XrdAmi/lambda.zip": "zip",
+        "README.md": "Not published\n",
+    }
+    for name, content in files.items():
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+    # Objects uploaded in parts don't have the MD5 of their content as their
+    # ETag, so are assumed to be unchanged.
+    key = f"{PREFIX}ami_assets/large.img"
+    upload_id = s3.create_multipart_upload(Bucket=BUCKET, Key=key)["UploadId"]
+    etag = s3.upload_part(
+        Bucket=BUCKET, Key=key, UploadId=upload_id, PartNumber=1, Body=b"a"
+    )["ETag"]
+    s3.complete_multipart_upload(
+        Bucket=BUCKET,
+        Key=key,
+        UploadId=upload_id,
+        MultipartUpload={"Parts": [{"ETag": etag, "PartNumber": 1}]},
+    )
+    (tmp_path / "ami_assets/large.img").write_text("b")
+
+    assert stack_cache.unpublished(s3, BUCKET, PREFIX, tmp_path) == [
+        f"cf-templates/{NESTED_TEMPLATE}",
+        "cf-templates/xrd-new-cf.yaml",
+    ]
@@ -0,0 +1,65 @@
+# test_utils.py
+
+"""
+Tests for waiting for several checks at once.
+
+These don't need a cluster, e.g.::
+
+    pytest test_utils.py
+
+"""
+
+import pytest
+
+from . import utils
+
+
+def _raise() -> bool:
+    raise RuntimeError("pod not found")
+
+
+def test_run_checks_error() -> None:
+    """A check which raises fails with the exception, and the other checks'
+    results are kept."""
+    calls = []
+
+    def eventually() -> bool:
+        calls.append(None)
+        return len(calls) == 2
+
+    results = utils.run_checks(
+        [
+            utils.Check("ok", lambda: True, timeout=1),
+            utils.Check("error", _raise, timeout=1),
+            utils.Check("eventually", eventually, timeout=1),
+        ],
+        interval=0.01,
+    )
+
+    assert list(results) == ["ok", "error", "eventually"]
+    assert results["ok"].success
+    assert results["ok"].error is None
+    assert results["eventually"].success
+    assert results["eventually"].attempts == 2
+    error = results["error"]
+    assert not error
+    assert isinstance(error.error, RuntimeError)
+    assert error.attempts == 1
+
+
+def test_assert_checks_error() -> None:
+    """All failures are reported, with the first exception chained."""
+    with pytest.raises(AssertionError) as excinfo:
+        utils.assert_checks(
+            [
+                utils.Check("ok", lambda: True, timeout=1),
+                utils.Check("timeout", lambda: False, timeout=0),
+                utils.Check("error", _raise, timeout=1),
+            ]
+        )
+
+    message = str(excinfo.value)
+    assert message.startswith("2 of 3 checks failed:\n")
+    assert "  timeout (gave up after " in message
+    assert "  error (raised RuntimeError('pod not found') after " in message
+    assert isinstance(excinfo.value.__cause__, RuntimeError)
@@ -0,0 +1,165 @@
+# test_xr_output.py
+
+"""
+Tests for the parsers of XR CLI output and the tables of samples, against
+sample CLI output.
+
+These don't need a cluster, e.g.::
+
+    pytest test_xr_output.py
+
+"""
+
+import math
+
+import pytest
+
+from . import xr_output
+
+
+PING_OUTPUT = """\
+Sending 5, 100-byte ICMP Echos to 10.0.2.12, timeout is 2 seconds:
+!!!!!
+Success rate is 100 percent (5/5), round-trip min/avg/max = 1/2/4 ms
+"""
+
+PING_PARTIAL_OUTPUT = """\
+Sending 5, 100-byte ICMP Echos to 10.0.3.12, timeout is 2 seconds:
+!.!.!
+Success rate is 60 percent (3/5), round-trip min/avg/max = 2/5/9 ms
+"""
+
+PING_FAILED_OUTPUT = """\
+Sending 5, 100-byte ICMP Echos to 10.0.2.11, timeout is 2 seconds:
+.....
+Success rate is 0 percent (0/5)
+"""
+
+BGP_OUTPUT = """\
+Neighbor        Spk    AS Description                          Up/Down  NBRState
+10.1.0.2          0     1                                      00:17:12 Established
+100.0.0.1         0     1 route reflector                      1d02h    Established
+1.0.0.12          0 65001                                      never    Idle (Admin)
+10.1.0.3          0     1 peer                                 2w3d     Active
+"""  # noqa: E501
+
+
+def test_parse_ping() -> None:
+    assert xr_output.parse_ping(PING_OUTPUT) == xr_output.PingResult(
+        destination="10.0.2.12",
+        sent=5,
+        received=5,
+        success_rate=100,
+        rtt_min=1.0,
+        rtt_avg=2.0,
+        rtt_max=4.0,
+    )
+    assert xr_output.parse_ping(PING_OUTPUT).success
+    assert not xr_output.parse_ping(PING_PARTIAL_OUTPUT).success
+
+    result = xr_output.parse_ping(PING_FAILED_OUTPUT)
+    assert result == xr_output.PingResult("10.0.2.11", 5, 0, 0)
+    assert not result.success
+
+
+def test_parse_ping_invalid() -> None:
+    with pytest.raises(ValueError):
+        xr_output.parse_ping("% Invalid input detected at '^' marker.")
+
+
+@pytest.mark.parametrize(
+    "value, seconds",
+    [
+        ("00:17:12", 17 * 60 + 12),
+        ("25:00:01", 25 * 3600 + 1),
+        ("1d02h", 86400 + 2 * 3600),
+        ("2w3d", 17 * 86400),
+        ("1y2w", 379 * 86400),
+        ("never", None),
+    ],
+)
+def test_parse_duration(value: str, seconds: float) -> None:
+    assert xr_output.parse_duration(value) == seconds
+
+
+@pytest.mark.parametrize("value", ["", "1:2", "1x", "d"])
+def test_parse_duration_invalid(value: str) -> None:
+    with pytest.raises(ValueError):
+        xr_output.parse_duration(value)
+
+
+def test_parse_bgp_brief() -> None:
+    assert xr_output.parse_bgp_brief(BGP_OUTPUT) == [
+        xr_output.BgpNeighbor(
+            "10.1.0.2", 0, "1", "", 17 * 60 + 12, "Established"
+        ),
+        xr_output.BgpNeighbor(
+            "100.0.0.1", 0, "1", "route reflector", 93600, "Established"
+        ),
+        xr_output.BgpNeighbor(
+            "1.0.0.12", 0, "65001", "", None, "Idle (Admin)"
+        ),
+        xr_output.BgpNeighbor(
+            "10.1.0.3", 0, "1", "peer", 17 * 86400, "Active"
+        ),
+    ]
+    assert [n.established for n in xr_output.parse_bgp_brief(BGP_OUTPUT)] == [
+        True,
+        True,
+        False,
+        False,
+    ]
+
+
+@pytest.mark.parametrize(
+    "q, expected",
+    [(0, 1.0), (50, 2.5), (90, 3.7), (100, 4.0)],
+)
+def test_percentile(q: float, expected: float) -> None:
+    values = [4.0, math.nan, 1.0, 3.0, 2.0]
+    assert xr_output.percentile(values, q) == pytest.approx(expected)
+
+
+def test_percentile_empty() -> None:
+    with pytest.raises(ValueError):
+        xr_output.percentile([math.nan], 50)
+
+
+def test_ping_samples() -> None:
+    samples = xr_output.PingSamples()
+    for output in (PING_OUTPUT, PING_PARTIAL_OUTPUT, PING_FAILED_OUTPUT):
+        samples.append(xr_output.parse_ping(output), timestamp=0)
+
+    assert len(samples) == 3
+    assert samples.loss() == pytest.approx(7 / 15)
+    # Samples without replies have no RTTs, so are ignored.
+    assert samples.rtt_percentile(50) == pytest.approx(3.5)
+    assert samples.rtt_percentile(100, column="rtt_max") == 9
+    assert xr_output.PingSamples().loss() == 0
+
+
+def test_bgp_samples() -> None:
+    samples = xr_output.BgpSamples()
+
+    def sample(up_down: str, state: str = "Established") -> None:
+        samples.append(
+            xr_output.parse_bgp_brief(
+                f"10.1.0.2          0     1          {up_down} {state}\n"
+                f"100.0.0.1         0     1          1d02h    Established\n"
+            )
+        )
+
+    sample("00:00:10")
+    sample("00:00:20")
+    assert len(samples) == 4
+    assert samples.flaps("10.1.0.2") == 0
+
+    # Down, and back up.
+    sample("00:00:01", "Active")
+    sample("00:00:05")
+    assert samples.flaps("10.1.0.2") == 1
+
+    # Reset between samples.
+    sample("00:00:01")
+    assert samples.flaps("10.1.0.2") == 2
+    assert samples.flaps("100.0.0.1") == 0
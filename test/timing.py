@@ -0,0 +1,213 @@
+# timing.py
+
+"""
+Timing of the phases of a test session.
+
+Phases are recorded as spans, nested per thread, e.g.::
+
+    >>> with timing.span("helm install", category="helm"):
+    ...     ...
+
+or by decorating a function::
+
+    >>> @timing.traced(category="k8s")
+    ... def wait_for_pods(...):
+    ...     ...
+
+The spans can be written out as a Chrome trace (viewable in chrome://tracing
+or https://ui.perfetto.dev), and summarized as the slowest phases.  The
+phases of other processes (e.g. pytest-xdist workers) can be merged into the
+summary.
+
+"""
+
+__all__ = (
+    "Span",
+    "Tracer",
+    "span",
+    "traced",
+    "tracer",
+)
+
+import contextlib
+import dataclasses
+import functools
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Iterator, Optional, TypeVar, Union
+
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+@dataclasses.dataclass
+class Span:
+    """
+    A timed phase.
+
+    .. attribute:: start
+       Start time, in seconds since the tracer was created.
+
+    .. attribute:: parent
+       Index of the enclosing span on the same thread, if any.
+
+    """
+
+    name: str
+    category: str
+    start: float
+    end: Optional[float]
+    thread: int
+    parent: Optional[int]
+    args: dict[str, Any]
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else self.start) - self.start
+
+
+class Tracer:
+    """Records spans from any thread."""
+
+    def __init__(self):
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.spans: list[Span] = []
+        # Phases merged from other tracers, as returned by `phases`.
+        self._merged: dict[str, list] = {}
+
+    def _now(self) -> float:
+        return time.perf_counter() - self._origin
+
+    @contextlib.contextmanager
+    def span(self, name: str, category: str = "", **args) -> Iterator[Span]:
+        """Record a span around the body of the ``with`` statement."""
+        stack = self._local.__dict__.setdefault("stack", [])
+        with self._lock:
+            index = len(self.spans)
+            s = Span(
+                name=name,
+                category=category,
+                start=self._now(),
+                end=None,
+                thread=threading.get_ident(),
+                parent=stack[-1] if stack else None,
+                args=args,
+            )
+            self.spans.append(s)
+        stack.append(index)
+        try:
+            yield s
+        except BaseException as e:
+            s.args["error"] = type(e).__name__
+            raise
+        finally:
+            stack.pop()
+            s.end = self._now()
+
+    def traced(
+        self,
+        name: Union[str, Callable[..., str], None] = None,
+        category: str = "",
+    ) -> Callable[[F], F]:
+        """
+        Decorator to record a span around each call of a function.
+
+        :param name:
+            Name of the span (default: the function's qualified name), or a
+            function called with the same arguments to return the name.
+
+        """
+
+        def decorator(func: F) -> F:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if callable(name):
+                    span_name = name(*args, **kwargs)
+                else:
+                    span_name = name or func.__qualname__
+                with self.span(span_name, category):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def chrome_trace(self) -> dict[str, Any]:
+        """Return the spans in Chrome trace event format."""
+        pid = os.getpid()
+        return {
+            "traceEvents": [
+                {
+                    "name": s.name,
+                    "cat": s.category,
+                    "ph": "X",
+                    "ts": round(s.start * 1e6),
+                    "dur": round(s.duration * 1e6),
+                    "pid": pid,
+                    "tid": s.thread,
+                    "args": {k: str(v) for k, v in s.args.items()},
+                }
+                for s in self.spans
+            ],
+            "displayTimeUnit": "ms",
+        }
+
+    def write_chrome_trace(self, fname: Path) -> None:
+        with open(fname, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
+    def phases(self) -> dict[str, list]:
+        """
+        Return the phases, aggregating spans with the same name, including
+        those merged from other tracers (see `merge`).
+
+        :returns:
+            The [count, total, max] of each phase, by name.
+
+        """
+        phases = {name: list(p) for name, p in self._merged.items()}
+        for s in self.spans:
+            _add_phase(phases, s.name, [1, s.duration, s.duration])
+        return phases
+
+    def merge(self, phases: dict[str, list]) -> None:
+        """
+        Merge the phases of another tracer, e.g. of a pytest-xdist worker, as
+        returned by its `phases`.
+
+        """
+        with self._lock:
+            for name, phase in phases.items():
+                _add_phase(self._merged, name, phase)
+
+    def slowest(self, n: int) -> list[tuple[str, int, float, float]]:
+        """
+        Return the ``n`` slowest phases by total time (see `phases`).
+
+        :returns:
+            A list of (name, count, total, max) tuples, slowest first.
+
+        """
+        summary = [(name, *p) for name, p in self.phases().items()]
+        summary.sort(key=lambda p: p[2], reverse=True)
+        return summary[:n]
+
+
+def _add_phase(phases: dict[str, list], name: str, phase: list) -> None:
+    if (p := phases.get(name)) is None:
+        phases[name] = list(phase)
+    else:
+        p[0] += phase[0]
+        p[1] += phase[1]
+        p[2] = max(p[2], phase[2])
+
+
+# The tracer for the test session.
+tracer = Tracer()
+span = tracer.span
+traced = tracer.traced
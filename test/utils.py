@@ -1,30 +1,45 @@
 # utils.py
 
 __all__ = (
+    "Check",
+    "WaitResult",
+    "assert_checks",
     "check_ping",
+    "poll",
+    "run_checks",
     "run_cmd",
+    "wait_all",
     "wait_until",
 )
 
 
+import codecs
+import collections
+import concurrent.futures
+import dataclasses
+import functools
 import logging
+import os
+import random
+import selectors
 import shlex
 import subprocess
 import time
-from typing import Callable
+from typing import Callable, Iterable, Optional, Union
 
-from ._types import Kubectl
+from . import timing, xr_output
+from ._types import PodExec
 
 
 logger = logging.getLogger(__name__)
 
 
-def check_ping(kubectl: Kubectl, pod_name: str, address: str) -> bool:
+def check_ping(pod_exec: PodExec, pod_name: str, address: str) -> bool:
     """
     Check whether it is possible to ping a given address from a given pod.
 
-    :param kubectl:
-        Kubectl context.
+    :param pod_exec:
+        Function to run a command in a pod.
 
     :param pod_name:
         Pod from which to ping.
@@ -38,22 +53,56 @@ def check_ping(kubectl: Kubectl, pod_name: str, address: str) -> bool:
 
     """
     try:
-        p = kubectl(
-            "exec",
-            pod_name,
-            "--",
-            "xrenv",
-            "ping",
-            address,
-        )
-    except subprocess.CalledProcessError:
+        p = pod_exec(pod_name, "xrenv", "ping", address)
+    except (
+        subprocess.CalledProcessError,
+        subprocess.TimeoutExpired,
+        ConnectionError,
+    ):
+        return False
+
+    try:
+        return xr_output.parse_ping(p.stdout).success
+    except ValueError:
         return False
 
-    return "!!!!!" in p.stdout
+
+# Global options of the commands run which take a value, skipped when naming
+# the commands' spans.
+_VALUE_OPTIONS = (
+    "-n",
+    "--context",
+    "--kubeconfig",
+    "--namespace",
+    "--profile",
+    "--region",
+)
+
+
+def _cmd_name(cmd: list[str], **kwargs) -> str:
+    """
+    Name a command by its program and first non-option argument, e.g.
+    "kubectl get" for ``kubectl --namespace foo get pods``.
+
+    """
+    args = iter(cmd[1:])
+    for arg in args:
+        if arg in _VALUE_OPTIONS:
+            next(args, None)
+        elif not arg.startswith("-"):
+            return shlex.join([cmd[0], arg])
+    return shlex.quote(cmd[0])
 
 
+@timing.traced(name=_cmd_name, category="cmd")
 def run_cmd(
-    cmd: list[str], *, log_output: bool = False, **kwargs
+    cmd: list[str],
+    *,
+    log_output: bool = False,
+    stream: bool = False,
+    on_line: Optional[Callable[[str, str], None]] = None,
+    max_lines: Optional[int] = 1000,
+    **kwargs,
 ) -> subprocess.CompletedProcess[str]:
     """
     Run a command, capturing stdout and stderr by default, and raising on error.
@@ -64,8 +113,24 @@ def run_cmd(
     :param log_output:
         Whether to log the output.
 
+    :param stream:
+        Whether to read the output as it is produced, rather than when the
+        command ends.  Each line is logged as it arrives if ``log_output`` is
+        set, and passed to ``on_line``.  Only the last ``max_lines`` lines of
+        each of stdout and stderr are kept in the completed process object.
+
+    :param on_line:
+        Function called with the name of the stream ("stdout" or "stderr")
+        and each line of output (without the newline), in streaming mode.
+
+    :param max_lines:
+        Number of lines of each of stdout and stderr to keep in streaming
+        mode, or None to keep all.
+
     :param kwargs:
-        Passed through to subprocess.run().
+        Passed through to subprocess.run(), or subprocess.Popen() in
+        streaming mode (where only ``check`` and ``timeout`` are also
+        accepted).
 
     :raises subprocess.CalledProcessError:
         If the command returns non-zero exit status.
@@ -78,6 +143,19 @@ def run_cmd(
 
     """
     logger.debug("Running command: %r", shlex.join(cmd))
+    if stream:
+        try:
+            return _run_streaming(
+                cmd,
+                log_output=log_output,
+                on_line=on_line,
+                max_lines=max_lines,
+                **kwargs,
+            )
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+            _log_failure(e)
+            raise
+
     kwargs = {
         "check": True,
         "text": True,
@@ -98,35 +176,13 @@ def run_cmd(
     try:
         p: subprocess.CompletedProcess[str] = subprocess.run(cmd, **kwargs)
     except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
-        if isinstance(e, subprocess.CalledProcessError):
-            issue_desc = "failed"
-            rc = e.returncode
-        else:
-            issue_desc = "timed out"
-            rc = None
-            # Workaround for https://github.com/python/cpython/issues/87597,
-            # TimeoutExpired gives bytes rather than str.
-            if isinstance(e.stdout, bytes):
-                e.stdout = e.stdout.decode("utf-8")
-            if isinstance(e.stderr, bytes):
-                e.stderr = e.stderr.decode("utf-8")
-        if e.stderr:
-            logger.debug(
-                "Command %s with exit code %s, stdout:\n%s\nstderr:\n%s",
-                issue_desc,
-                rc,
-                e.stdout.strip("\n"),
-                e.stderr.strip("\n"),
-            )
-        elif e.stdout:
-            logger.debug(
-                "Command %s with exit code %s, output:\n%s",
-                issue_desc,
-                rc,
-                e.stdout.strip("\n"),
-            )
-        else:
-            logger.debug("Command %s with exit code %s", issue_desc, rc)
+        # Workaround for https://github.com/python/cpython/issues/87597,
+        # TimeoutExpired gives bytes rather than str.
+        if isinstance(e.stdout, bytes):
+            e.stdout = e.stdout.decode("utf-8")
+        if isinstance(e.stderr, bytes):
+            e.stderr = e.stderr.decode("utf-8")
+        _log_failure(e)
         raise
 
     if log_output:
@@ -136,6 +192,378 @@ def run_cmd(
     return p
 
 
+def _log_failure(
+    e: Union[subprocess.CalledProcessError, subprocess.TimeoutExpired],
+) -> None:
+    if isinstance(e, subprocess.CalledProcessError):
+        issue_desc = "failed"
+        rc = e.returncode
+    else:
+        issue_desc = "timed out"
+        rc = None
+    if e.stderr:
+        logger.debug(
+            "Command %s with exit code %s, stdout:\n%s\nstderr:\n%s",
+            issue_desc,
+            rc,
+            (e.stdout or "").strip("\n"),
+            e.stderr.strip("\n"),
+        )
+    elif e.stdout:
+        logger.debug(
+            "Command %s with exit code %s, output:\n%s",
+            issue_desc,
+            rc,
+            e.stdout.strip("\n"),
+        )
+    else:
+        logger.debug("Command %s with exit code %s", issue_desc, rc)
+
+
+def _run_streaming(
+    cmd: list[str],
+    *,
+    log_output: bool,
+    on_line: Optional[Callable[[str, str], None]],
+    max_lines: Optional[int],
+    check: bool = True,
+    timeout: Optional[float] = None,
+    **kwargs,
+) -> subprocess.CompletedProcess[str]:
+    """Run a command, reading its output line by line as it is produced."""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    lines = {
+        "stdout": collections.deque(maxlen=max_lines),
+        "stderr": collections.deque(maxlen=max_lines),
+    }
+
+    def handle_line(name: str, line: str) -> None:
+        lines[name].append(line)
+        if log_output:
+            logger.debug("Command %s: %s", name, line)
+        if on_line is not None:
+            on_line(name, line)
+
+    def output(name: str) -> str:
+        return "".join(f"{line}\n" for line in lines[name])
+
+    with subprocess.Popen(
+        cmd,
+        stdin=kwargs.pop("stdin", subprocess.DEVNULL),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        **kwargs,
+    ) as proc, selectors.DefaultSelector() as selector:
+        for name in ("stdout", "stderr"):
+            pipe = getattr(proc, name)
+            os.set_blocking(pipe.fileno(), False)
+            selector.register(
+                pipe,
+                selectors.EVENT_READ,
+                (name, codecs.getincrementaldecoder("utf-8")("replace"), [""]),
+            )
+
+        while selector.get_map():
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    proc.kill()
+                    raise subprocess.TimeoutExpired(
+                        cmd,
+                        timeout,
+                        output=output("stdout"),
+                        stderr=output("stderr"),
+                    )
+            for key, _ in selector.select(remaining):
+                name, decoder, partial = key.data
+                data = os.read(key.fd, 65536)
+                text = partial[0] + decoder.decode(data, final=not data)
+                *complete, partial[0] = text.split("\n")
+                if not data:
+                    # End of the stream: flush any unterminated last line.
+                    selector.unregister(key.fileobj)
+                    if partial[0]:
+                        complete.append(partial[0])
+                for line in complete:
+                    handle_line(name, line)
+
+        remaining = None if deadline is None else deadline - time.monotonic()
+        try:
+            returncode = proc.wait(remaining)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            raise subprocess.TimeoutExpired(
+                cmd, timeout, output=output("stdout"), stderr=output("stderr")
+            ) from None
+
+    p = subprocess.CompletedProcess(
+        cmd, returncode, stdout=output("stdout"), stderr=output("stderr")
+    )
+    if check:
+        p.check_returncode()
+    return p
+
+
+@dataclasses.dataclass
+class WaitResult:
+    """
+    The result of waiting for a predicate to become true.
+
+    .. attribute:: name
+       Name of the predicate.
+
+    .. attribute:: success
+       Whether the predicate became true before the timeout.
+
+    .. attribute:: elapsed
+       Time in seconds until the predicate became true, or until giving up.
+
+    .. attribute:: attempts
+       Number of times the predicate was called.
+
+    .. attribute:: error
+       The exception raised by the predicate, if it raised one when run as a
+       `Check`.
+
+    """
+
+    name: str
+    success: bool
+    elapsed: float
+    attempts: int
+    error: Optional[Exception] = None
+
+    def __bool__(self) -> bool:
+        return self.success
+
+
+def _poll_span_name(predicate, *, name=None, **kwargs) -> str:
+    return f"poll {name or getattr(predicate, '__name__', repr(predicate))}"
+
+
+@timing.traced(name=_poll_span_name, category="wait")
+def poll(
+    predicate: Callable[[], bool],
+    *,
+    timeout: float,
+    interval: float = 1,
+    backoff: float = 2,
+    max_interval: Optional[float] = 5,
+    jitter: float = 0.1,
+    name: Optional[str] = None,
+) -> WaitResult:
+    """
+    Call a predicate until it returns true, or until a timeout expires.
+
+    The timeout is measured with a monotonic clock, and includes the time
+    spent in the predicate.  The predicate is always called at least once,
+    and is called once more when the timeout expires, but a call in progress
+    is not interrupted.
+
+    :param predicate:
+        Predicate to call, with no arguments.
+
+    :param timeout:
+        Maximum time to wait in seconds.
+
+    :param interval:
+        Initial time to sleep between calls in seconds.
+
+    :param backoff:
+        Factor to multiply the interval by after each call.  Set to 1 for a
+        fixed interval.
+
+    :param max_interval:
+        Maximum time to sleep between calls in seconds, or None for no
+        maximum.
+
+    :param jitter:
+        Fraction by which each sleep is randomly lengthened or shortened.
+
+    :param name:
+        Name of the predicate for the result and logging (default: the
+        predicate's name).
+
+    :returns:
+        A `WaitResult`, which is truthy if the predicate returned true.
+
+    """
+    if name is None:
+        name = getattr(predicate, "__name__", repr(predicate))
+
+    start = time.monotonic()
+    deadline = start + timeout
+    delay = interval
+    attempts = 0
+    while True:
+        attempts += 1
+        if predicate():
+            success = True
+            break
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            success = False
+            break
+        sleep = delay * (1 + random.uniform(-jitter, jitter))
+        time.sleep(max(0, min(sleep, remaining)))
+        delay *= backoff
+        if max_interval is not None:
+            delay = min(delay, max_interval)
+
+    result = WaitResult(name, success, time.monotonic() - start, attempts)
+    logger.debug(
+        "Waited %.1fs for %s (%d attempts): %s",
+        result.elapsed,
+        name,
+        attempts,
+        "succeeded" if success else "timed out",
+    )
+    return result
+
+
+@dataclasses.dataclass
+class Check:
+    """
+    A named predicate to wait for, with its own timeout.
+
+    .. attribute:: name
+       Name of the check, used in results and failure messages.
+
+    .. attribute:: predicate
+       Predicate to call, with no arguments.
+
+    .. attribute:: timeout
+       Maximum time to wait for the predicate in seconds.
+
+    """
+
+    name: str
+    predicate: Callable[[], bool]
+    timeout: float = 60
+
+
+def _run_check(check: Check, **kwargs) -> WaitResult:
+    """Wait for a check, returning a failed result if its predicate raises."""
+    attempts = 0
+
+    def predicate() -> bool:
+        nonlocal attempts
+        attempts += 1
+        return check.predicate()
+
+    start = time.monotonic()
+    try:
+        return poll(
+            predicate, timeout=check.timeout, name=check.name, **kwargs
+        )
+    except Exception as e:
+        logger.debug("Check %s raised %r", check.name, e)
+        return WaitResult(
+            check.name, False, time.monotonic() - start, attempts, error=e
+        )
+
+
+def run_checks(
+    checks: Iterable[Check],
+    *,
+    max_workers: Optional[int] = None,
+    **kwargs,
+) -> dict[str, WaitResult]:
+    """
+    Wait for several checks at once, each in its own thread.
+
+    The total time taken is roughly that of the slowest check, rather than
+    the sum of all of them.  A check whose predicate raises an exception
+    fails, with the exception in its result, without affecting the others.
+
+    :param checks:
+        Checks to wait for.  Names must be unique.
+
+    :param max_workers:
+        Maximum number of checks to run concurrently (default: all).
+
+    :param kwargs:
+        Passed through to `poll`.
+
+    :returns:
+        The `WaitResult` of each check, keyed by name, in the order given.
+
+    """
+    checks = list(checks)
+    if not checks:
+        return {}
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=max_workers or len(checks)
+    ) as executor:
+        futures = {
+            check.name: executor.submit(_run_check, check, **kwargs)
+            for check in checks
+        }
+        return {name: future.result() for name, future in futures.items()}
+
+
+def assert_checks(checks: Iterable[Check], **kwargs) -> dict[str, WaitResult]:
+    """
+    Assert several checks all succeed, waiting for them at once.
+
+    Unlike asserting on each check in turn, all checks are run to completion
+    and every failure is reported together.
+
+    :param kwargs:
+        Passed through to `run_checks`.
+
+    :raises AssertionError:
+        If any check does not succeed within its timeout, or raises.  The
+        first exception raised by a check, if any, is chained.
+
+    :returns:
+        The `WaitResult` of each check, keyed by name.
+
+    """
+    results = run_checks(checks, **kwargs)
+    failures = [r for r in results.values() if not r]
+    if failures:
+        errors = [r.error for r in failures if r.error is not None]
+        raise AssertionError(
+            f"{len(failures)} of {len(results)} checks failed:\n"
+            + "\n".join(
+                f"  {r.name} ("
+                + (f"raised {r.error!r}" if r.error else "gave up")
+                + f" after {r.elapsed:.1f}s, {r.attempts} attempts)"
+                for r in failures
+            )
+        ) from (errors[0] if errors else None)
+    return results
+
+
+def wait_all(
+    predicates: dict[str, Callable[[], bool]],
+    *,
+    timeout: float,
+    **kwargs,
+) -> dict[str, WaitResult]:
+    """
+    Wait for several predicates at once, each in its own thread.
+
+    :param predicates:
+        Predicates to call with no arguments, keyed by name.
+
+    :param timeout:
+        Maximum time to wait for each predicate in seconds.
+
+    :param kwargs:
+        Passed through to `run_checks`.
+
+    :returns:
+        The `WaitResult` of each predicate, keyed by name, in the order given.
+
+    """
+    return run_checks(
+        (Check(name, p, timeout) for name, p in predicates.items()), **kwargs
+    )
+
+
 def wait_until(
     interval: int,
     maximum: int,
@@ -143,10 +571,21 @@ def wait_until(
     *args,
     **kwargs,
 ) -> bool:
-    elapsed = 0
-    while elapsed < maximum:
-        if predicate(*args, **kwargs):
-            return True
-        time.sleep(interval)
-        elapsed += interval
-    return False
+    """
+    Call ``predicate(*args, **kwargs)`` every ``interval`` seconds until it
+    returns true, for up to ``maximum`` seconds.
+
+    This is a fixed-interval `poll`.
+
+    :returns:
+        True if the predicate returned true, False if it timed out.
+
+    """
+    return poll(
+        functools.partial(predicate, *args, **kwargs),
+        timeout=maximum,
+        interval=interval,
+        backoff=1,
+        jitter=0,
+        name=getattr(predicate, "__name__", None),
+    ).success
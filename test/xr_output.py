@@ -0,0 +1,321 @@
+# xr_output.py
+
+"""Parsers for XR CLI output, and tables of repeated samples."""
+
+__all__ = (
+    "BgpNeighbor",
+    "BgpSamples",
+    "PingResult",
+    "PingSamples",
+    "parse_bgp_brief",
+    "parse_duration",
+    "parse_ping",
+    "percentile",
+)
+
+import array
+import dataclasses
+import math
+import re
+import time
+from typing import Iterable, Optional
+
+
+_DURATION_HMS_RE = re.compile(r"^(\d+):(\d+):(\d+)$")
+_DURATION_UNITS_RE = re.compile(
+    r"^(?:(\d+)y)?(?:(\d+)w)?(?:(\d+)d)?(?:(\d+)h)?$"
+)
+_DURATION_UNITS = (365 * 86400, 7 * 86400, 86400, 3600)
+
+_PING_SUCCESS_RE = re.compile(
+    r"Success rate is (\d+) percent \((\d+)/(\d+)\)"
+    r"(?:, round-trip min/avg/max = (\d+)/(\d+)/(\d+) ms)?"
+)
+_PING_DEST_RE = re.compile(r"ICMP Echos to ([^\s,]+)")
+
+
+def parse_duration(value: str) -> Optional[float]:
+    """
+    Parse an XR duration, e.g. an Up/Down time, into seconds.
+
+    XR shows durations as ``hh:mm:ss`` for under a day, and then in units of
+    years, weeks, days and hours, e.g. ``1d02h`` or ``2w3d``.
+
+    :returns:
+        The duration in seconds, or None for ``never``.
+
+    :raises ValueError:
+        If the duration can't be parsed.
+
+    """
+    if value == "never":
+        return None
+    if m := _DURATION_HMS_RE.match(value):
+        hours, minutes, seconds = (int(x) for x in m.groups())
+        return float(hours * 3600 + minutes * 60 + seconds)
+    if (m := _DURATION_UNITS_RE.match(value)) and any(m.groups()):
+        return float(
+            sum(
+                int(x) * unit
+                for x, unit in zip(m.groups(), _DURATION_UNITS)
+                if x is not None
+            )
+        )
+    raise ValueError(f"Invalid duration: {value!r}")
+
+
+@dataclasses.dataclass
+class BgpNeighbor:
+    """
+    A neighbor in ``show bgp neighbor brief`` (``bgp_show -n -br``) output.
+
+    .. attribute:: up_down
+       Time in seconds the session has been up (if established) or down, or
+       None if it has never been up.
+
+    """
+
+    neighbor: str
+    speaker: int
+    asn: str
+    description: str
+    up_down: Optional[float]
+    state: str
+
+    @property
+    def established(self) -> bool:
+        return self.state == "Established"
+
+
+def parse_bgp_brief(output: str) -> list[BgpNeighbor]:
+    """
+    Parse ``bgp_show -n -br`` output.
+
+    Example output::
+
+        Neighbor        Spk    AS Description                          Up/Down  NBRState
+        10.1.0.2          0     1                                      00:17:12 Established
+        100.0.0.1         0     1                                      00:15:44 Established
+
+    Lines which aren't neighbor entries (e.g. the header) are ignored.
+
+    """
+    neighbors = []
+    for line in output.splitlines():
+        cols = line.split()
+        if len(cols) < 5 or not cols[1].isdigit():
+            continue
+        # The description may be empty or contain spaces, and the state may
+        # contain spaces (e.g. "Idle (Admin)"), so find the Up/Down column.
+        for i in range(len(cols) - 2, 2, -1):
+            try:
+                up_down = parse_duration(cols[i])
+            except ValueError:
+                continue
+            break
+        else:
+            continue
+        neighbors.append(
+            BgpNeighbor(
+                neighbor=cols[0],
+                speaker=int(cols[1]),
+                asn=cols[2],
+                description=" ".join(cols[3:i]),
+                up_down=up_down,
+                state=" ".join(cols[i + 1 :]),
+            )
+        )
+    return neighbors
+
+
+@dataclasses.dataclass
+class PingResult:
+    """
+    The result of an XR ``ping``.
+
+    .. attribute:: success_rate
+       Percentage of echo requests which were answered.
+
+    .. attribute:: rtt_min
+       Minimum round-trip time in ms, or None if there were no replies.
+
+    """
+
+    destination: Optional[str]
+    sent: int
+    received: int
+    success_rate: int
+    rtt_min: Optional[float] = None
+    rtt_avg: Optional[float] = None
+    rtt_max: Optional[float] = None
+
+    @property
+    def success(self) -> bool:
+        return self.sent > 0 and self.received == self.sent
+
+
+def parse_ping(output: str) -> PingResult:
+    """
+    Parse ``xrenv ping`` output.
+
+    Example output::
+
+        Sending 5, 100-byte ICMP Echos to 10.0.2.12, timeout is 2 seconds:
+        !!!!!
+        Success rate is 100 percent (5/5), round-trip min/avg/max = 1/2/4 ms
+
+    :raises ValueError:
+        If there is no success rate in the output.
+
+    """
+    m = _PING_SUCCESS_RE.search(output)
+    if m is None:
+        raise ValueError(f"No ping success rate found in: {output!r}")
+    dest = _PING_DEST_RE.search(output)
+    rate, received, sent, *rtts = m.groups()
+    rtt_min, rtt_avg, rtt_max = (
+        float(x) if x is not None else None for x in rtts
+    )
+    return PingResult(
+        destination=dest.group(1) if dest else None,
+        sent=int(sent),
+        received=int(received),
+        success_rate=int(rate),
+        rtt_min=rtt_min,
+        rtt_avg=rtt_avg,
+        rtt_max=rtt_max,
+    )
+
+
+def percentile(values: Iterable[float], q: float) -> float:
+    """
+    Return the ``q``-th percentile (0-100) of some values, interpolating
+    linearly between the closest ranks.  NaN values are ignored.
+
+    :raises ValueError:
+        If there are no (non-NaN) values.
+
+    """
+    values = sorted(v for v in values if not math.isnan(v))
+    if not values:
+        raise ValueError("No values")
+    rank = (len(values) - 1) * q / 100
+    lower = math.floor(rank)
+    upper = math.ceil(rank)
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+
+def _optional(value: Optional[float]) -> float:
+    return math.nan if value is None else value
+
+
+class PingSamples:
+    """
+    A columnar table of repeated ping results.
+
+    Each column is an `array.array`, so statistics across many samples are
+    cheap to compute.  Missing RTTs (no replies) are stored as NaN.
+
+    Example usage::
+
+        >>> samples = PingSamples()
+        >>> samples.append(parse_ping(output))
+        >>> assert samples.loss() < 0.01
+        >>> assert samples.rtt_percentile(99) < 5
+
+    """
+
+    def __init__(self):
+        self.timestamp = array.array("d")
+        self.sent = array.array("l")
+        self.received = array.array("l")
+        self.rtt_min = array.array("d")
+        self.rtt_avg = array.array("d")
+        self.rtt_max = array.array("d")
+
+    def __len__(self) -> int:
+        return len(self.timestamp)
+
+    def append(
+        self, result: PingResult, *, timestamp: Optional[float] = None
+    ) -> None:
+        """Add a sample, timestamped now unless ``timestamp`` is given."""
+        self.timestamp.append(time.time() if timestamp is None else timestamp)
+        self.sent.append(result.sent)
+        self.received.append(result.received)
+        self.rtt_min.append(_optional(result.rtt_min))
+        self.rtt_avg.append(_optional(result.rtt_avg))
+        self.rtt_max.append(_optional(result.rtt_max))
+
+    def loss(self) -> float:
+        """Return the fraction of echo requests lost across all samples."""
+        sent = sum(self.sent)
+        return (sent - sum(self.received)) / sent if sent else 0.0
+
+    def rtt_percentile(self, q: float, *, column: str = "rtt_avg") -> float:
+        """Return a percentile of an RTT column, in ms."""
+        return percentile(getattr(self, column), q)
+
+
+class BgpSamples:
+    """
+    A columnar table of repeated BGP neighbor states.
+
+    Each sample adds one row per neighbor.  Up/Down times are stored as NaN
+    for neighbors which have never been up.
+
+    Example usage::
+
+        >>> samples = BgpSamples()
+        >>> samples.append(parse_bgp_brief(output))
+        >>> assert samples.flaps("10.1.0.2") == 0
+
+    """
+
+    def __init__(self):
+        self.timestamp = array.array("d")
+        self.neighbor: list[str] = []
+        self.established = array.array("b")
+        self.up_down = array.array("d")
+
+    def __len__(self) -> int:
+        return len(self.timestamp)
+
+    def append(
+        self,
+        neighbors: Iterable[BgpNeighbor],
+        *,
+        timestamp: Optional[float] = None,
+    ) -> None:
+        """Add a sample, timestamped now unless ``timestamp`` is given."""
+        if timestamp is None:
+            timestamp = time.time()
+        for n in neighbors:
+            self.timestamp.append(timestamp)
+            self.neighbor.append(n.neighbor)
+            self.established.append(n.established)
+            self.up_down.append(_optional(n.up_down))
+
+    def flaps(self, neighbor: str) -> int:
+        """
+        Return the number of times a neighbor's session went down between
+        samples.
+
+        This counts transitions out of Established, and also sessions which
+        were Established in consecutive samples but whose uptime went
+        backwards (i.e. the session reset between the samples).
+
+        """
+        flaps = 0
+        prev_established = False
+        prev_up = math.nan
+        for name, established, up in zip(
+            self.neighbor, self.established, self.up_down
+        ):
+            if name != neighbor:
+                continue
+            if prev_established and (not established or up < prev_up):
+                flaps += 1
+            prev_established = bool(established)
+            prev_up = up
+        return flaps